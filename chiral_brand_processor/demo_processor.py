@@ -9,6 +9,9 @@ import json
 import re
 from pathlib import Path
 from datetime import datetime
+from itertools import islice
+from rule_cache import load_rule_set
+from text_replacer import TextReplacer
 
 class DemoTextReplacer:
     """Simplified text replacer for demonstration"""
@@ -18,8 +21,11 @@ class DemoTextReplacer:
         with open(config_path, 'r', encoding='utf-8') as f:
             config = json.load(f)
         
-        self.rules = config['text_replacements']
-        self.product_config = config['product_naming']
+        # One compiled rule set per config, shared with every replacer
+        self.rule_set = load_rule_set(config)
+        # Every rule the matcher applies, Chinese rules included
+        self.rules = dict(zip(self.rule_set.matcher.keys, self.rule_set.matcher.values))
+        self.product_config = self.rule_set.product_naming
         
         print(f"📋 Loaded {len(self.rules)} replacement rules")
         
@@ -28,32 +34,38 @@ class DemoTextReplacer:
         original_text = text
         replacement_count = 0
         
-        # Apply basic text replacements
-        for old_text, new_text in self.rules.items():
-            if old_text in text:
-                count_before = text.count(old_text)
-                text = text.replace(old_text, new_text)
-                replacement_count += count_before
-                
-                if count_before > 0:
-                    print(f"  ✅ '{old_text}' → '{new_text}' ({count_before} times)")
+        # Apply basic text replacements in a single pass
+        text, counts = self.rule_set.matcher.replace(text)
+        for old_text, count in zip(self.rule_set.matcher.keys, counts):
+            if count > 0:
+                replacement_count += count
+                print(f"  ✅ '{old_text}' → '{self.rules[old_text]}' ({count} times)")
         
         # Apply product naming changes
         text = self.update_product_names(text)
         
         return text, replacement_count
     
+    def process_file(self, input_path, output_path, chunk_size=1 << 20):
+        """Process a text file in fixed-size chunks, writing output as it goes"""
+        replacer = TextReplacer(self.rules, rule_set=self.rule_set)
+        renamed = [0]
+        counts = replacer.replace_file(Path(input_path), Path(output_path), chunk_size, renamed)
+        
+        for old_text, count in counts.items():
+            print(f"  ✅ '{old_text}' → '{self.rules[old_text]}' ({count} times)")
+        if renamed[0]:
+            print(f"  🔄 Product names updated ({renamed[0]} times)")
+        
+        return sum(counts.values()) + renamed[0]
+    
     def update_product_names(self, text):
         """Update product naming"""
-        # Remove old prefixes and add new ones
-        for old_prefix in self.product_config['remove_prefix']:
-            for model in ['Lite3', 'Lite2', 'X20', 'Mini', 'X30', 'J60Joint']:
-                old_pattern = f"{old_prefix}{model}"
-                new_pattern = f"{self.product_config['add_prefix']} {model}"
-                
-                if old_pattern in text:
-                    text = text.replace(old_pattern, new_pattern)
-                    print(f"  🔄 Product: '{old_pattern}' → '{new_pattern}'")
+        # Remove old prefixes and add new ones in one compiled pass
+        text, count = self.rule_set.namer.rename(text)
+        
+        if count > 0:
+            print(f"  🔄 Product names updated ({count} times)")
         
         return text
     
@@ -83,6 +95,11 @@ class DemoTextReplacer:
         print("-" * 50)
         return changes_found
 
+def read_sample_lines(path, count=10):
+    """Read the first few lines of a file without loading all of it"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return [line.rstrip('\n') for line in islice(f, count)]
+
 def create_demo_logo():
     """Create a simple text-based logo"""
     logo_styles = {
@@ -133,44 +150,34 @@ def demo_complete_workflow():
         print(f"\n📄 Processing: {file_path.name}")
         print("=" * 40)
         
-        # Read file
-        with open(file_path, 'r', encoding='utf-8') as f:
-            original_content = f.read()
+        print(f"📊 Original file size: {file_path.stat().st_size} bytes")
         
-        print(f"📊 Original file size: {len(original_content)} characters")
+        # Generate output filename
+        output_dir = Path("output")
+        output_dir.mkdir(exist_ok=True)
         
-        # Preview changes
-        changes_found = replacer.preview_changes(original_content)
+        output_filename = f"Chiral_{file_path.stem}_Datasheet.txt"
+        output_path = output_dir / output_filename
         
-        if changes_found:
-            # Apply changes
-            print("\n🔄 Applying changes...")
-            modified_content, change_count = replacer.process_text(original_content)
-            
-            # Generate output filename
-            output_dir = Path("output")
-            output_dir.mkdir(exist_ok=True)
-            
-            output_filename = f"Chiral_{file_path.stem}_Datasheet.txt"
-            output_path = output_dir / output_filename
-            
-            # Save processed file
-            with open(output_path, 'w', encoding='utf-8') as f:
-                f.write(modified_content)
-            
+        # Apply changes, streaming the file through the replacer
+        print("\n🔄 Applying changes...")
+        change_count = replacer.process_file(file_path, output_path)
+        
+        if change_count:
             print(f"✅ Saved processed file: {output_path}")
             print(f"📈 Total changes made: {change_count}")
             
             # Show sample of changes
             print("\n📋 Sample of processed content:")
             print("-" * 40)
-            lines = modified_content.split('\n')[:10]
-            for line in lines:
+            lines = read_sample_lines(output_path, 11)
+            for line in lines[:10]:
                 if line.strip():
                     print(f"   {line}")
-            if len(modified_content.split('\n')) > 10:
+            if len(lines) > 10:
                 print("   ...")
         else:
+            output_path.unlink()
             print("ℹ️  No changes needed for this file")
     
     # Generate demo logos
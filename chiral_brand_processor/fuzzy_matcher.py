@@ -0,0 +1,274 @@
+"""
+Fuzzy Matching Module - Detects OCR-mangled and spaced-out brand names
+"""
+
+import re
+import logging
+from bisect import bisect_right
+from typing import Dict, List, Tuple, Any, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Characters that OCR and text extraction commonly confuse with letters
+OCR_CONFUSABLES = str.maketrans({'0': 'o', '1': 'l', '|': 'l', '5': 's', '$': 's'})
+
+# Runs of characters that make up the matching skeleton
+SKELETON_RUN = re.compile(r'[A-Za-z0-9|$]+')
+
+# Gaps that may split a brand name: spaces, hyphenated line breaks, dots
+JOINABLE_GAP = re.compile(r'[\s\-­._]{1,3}')
+
+# Inserted into the skeleton where runs must not be joined
+BARRIER = '#'
+
+
+def build_skeleton(text: str) -> Tuple[str, List[int], List[int]]:
+    """Lowercased, confusable-mapped alphanumeric skeleton of ``text``
+
+    Returns the skeleton plus parallel lists of run start offsets in the
+    skeleton and in the original text, used to map matches back.
+    """
+    parts = []
+    skeleton_starts = []
+    original_starts = []
+    length = 0
+    previous_end = None
+
+    for run in SKELETON_RUN.finditer(text):
+        if previous_end is not None and not JOINABLE_GAP.fullmatch(text, previous_end, run.start()):
+            skeleton_starts.append(length)
+            original_starts.append(previous_end)
+            parts.append(BARRIER)
+            length += 1
+
+        skeleton_starts.append(length)
+        original_starts.append(run.start())
+        parts.append(run.group())
+        length += run.end() - run.start()
+        previous_end = run.end()
+
+    skeleton = ''.join(parts).lower().translate(OCR_CONFUSABLES)
+    return skeleton, skeleton_starts, original_starts
+
+
+def term_skeleton(term: str) -> str:
+    """Skeleton of a configured brand term"""
+    return build_skeleton(term)[0].replace(BARRIER, '')
+
+
+def best_substring_match(pattern: str, window: str, allowed_starts: Optional[Set[int]] = None,
+                         allowed_ends: Optional[Set[int]] = None) -> Tuple[int, int, int]:
+    """Smallest edit distance of ``pattern`` against any substring of ``window``
+
+    Returns (distance, start, end) of the best substring, preferring the
+    shortest one on ties. ``allowed_starts`` and ``allowed_ends`` limit
+    the substrings considered to those offsets; the distance is
+    ``len(pattern) + len(window) + 1`` when none qualifies.
+    """
+    columns = len(window) + 1
+    unreachable = len(pattern) + columns
+    # Row 0: empty pattern matches at any allowed start at zero cost
+    if allowed_starts is None:
+        costs = [0] * columns
+    else:
+        costs = [0 if j in allowed_starts else unreachable for j in range(columns)]
+    starts = list(range(columns))
+
+    for char in pattern:
+        new_costs = [costs[0] + 1] + [0] * (columns - 1)
+        new_starts = [0] * columns
+        for j in range(1, columns):
+            substitution = costs[j - 1] + (window[j - 1] != char)
+            deletion = costs[j] + 1
+            insertion = new_costs[j - 1] + 1
+            best = min(substitution, deletion, insertion)
+            new_costs[j] = best
+            if best == substitution:
+                new_starts[j] = starts[j - 1]
+            elif best == deletion:
+                new_starts[j] = starts[j]
+            else:
+                new_starts[j] = new_starts[j - 1]
+        costs, starts = new_costs, new_starts
+
+    ends = [j for j in range(columns) if allowed_ends is None or j in allowed_ends]
+    if not ends:
+        return unreachable, 0, 0
+    end = min(ends, key=lambda j: (costs[j], j - starts[j]))
+    return costs[end], starts[end], end
+
+
+class FuzzyBrandMatcher:
+    """Finds near-matches of brand terms within a bounded edit distance
+
+    Text is reduced to a skeleton (lowercase alphanumerics, OCR confusables
+    mapped, spaces and hyphenated line breaks removed) so that
+    "D E E P Robotics", "DeepRobotics" and "DEEP Rob0tics" all look alike.
+    Candidate positions come from a q-gram index of the terms, scanned by a
+    single lookahead pattern; only positions where enough q-grams line up
+    are verified with an edit-distance check, so cost follows the number of
+    candidates rather than text length times term count.
+
+    A hit must start and end on word boundaries, and its first and last
+    characters must be the term's, so words that merely contain or extend
+    a brand term ("sleep robotics", "deep robotic arm") are not hits.
+    """
+
+    def __init__(self, terms: Dict[str, str], max_distance: int = 2, qgram: int = 3,
+                 replace: bool = False):
+        """Build the q-gram index for the given term -> replacement mapping"""
+        self.max_distance = max_distance
+        self.qgram = qgram
+        self.replace_hits = replace
+
+        self.terms = []
+        self.replacements = []
+        self.skeletons = []
+        seen = set()
+        for term, replacement in terms.items():
+            skeleton = term_skeleton(term)
+            if len(skeleton) < qgram or skeleton in seen:
+                continue
+            seen.add(skeleton)
+            self.terms.append(term)
+            self.replacements.append(replacement)
+            self.skeletons.append(skeleton)
+
+        # q-gram -> [(term index, offset in term skeleton)]
+        self.index: Dict[str, List[Tuple[int, int]]] = {}
+        for term_index, skeleton in enumerate(self.skeletons):
+            for offset in range(len(skeleton) - qgram + 1):
+                self.index.setdefault(skeleton[offset:offset + qgram], []).append((term_index, offset))
+
+        grams = '|'.join(re.escape(gram) for gram in sorted(self.index))
+        self.anchor = re.compile(f'(?=({grams}))') if grams else None
+
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any],
+                    replacements: Optional[Dict[str, str]] = None) -> Optional['FuzzyBrandMatcher']:
+        """Create a matcher from the ``fuzzy_matching`` config section, None if disabled"""
+        if not settings.get('enabled', False):
+            return None
+
+        terms = settings.get('terms', {})
+        if isinstance(terms, list):
+            # Bare term list: take replacements from text_replacements
+            replacements = replacements or {}
+            terms = {term: replacements.get(term, '') for term in terms}
+
+        return cls(
+            terms,
+            max_distance=settings.get('max_distance', 2),
+            replace=settings.get('replace', False)
+        )
+
+    def _threshold(self, length: int) -> int:
+        """Shared q-grams required before a candidate is verified"""
+        return max(1, length - self.qgram + 1 - self.max_distance * self.qgram)
+
+    def find(self, text: str) -> List[Dict[str, Any]]:
+        """Return near-matches of the brand terms in ``text``"""
+        if self.anchor is None or not text:
+            return []
+
+        skeleton, skeleton_starts, original_starts = build_skeleton(text)
+        # Runs start and end words; a barrier run is followed by a new word
+        boundaries = set(skeleton_starts)
+        boundaries.add(len(skeleton))
+
+        # Candidate diagonals (skeleton position - offset in term) per term
+        diagonals: Dict[int, List[int]] = {}
+        for anchor in self.anchor.finditer(skeleton):
+            position = anchor.start()
+            for term_index, offset in self.index[anchor.group(1)]:
+                diagonals.setdefault(term_index, []).append(position - offset)
+
+        hits = []
+        for term_index, positions in diagonals.items():
+            for start, end in self._candidate_regions(term_index, sorted(positions)):
+                hit = self._verify(term_index, skeleton, start, end, boundaries)
+                if hit is None:
+                    continue
+                distance, skel_start, skel_end = hit
+                original_start = self._to_original(skel_start, skeleton_starts, original_starts)
+                original_end = self._to_original(skel_end - 1, skeleton_starts, original_starts) + 1
+                hits.append({
+                    'start': original_start,
+                    'end': original_end,
+                    'matched': text[original_start:original_end],
+                    'term': self.terms[term_index],
+                    'replacement': self.replacements[term_index],
+                    'distance': distance
+                })
+
+        hits.sort(key=lambda hit: (hit['start'], -(hit['end'] - hit['start'])))
+
+        # Keep the first of any overlapping hits
+        result = []
+        for hit in hits:
+            if not result or hit['start'] >= result[-1]['end']:
+                result.append(hit)
+        return result
+
+    def _candidate_regions(self, term_index: int, positions: List[int]) -> List[Tuple[int, int]]:
+        """Skeleton windows where enough q-grams of a term line up"""
+        length = len(self.skeletons[term_index])
+        threshold = self._threshold(length)
+        slack = self.max_distance
+        regions = []
+
+        # Group qualifying diagonal windows that overlap, so one occurrence
+        # gives one region while neighbouring occurrences stay separate
+        clusters = []
+        low = 0
+        for high in range(len(positions)):
+            while positions[high] - positions[low] > 2 * slack:
+                low += 1
+            if high - low + 1 >= threshold:
+                if clusters and positions[low] <= clusters[-1][1]:
+                    clusters[-1] = (clusters[-1][0], positions[high])
+                else:
+                    clusters.append((positions[low], positions[high]))
+
+        for first, last in clusters:
+            regions.append((max(0, first - slack), last + length + slack))
+        return regions
+
+    def _verify(self, term_index: int, skeleton: str, start: int, end: int,
+                boundaries: Set[int]) -> Optional[Tuple[int, int, int]]:
+        """Edit-distance check of a candidate window, returning skeleton offsets
+
+        Only substrings between word ``boundaries`` of the skeleton count.
+        """
+        window = skeleton[start:end]
+        edges = {boundary - start for boundary in boundaries if start <= boundary <= end}
+        term = self.skeletons[term_index]
+        distance, hit_start, hit_end = best_substring_match(term, window, edges, edges)
+        if distance > self.max_distance or hit_end <= hit_start:
+            return None
+        if BARRIER in window[hit_start:hit_end]:
+            return None
+        if window[hit_start] != term[0] or window[hit_end - 1] != term[-1]:
+            return None
+        return distance, start + hit_start, start + hit_end
+
+    @staticmethod
+    def _to_original(position: int, skeleton_starts: List[int], original_starts: List[int]) -> int:
+        """Map a skeleton offset back to an offset in the original text"""
+        run = bisect_right(skeleton_starts, position) - 1
+        return original_starts[run] + position - skeleton_starts[run]
+
+    def replace(self, text: str) -> Tuple[str, List[Dict[str, Any]]]:
+        """Return text with hits replaced (when enabled) and the hits found"""
+        hits = self.find(text)
+        if not self.replace_hits or not hits:
+            return text, hits
+
+        pieces = []
+        pos = 0
+        for hit in hits:
+            pieces.append(text[pos:hit['start']])
+            pieces.append(hit['replacement'])
+            pos = hit['end']
+        pieces.append(text[pos:])
+        return ''.join(pieces), hits
@@ -0,0 +1,122 @@
+"""
+Link Validation Module - Checks that replacements leave URLs and emails intact
+"""
+
+import re
+import logging
+from bisect import bisect_left
+from typing import Dict, List, Tuple, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+URL_PATTERN = re.compile(r'https?://[^\s]+')
+EMAIL_PATTERN = re.compile(r'[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}')
+
+LINK_PATTERNS = {
+    'url': URL_PATTERN,
+    'email': EMAIL_PATTERN
+}
+
+
+def index_links(text: str) -> List[Tuple[int, int, str, str]]:
+    """(start, end, kind, text) of every URL and email in ``text``, sorted by start
+
+    Built once per page at extraction time so validation never has to
+    rescan the page.
+    """
+    links = []
+    for kind, pattern in LINK_PATTERNS.items():
+        for match in pattern.finditer(text):
+            links.append((match.start(), match.end(), kind, match.group()))
+    links.sort()
+    return links
+
+
+class LinkValidator:
+    """Validates links against the edits the replacer actually applied
+
+    Pages carry a link index (``links``, from index_links) and the edit log
+    of the replacement pass (``edits``, sorted (start, end, replacement,
+    rule) against the original page text). Only links overlapping an edit
+    are looked at, so the cost follows the number of edits, not text size.
+    """
+
+    def __init__(self, validate_urls: bool = True, validate_emails: bool = True):
+        """Initialize with the link kinds to check"""
+        self.kinds = set()
+        if validate_urls:
+            self.kinds.add('url')
+        if validate_emails:
+            self.kinds.add('email')
+
+    @classmethod
+    def from_config(cls, quality: Dict[str, Any]) -> Optional['LinkValidator']:
+        """Create a validator from the ``quality_control`` config section, None if off"""
+        validator = cls(
+            validate_urls=quality.get('validate_urls', False),
+            validate_emails=quality.get('validate_emails', False)
+        )
+        return validator if validator.kinds else None
+
+    def check_page(self, links: List[Tuple[int, int, str, str]],
+                   edits: List[Tuple[int, int, str, int]]) -> List[Dict[str, Any]]:
+        """Return the links of one page broken by its edits"""
+        if not links or not edits:
+            return []
+
+        edit_starts = [edit[0] for edit in edits]
+        edit_ends = [edit[1] for edit in edits]
+        broken = []
+
+        for start, end, kind, text in links:
+            if kind not in self.kinds:
+                continue
+
+            # Edits are sorted and disjoint, so their ends are sorted too
+            first = bisect_left(edit_ends, start + 1)
+            if first == len(edits) or edit_starts[first] >= end:
+                continue
+
+            pieces = []
+            pos = start
+            straddles = False
+            k = first
+            while k < len(edits) and edit_starts[k] < end:
+                edit_start, edit_end, replacement = edits[k][:3]
+                if edit_start < start or edit_end > end:
+                    straddles = True
+                pieces.append(text[pos - start:max(edit_start, start) - start])
+                pieces.append(replacement)
+                pos = min(edit_end, end)
+                k += 1
+            pieces.append(text[pos - start:])
+            modified = ''.join(pieces)
+
+            if straddles or not LINK_PATTERNS[kind].fullmatch(modified):
+                broken.append({
+                    'kind': kind,
+                    'original': text,
+                    'modified': modified,
+                    'start': start,
+                    'end': end
+                })
+
+        return broken
+
+    def validate(self, pdf_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Check every page that has a link index and an edit log"""
+        broken = []
+
+        for page_index, page_data in enumerate(pdf_data.get('pages', [])):
+            page_number = page_data.get('number', page_index + 1)
+            edits = page_data.get('edits')
+            if not edits:
+                continue  # Also avoids extracting links of untouched lazy pages
+            for link in self.check_page(page_data.get('links', []), edits):
+                link['page'] = page_number
+                logger.warning(f"Potentially broken {link['kind']} on page {page_number}: "
+                               f"{link['original']} -> {link['modified']}")
+                broken.append(link)
+
+        pdf_data['broken_links'] = broken
+        return broken
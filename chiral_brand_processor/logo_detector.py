@@ -0,0 +1,430 @@
+"""
+Logo Detection Module - Recognises known logos by perceptual hash and template
+"""
+
+import io
+import os
+import json
+import base64
+import hashlib
+import logging
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Tuple, Any, Optional, Callable
+
+import numpy as np
+import fitz  # PyMuPDF
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Shipped with the package: the old logo variants of the supplier datasheets
+DEFAULT_INDEX_PATH = Path(__file__).resolve().parent / "logo_index.json"
+
+# Side of the grayscale thumbnail the hash is computed from
+HASH_SIZE = 32
+
+# Low-frequency DCT block kept for the 64-bit hash
+HASH_BLOCK = 8
+
+# Images smaller than this (pixels per side) carry too little to classify
+MIN_IMAGE_SIDE = 16
+
+# Height templates are stored at; the scales below are relative to it
+TEMPLATE_HEIGHT = 32
+
+# Template heights tried against a band, as fractions of TEMPLATE_HEIGHT
+DEFAULT_SCALES = (0.375, 0.5, 0.75, 1.0)
+
+# Pixels at or above this gray level count as paper when cropping templates
+PAPER_LEVEL = 245
+
+# Template matches kept per template scale and band
+MAX_MATCHES = 4
+
+# Logo files that are rendered rather than decoded
+VECTOR_SUFFIXES = ('.svg', '.pdf')
+
+
+def _dct_matrix(size: int) -> np.ndarray:
+    """Orthonormal DCT-II basis, so a 2D DCT is two matrix products"""
+    n = np.arange(size)
+    matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * size))
+    matrix[0] /= np.sqrt(2)
+    return matrix * np.sqrt(2 / size)
+
+
+DCT = _dct_matrix(HASH_SIZE)
+
+
+def _paper(gray: np.ndarray, alpha: np.ndarray) -> float:
+    """Gray level that transparent areas are filled with
+
+    Transparent areas count as white paper, except behind light ink (a
+    white logo made for dark backgrounds), which would vanish on white.
+    """
+    coverage = alpha.sum()
+    if coverage and (gray * alpha).sum() / coverage > 127.5:
+        return 0.0
+    return 255.0
+
+
+def _flatten(image: Image.Image) -> Image.Image:
+    """Composite a transparent image onto its paper (see _paper) as grayscale"""
+    pixels = np.asarray(image.convert('LA'), dtype=np.float64)
+    gray, alpha = pixels[..., 0], pixels[..., 1] / 255.0
+    flat = gray * alpha + _paper(gray, alpha) * (1.0 - alpha)
+    return Image.fromarray(np.round(flat).astype(np.uint8), 'L')
+
+
+def _thumbnail(data: bytes, mode: str = 'L') -> Optional[Image.Image]:
+    """Reduced-resolution decode of an image stream, None if PIL cannot read it"""
+    try:
+        image = Image.open(io.BytesIO(data))
+        # JPEG decodes at 1/2, 1/4 or 1/8 scale in draft mode
+        image.draft(mode, (HASH_SIZE * 2, HASH_SIZE * 2))
+        if min(image.size) < MIN_IMAGE_SIDE:
+            return None
+        if image.mode in ('RGBA', 'LA', 'P'):
+            image = _flatten(image.convert('RGBA'))
+        return image.convert(mode).resize((HASH_SIZE, HASH_SIZE), Image.Resampling.BILINEAR)
+    except Exception as e:
+        logger.debug(f"Cannot decode image for hashing: {e}")
+        return None
+
+
+def perceptual_hash(data: bytes, mask: Optional[bytes] = None) -> Optional[int]:
+    """64-bit DCT hash of an image stream, optionally composited with its soft mask"""
+    image = _thumbnail(data)
+    if image is None:
+        return None
+
+    pixels = np.asarray(image, dtype=np.float64)
+    if mask is not None:
+        alpha = _thumbnail(mask)
+        if alpha is not None:
+            alpha = np.asarray(alpha, dtype=np.float64) / 255.0
+            pixels = pixels * alpha + _paper(pixels, alpha) * (1.0 - alpha)
+
+    coefficients = (DCT @ pixels @ DCT.T)[:HASH_BLOCK, :HASH_BLOCK].ravel()
+    # The DC term only encodes brightness; compare the rest against their median
+    bits = coefficients > np.median(coefficients[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Number of differing bits between two hashes"""
+    return bin(a ^ b).count('1')
+
+
+def load_logo_file(path: Path, dpi: int = 144) -> bytes:
+    """Image bytes of a logo file, rendering SVG and PDF logos to PNG"""
+    path = Path(path)
+    if path.suffix.lower() not in VECTOR_SUFFIXES:
+        return path.read_bytes()
+    with fitz.open(str(path)) as doc:
+        return doc[0].get_pixmap(dpi=dpi, alpha=False).tobytes("png")
+
+
+def make_template(data: bytes) -> Optional[np.ndarray]:
+    """Grayscale template of a logo image, cropped to its ink and TEMPLATE_HEIGHT tall"""
+    try:
+        image = Image.open(io.BytesIO(data)).convert('RGBA')
+    except Exception as e:
+        logger.debug(f"Cannot decode logo for template: {e}")
+        return None
+    flat = _flatten(image)
+    pixels = np.asarray(flat)
+
+    # Ink is whatever stands out from the paper, dark or light
+    paper = 255 if pixels.mean() >= 127.5 else 0
+    ink = np.abs(pixels.astype(np.int16) - paper) > 255 - PAPER_LEVEL
+    rows = np.flatnonzero(ink.any(axis=1))
+    columns = np.flatnonzero(ink.any(axis=0))
+    if not len(rows):
+        return None
+    cropped = pixels[rows[0]:rows[-1] + 1, columns[0]:columns[-1] + 1]
+    width = max(1, round(cropped.shape[1] * TEMPLATE_HEIGHT / cropped.shape[0]))
+    resized = Image.fromarray(cropped).resize((width, TEMPLATE_HEIGHT), Image.Resampling.LANCZOS)
+    return np.asarray(resized, dtype=np.uint8)
+
+
+def normalized_cross_correlation(image: np.ndarray, template: np.ndarray) -> np.ndarray:
+    """NCC score of ``template`` at every position it fits inside ``image``
+
+    The correlation is computed with FFTs and the window statistics with
+    integral images, so cost does not grow with template size.
+    """
+    image = image.astype(np.float64)
+    template = template.astype(np.float64)
+    th, tw = template.shape
+    height, width = image.shape
+    count = th * tw
+
+    centered = template - template.mean()
+    template_norm = np.sqrt((centered * centered).sum())
+    if template_norm == 0:
+        return np.zeros((height - th + 1, width - tw + 1))
+
+    # Correlation with the zero-mean template equals correlation with the
+    # zero-mean window, since the template sums to zero
+    shape = (height + th - 1, width + tw - 1)
+    spectrum = np.fft.rfft2(image, shape) * np.fft.rfft2(centered[::-1, ::-1], shape)
+    numerator = np.fft.irfft2(spectrum, shape)[th - 1:height, tw - 1:width]
+
+    integral = np.pad(image, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+    squares = np.pad(image * image, ((1, 0), (1, 0))).cumsum(0).cumsum(1)
+
+    def window_sums(table):
+        return table[th:, tw:] - table[:-th, tw:] - table[th:, :-tw] + table[:-th, :-tw]
+
+    sums = window_sums(integral)
+    variance = np.maximum(window_sums(squares) - sums * sums / count, 0)
+    denominator = np.sqrt(variance) * template_norm
+    # Flat windows (blank paper) cannot match anything
+    return np.where(denominator > 1e-6 * count, numerator / np.maximum(denominator, 1e-12), 0.0)
+
+
+class LogoDetector:
+    """Classifies images against an index of known logo hashes
+
+    The index is a small JSON file of labelled 64-bit perceptual hashes.
+    Classification results are cached by the digest of the image stream,
+    so a logo repeated across pages and documents is only decoded once
+    per batch.
+
+    Logos drawn as vector graphics are found by rendering the header and
+    footer bands of a page at low resolution and matching them against
+    grayscale templates of the same logos. Band results are cached by the
+    digest of the rendered pixels, so a header repeated on every page is
+    only matched once.
+    """
+
+    def __init__(self, index_path: Optional[Path] = None, max_distance: int = 10,
+                 match_threshold: float = 0.8, band: float = 0.15, render_dpi: int = 36,
+                 scales: Tuple[float, ...] = DEFAULT_SCALES):
+        """Load the index from ``index_path`` if it exists"""
+        self.index_path = Path(index_path) if index_path is not None else DEFAULT_INDEX_PATH
+        self.max_distance = max_distance
+        self.match_threshold = match_threshold
+        self.band = band
+        self.render_dpi = render_dpi
+        self.scales = tuple(scales)
+        self.entries: List[Dict[str, Any]] = []
+        self.templates: List[Dict[str, Any]] = []
+        self._results: Dict[str, Optional[Dict[str, Any]]] = {}
+        self._band_results: Dict[str, List[Tuple[str, float, int, int, int, int]]] = {}
+        self.lookups = 0
+        self.decodes = 0
+        self.band_renders = 0
+        self.vector_hits = 0
+        self._load()
+
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any], base_dir: Optional[Path] = None) -> 'LogoDetector':
+        """Create a detector from the ``logo_detection`` config section
+
+        A relative ``index_path`` is resolved against ``base_dir`` (the
+        directory of the config file), not the working directory.
+        """
+        index_path = Path(settings.get('index_path', DEFAULT_INDEX_PATH))
+        if not index_path.is_absolute() and base_dir is not None:
+            index_path = Path(base_dir) / index_path
+        return cls(
+            index_path,
+            settings.get('max_distance', 10),
+            match_threshold=settings.get('match_threshold', 0.8),
+            band=settings.get('band', 0.15),
+            render_dpi=settings.get('render_dpi', 36),
+            scales=settings.get('scales', DEFAULT_SCALES)
+        )
+
+    def _load(self):
+        """Read the on-disk index"""
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.entries = [
+                {'label': entry['label'], 'hash': int(entry['hash'], 16)}
+                for entry in data.get('logos', [])
+            ]
+            self.templates = [
+                {
+                    'label': entry['label'],
+                    'pixels': np.frombuffer(base64.b64decode(entry['pixels']), dtype=np.uint8)
+                    .reshape(entry['height'], entry['width'])
+                }
+                for entry in data.get('templates', [])
+            ]
+        except FileNotFoundError:
+            logger.warning(f"Logo index {self.index_path} not found; images at the top of "
+                           f"each page are treated as logos until variants are added with index-logo")
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Ignoring unreadable logo index {self.index_path}: {e}")
+
+    def save(self):
+        """Write the index atomically"""
+        data = {
+            'logos': [
+                {'label': entry['label'], 'hash': f"{entry['hash']:016x}"}
+                for entry in self.entries
+            ],
+            'templates': [
+                {
+                    'label': template['label'],
+                    'width': template['pixels'].shape[1],
+                    'height': template['pixels'].shape[0],
+                    'pixels': base64.b64encode(template['pixels'].tobytes()).decode('ascii')
+                }
+                for template in self.templates
+            ]
+        }
+        directory = self.index_path.parent
+        directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(directory), suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def add(self, data: bytes, label: str, mask: Optional[bytes] = None) -> int:
+        """Add a logo variant to the index (call save() to persist it)
+
+        The variant is stored both as a hash, for embedded images, and as a
+        template, for logos drawn as vector graphics.
+        """
+        logo_hash = perceptual_hash(data, mask)
+        if logo_hash is None:
+            raise ValueError(f"Cannot hash logo image for '{label}'")
+        self.entries.append({'label': label, 'hash': logo_hash})
+        template = make_template(data)
+        if template is not None:
+            self.templates.append({'label': label, 'pixels': template})
+        self._results.clear()
+        self._band_results.clear()
+        return logo_hash
+
+    @property
+    def empty(self) -> bool:
+        """True when there are no known logos to compare against"""
+        return not self.entries
+
+    def classify(self, data: bytes, mask: Optional[bytes] = None,
+                 fallback: Optional[Callable[[], bytes]] = None) -> Optional[Dict[str, Any]]:
+        """Closest known logo within ``max_distance`` as {'label', 'distance'}, or None
+
+        ``fallback`` returns a decodable rendition (e.g. PNG) for streams
+        PIL cannot read itself, such as JBIG2 or unusual colour spaces.
+        """
+        self.lookups += 1
+        digest = hashlib.sha1(data)
+        if mask is not None:
+            digest.update(mask)
+        key = digest.hexdigest()
+        if key in self._results:
+            return self._results[key]
+
+        self.decodes += 1
+        result = None
+        image_hash = perceptual_hash(data, mask)
+        if image_hash is None and fallback is not None:
+            image_hash = perceptual_hash(fallback())
+        if image_hash is not None and self.entries:
+            best = min(self.entries, key=lambda entry: hamming_distance(entry['hash'], image_hash))
+            distance = hamming_distance(best['hash'], image_hash)
+            if distance <= self.max_distance:
+                result = {'label': best['label'], 'distance': distance}
+
+        self._results[key] = result
+        return result
+
+    def find_vector_logos(self, page: 'fitz.Page') -> List[Dict[str, Any]]:
+        """Vector-drawn logos in the header and footer bands of ``page``
+
+        Returns {'label', 'score', 'rect', 'drawings'} per logo, where
+        ``rect`` covers the matched drawings (indices into get_drawings()).
+        Matches that cover no drawing, such as embedded images, are dropped.
+        """
+        if not self.templates:
+            return []
+
+        area = page.rect
+        band = area.height * self.band
+        clips = (fitz.Rect(area.x0, area.y0, area.x1, area.y0 + band),
+                 fitz.Rect(area.x0, area.y1 - band, area.x1, area.y1))
+        zoom = self.render_dpi / 72
+        drawings = None
+        hits = []
+
+        for clip in clips:
+            pix = page.get_pixmap(dpi=self.render_dpi, clip=clip, colorspace=fitz.csGRAY, alpha=False)
+            key = hashlib.sha1(pix.samples).hexdigest() + f":{pix.width}x{pix.height}"
+            if key not in self._band_results:
+                self.band_renders += 1
+                pixels = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)
+                self._band_results[key] = self._match_band(pixels[:, :pix.width])
+
+            for label, score, x, y, width, height in self._band_results[key]:
+                if drawings is None:
+                    drawings = page.get_drawings()
+                # One render pixel of slack around the matched window
+                window = fitz.Rect(clip.x0 + (x - 1) / zoom, clip.y0 + (y - 1) / zoom,
+                                   clip.x0 + (x + width + 1) / zoom, clip.y0 + (y + height + 1) / zoom)
+                indices = [i for i, drawing in enumerate(drawings)
+                           if not drawing['rect'].is_empty and window.contains(drawing['rect'])]
+                if not indices:
+                    continue
+                rect = fitz.Rect(drawings[indices[0]]['rect'])
+                for i in indices[1:]:
+                    rect |= drawings[i]['rect']
+                hits.append({'label': label, 'score': score, 'rect': tuple(rect), 'drawings': indices})
+
+        self.vector_hits += len(hits)
+        return hits
+
+    def _match_band(self, pixels: np.ndarray) -> List[Tuple[str, float, int, int, int, int]]:
+        """Template matches in a rendered band as (label, score, x, y, width, height)"""
+        if pixels.size == 0 or pixels.min() >= PAPER_LEVEL:
+            return []  # Nothing drawn
+
+        candidates = []
+        for template in self.templates:
+            for scale in self.scales:
+                height = round(TEMPLATE_HEIGHT * scale)
+                width = round(template['pixels'].shape[1] * scale)
+                if min(height, width) < MIN_IMAGE_SIDE // 2:
+                    continue
+                if height > pixels.shape[0] or width > pixels.shape[1]:
+                    continue
+                scaled = np.asarray(Image.fromarray(template['pixels']).resize(
+                    (width, height), Image.Resampling.BILINEAR))
+                scores = normalized_cross_correlation(pixels, scaled)
+                for _ in range(MAX_MATCHES):
+                    y, x = np.unravel_index(np.argmax(scores), scores.shape)
+                    score = float(scores[y, x])
+                    if score < self.match_threshold:
+                        break
+                    candidates.append((template['label'], score, int(x), int(y), width, height))
+                    # Suppress the neighbourhood of this peak
+                    scores[max(0, y - height + 1):y + height, max(0, x - width + 1):x + width] = -1
+
+        # Best match wins where templates or scales overlap
+        candidates.sort(key=lambda c: -c[1])
+        matches = []
+        for candidate in candidates:
+            _, _, x, y, width, height = candidate
+            if all(x >= mx + mw or mx >= x + width or y >= my + mh or my >= y + height
+                   for _, _, mx, my, mw, mh in matches):
+                matches.append(candidate)
+        return matches
+
+    def info(self) -> Dict[str, int]:
+        """Counters for the processing report"""
+        return {
+            'known_logos': len(self.entries),
+            'templates': len(self.templates),
+            'lookups': self.lookups,
+            'decodes': self.decodes,
+            'cached': len(self._results),
+            'band_renders': self.band_renders,
+            'vector_hits': self.vector_hits
+        }
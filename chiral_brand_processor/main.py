@@ -16,9 +16,15 @@ from tqdm import tqdm
 import colorama
 from colorama import Fore, Style
 
-from pdf_processor import PDFProcessor
-from text_replacer import TextReplacer
+from pdf_processor import PDFProcessor, PagePool, COMPRESSION_DRAFT
+from text_replacer import TextReplacer, ReplacementStats
+from rule_cache import load_rule_set
+from fuzzy_matcher import FuzzyBrandMatcher
+from link_validator import LinkValidator
+from logo_detector import LogoDetector, load_logo_file
+from pdf_optimizer import PDFOptimizer, CATEGORIES
 from logo_generator import LogoGenerator
+from watermark import Watermark
 
 colorama.init(autoreset=True)
 
@@ -29,9 +35,45 @@ class ChiralBrandProcessor:
         """Initialize the brand processor"""
         self.config = self.load_config(config_path)
         self.setup_logging()
-        self.pdf_processor = PDFProcessor()
-        self.text_replacer = TextReplacer(self.config['text_replacements'])
+        self.pdf_processor = PDFProcessor.from_config(self.config.get('processing', {}))
+        self.rule_set = load_rule_set(self.config)
+        self.text_replacer = TextReplacer(
+            self.rule_set.rules,
+            rule_set=self.rule_set,
+            cache_size=self.config.get('processing', {}).get('span_cache_size', 4096),
+            fuzzy_matcher=FuzzyBrandMatcher.from_config(
+                self.config.get('fuzzy_matching', {}), self.rule_set.rules
+            )
+        )
         self.logo_generator = LogoGenerator(self.config['logo_settings'])
+        self.link_validator = LinkValidator.from_config(self.config.get('quality_control', {}))
+        self.logo_detector = LogoDetector.from_config(
+            self.config.get('logo_detection', {}), Path(config_path).resolve().parent
+        )
+        
+        # Worker processes for the pages of large documents, None when serial
+        self.page_pool = PagePool.from_config(self.text_replacer, self.config.get('processing', {}))
+        
+        # Output size optimizer, None when processing.optimize is off
+        self.optimizer = PDFOptimizer.from_config(self.config.get('processing', {}))
+        
+        # Watermark stamped while saving, None when watermark.enabled is off
+        self.watermark = Watermark.from_config(self.config.get('watermark', {}))
+        
+        # Rule hit counts merged across every processed document
+        self.corpus_stats = ReplacementStats(self.text_replacer.matcher.keys)
+        
+        # Near-matches of brand terms, tagged with the document they came from
+        self.fuzzy_hits: List[Dict] = []
+        
+        # URLs and emails altered into an invalid form, per document
+        self.broken_links: List[Dict] = []
+        
+        # Per-document page triage results
+        self.triage_results: Dict[str, Dict] = {}
+        
+        # Per-document output size reports of the optimizer
+        self.optimization_results: Dict[str, Dict] = {}
         
     def load_config(self, config_path: str) -> Dict:
         """Load configuration from JSON file"""
@@ -79,7 +121,12 @@ class ChiralBrandProcessor:
                 "preserve_layout": True,
                 "quality": "high",
                 "compression": "standard",
-                "backup_original": True
+                "dpi": 300,
+                "optimize": True,
+                "backup_original": False
+            },
+            "advanced_features": {
+                "rollback_capability": True
             }
         }
         
@@ -106,27 +153,71 @@ class ChiralBrandProcessor:
     
     def process_single_pdf(self, input_path: Path, output_path: Path) -> bool:
         """Process a single PDF file"""
+        pdf_content = None
         try:
             self.logger.info(f"Processing: {input_path.name}")
             
             # Load PDF
             pdf_content = self.pdf_processor.load_pdf(input_path)
             
-            # Replace text content
-            modified_content = self.text_replacer.replace_all(pdf_content)
+            processing = self.config.get('processing', {})
+            parallel = (self.page_pool is not None and
+                        pdf_content['page_count'] >= processing.get('parallel_min_pages', 64))
+            
+            if parallel:
+                # Triage and replace text with the pages spread over worker processes
+                modified_content = self.pdf_processor.replace_text_parallel(pdf_content, self.page_pool)
+                if 'triage' in modified_content:
+                    self.triage_results[input_path.name] = modified_content['triage']
+            else:
+                # Pages without text hits skip the text stages; logos are still replaced
+                if processing.get('triage', True):
+                    self.triage_results[input_path.name] = self.pdf_processor.triage(
+                        pdf_content, self.text_replacer.has_hits
+                    )
+                
+                # Replace text content
+                modified_content = self.text_replacer.replace_all(pdf_content)
+            self.corpus_stats.merge(modified_content['replacement_stats'])
+            for hit in modified_content.get('fuzzy_hits', []):
+                self.fuzzy_hits.append(dict(hit, document=input_path.name))
+            
+            # Check only the links the replacement edits touched
+            if self.link_validator is not None:
+                for link in self.link_validator.validate(modified_content):
+                    self.broken_links.append(dict(link, document=input_path.name))
             
             # Generate and replace logo
             logo_path = self.logo_generator.generate_logo()
             modified_content = self.pdf_processor.replace_logo(
                 modified_content, 
-                logo_path
+                logo_path,
+                self.logo_detector
             )
             
-            # Update product naming
-            modified_content = self.update_product_naming(modified_content)
-            
             # Save modified PDF
-            self.pdf_processor.save_pdf(modified_content, output_path)
+            if self.optimizer is None:
+                self.pdf_processor.save_pdf(modified_content, output_path, self.watermark)
+            else:
+                # Shrink the output for sending: images, fonts and file structure.
+                # The optimizer writes the output itself, so the edits are only
+                # saved as a quick draft for it to read
+                draft_path = output_path.with_suffix('.draft.pdf')
+                try:
+                    self.pdf_processor.save_pdf(modified_content, draft_path, self.watermark,
+                                                compression=COMPRESSION_DRAFT)
+                    self.optimization_results[input_path.name] = self.optimizer.optimize(
+                        draft_path, output_path
+                    )
+                finally:
+                    if draft_path.exists():
+                        draft_path.unlink()
+            
+            # The edit log replaces a full backup copy of the original
+            if self.config.get('advanced_features', {}).get('rollback_capability', False):
+                edit_log_path = output_path.with_suffix('.edits.json')
+                modified_content['edit_script'].save(edit_log_path)
+                self.logger.info(f"Edit log saved to: {edit_log_path.name}")
             
             self.logger.info(f"Successfully processed: {output_path.name}")
             return True
@@ -134,20 +225,15 @@ class ChiralBrandProcessor:
         except Exception as e:
             self.logger.error(f"Error processing {input_path.name}: {str(e)}")
             return False
+        
+        finally:
+            if pdf_content is not None:
+                self.pdf_processor.close_pdf(pdf_content)
     
     def update_product_naming(self, content: Dict) -> Dict:
         """Update product naming according to configuration"""
-        naming_config = self.config.get('product_naming', {})
-        
-        # Remove old prefixes
-        for prefix in naming_config.get('remove_prefix', []):
-            content = self.text_replacer.remove_prefix(content, prefix)
-        
-        # Add new prefix
-        new_prefix = naming_config.get('add_prefix', 'Chiral')
-        content = self.text_replacer.add_product_prefix(content, new_prefix)
-        
-        return content
+        # Old prefixes are removed and the new one added in a single pass
+        return self.text_replacer.rename_products(content)
     
     def process_batch(self, input_dir: str = "input", output_dir: str = "output"):
         """Process all PDF files in the input directory"""
@@ -196,6 +282,51 @@ class ChiralBrandProcessor:
         
         # Generate report
         self.generate_report(pdf_files, success_count, failed_files)
+        self.close()
+    
+    def close(self):
+        """Stop the page and image worker processes, if any were started"""
+        if self.page_pool is not None:
+            self.page_pool.close()
+        if self.optimizer is not None:
+            self.optimizer.close()
+    
+    def merge_catalog(self, output_dir: str, catalog_path: str) -> bool:
+        """Merge the processed PDFs in ``output_dir`` into one catalog"""
+        catalog = Path(catalog_path)
+        pdf_files = sorted(path for path in Path(output_dir).glob("*.pdf")
+                           if path.resolve() != catalog.resolve())
+        
+        if not pdf_files:
+            print(f"{Fore.YELLOW}No PDF files found in {output_dir}")
+            return False
+        
+        # Outline entries are named after the product, not the old metadata title
+        naming = self.config.get('output_naming', {})
+        titles = []
+        for path in pdf_files:
+            title = path.stem
+            if naming.get('prefix') and title.startswith(naming['prefix']):
+                title = title[len(naming['prefix']):]
+            if naming.get('suffix') and title.endswith(naming['suffix']):
+                title = title[:-len(naming['suffix'])]
+            titles.append(title.replace('_', ' ').strip() or path.stem)
+        
+        try:
+            catalog.parent.mkdir(parents=True, exist_ok=True)
+            result = self.pdf_processor.merge_pdfs(
+                pdf_files, catalog,
+                toc=self.config.get('catalog', {}).get('toc', True),
+                titles=titles
+            )
+        except Exception as e:
+            self.logger.error(f"Error merging catalog: {str(e)}")
+            return False
+        
+        print(f"{Fore.GREEN}Merged {len(pdf_files)} files ({result['pages']} pages) into {catalog}")
+        print(f"  {result['shared_streams']} duplicate streams shared "
+              f"({result['shared_bytes']} bytes), {result['size']} bytes written")
+        return True
     
     def generate_output_filename(self, original_name: str) -> str:
         """Generate output filename based on configuration"""
@@ -209,8 +340,7 @@ class ChiralBrandProcessor:
         suffix = naming.get('suffix', '')
         
         # Clean up product names
-        for old_prefix in self.config['product_naming'].get('remove_prefix', []):
-            base_name = base_name.replace(old_prefix, '')
+        base_name = self.text_replacer.product_namer.strip_prefixes(base_name)
         
         # Build new filename
         new_name = f"{prefix}{base_name.strip()}{suffix}.pdf"
@@ -237,6 +367,71 @@ class ChiralBrandProcessor:
                 status = "✓" if file.name not in failed else "✗"
                 f.write(f"{status} {file.name}\n")
             
+            f.write("\nRule Hits (all documents):\n")
+            f.write("-" * 40 + "\n")
+            for rule, count in self.corpus_stats.as_dict(include_zero=True).items():
+                f.write(f"{count:>8}  {rule}\n")
+            f.write(f"{self.corpus_stats.total:>8}  total\n")
+            
+            if self.triage_results:
+                pages = sum(t['pages'] for t in self.triage_results.values())
+                hit_pages = sum(len(t['hit_pages']) for t in self.triage_results.values())
+                f.write(f"\nPage Triage ({hit_pages}/{pages} pages with hits):\n")
+                f.write("-" * 40 + "\n")
+                for name, triage in self.triage_results.items():
+                    f.write(f"{name}: {len(triage['hit_pages'])}/{triage['pages']} pages "
+                            f"with hits, {triage['pass_through']} passed through\n")
+            
+            cache = self.text_replacer.cache_info()
+            lookups = cache['hits'] + cache['misses']
+            hit_rate = cache['hits'] / lookups * 100 if lookups else 0.0
+            f.write("\nSpan Cache:\n")
+            f.write("-" * 40 + "\n")
+            f.write(f"Hits: {cache['hits']} ({hit_rate:.1f}%)\n")
+            f.write(f"Misses: {cache['misses']}\n")
+            f.write(f"Evictions: {cache['evictions']}\n")
+            f.write(f"Entries: {cache['size']}/{cache['max_size']}\n")
+            
+            if not self.logo_detector.empty:
+                detector = self.logo_detector.info()
+                f.write(f"\nLogo Detection ({detector['known_logos']} known logos):\n")
+                f.write("-" * 40 + "\n")
+                f.write(f"Images classified: {detector['lookups']}\n")
+                f.write(f"Distinct images decoded: {detector['decodes']}\n")
+                f.write(f"Vector logos found: {detector['vector_hits']}\n")
+                f.write(f"Distinct page bands matched: {detector['band_renders']}\n")
+            else:
+                f.write("\nLogo Detection: no known logos, images in the top 150 pt replaced\n")
+            
+            if self.optimization_results:
+                results = self.optimization_results.values()
+                original = sum(r['original_size'] for r in results)
+                optimized = sum(r['optimized_size'] for r in results)
+                f.write(f"\nSize Optimization ({original - optimized} bytes saved):\n")
+                f.write("-" * 40 + "\n")
+                for category in CATEGORIES:
+                    f.write(f"{sum(r['saved'][category] for r in results):>12}  {category}\n")
+                for name, result in self.optimization_results.items():
+                    images = result['images']
+                    f.write(f"{name}: {result['original_size']} -> {result['optimized_size']} bytes, "
+                            f"{images['downsampled']} images downsampled, {images['jpeg']} JPEG, "
+                            f"{images['palette']} palette, {images['flate']} deflate\n")
+            
+            if self.link_validator is not None:
+                f.write(f"\nLink Validation ({len(self.broken_links)} potentially broken):\n")
+                f.write("-" * 40 + "\n")
+                for link in self.broken_links:
+                    f.write(f"{link['document']} p.{link['page']}: {link['original']} "
+                            f"-> {link['modified']}\n")
+            
+            if self.text_replacer.fuzzy_matcher is not None:
+                action = "replaced" if self.text_replacer.fuzzy_matcher.replace_hits else "flagged"
+                f.write(f"\nFuzzy Brand Matches ({len(self.fuzzy_hits)} {action}):\n")
+                f.write("-" * 40 + "\n")
+                for hit in self.fuzzy_hits:
+                    f.write(f"{hit['document']} p.{hit['page']}: '{hit['matched']}' "
+                            f"~ {hit['term']} (distance {hit['distance']})\n")
+            
             f.write("\n" + "=" * 60 + "\n")
             f.write("Configuration Used:\n")
             f.write("-" * 40 + "\n")
@@ -244,25 +439,45 @@ class ChiralBrandProcessor:
         
         print(f"{Fore.CYAN}Report saved to: {report_path}")
     
-    def preview_replacements(self, pdf_path: str):
+    def preview_replacements(self, pdf_path: str, limit: Optional[int] = None):
         """Preview text replacements for a PDF file"""
         print(f"\n{Fore.CYAN}Preview mode for: {pdf_path}")
         print("=" * 60)
         
-        # Load and analyze PDF
+        # Load and analyze PDF, printing hits as they are found
         pdf_content = self.pdf_processor.load_pdf(Path(pdf_path))
-        replacements = self.text_replacer.find_replacements(pdf_content)
-        
-        if replacements:
-            print(f"{Fore.GREEN}Found {len(replacements)} potential replacements:\n")
-            for old, new, context in replacements:
-                print(f"  {Fore.YELLOW}{old} → {Fore.GREEN}{new}")
-                print(f"  Context: ...{context}...")
-                print()
+        found = 0
+        
+        for hit in self.text_replacer.iter_replacements(pdf_content, limit):
+            found += 1
+            location = f"page {hit['page']}"
+            if hit['bbox']:
+                location += " at ({:.0f}, {:.0f})".format(*hit['bbox'][:2])
+            print(f"  {Fore.YELLOW}{hit['matched']} → {Fore.GREEN}{hit['replacement']}"
+                  f"{Style.RESET_ALL} ({location})")
+            print(f"  Context: ...{hit['context']}...")
+            print()
+        
+        self.pdf_processor.close_pdf(pdf_content)
+        
+        if found:
+            suffix = f" (stopped after first {limit})" if limit is not None and found >= limit else ""
+            print(f"{Fore.GREEN}Found {found} potential replacements{suffix}")
         else:
             print(f"{Fore.YELLOW}No replacements found")
         
         print("=" * 60)
+    
+    def index_logo(self, image_path: str, label: Optional[str] = None):
+        """Add a known logo variant (PNG, JPEG, SVG or PDF) to the logo detection index"""
+        image_path = Path(image_path)
+        label = label or image_path.stem
+        
+        logo_hash = self.logo_detector.add(load_logo_file(image_path), label)
+        self.logo_detector.save()
+        
+        print(f"{Fore.GREEN}Indexed logo '{label}' ({logo_hash:016x}) "
+              f"in {self.logo_detector.index_path}")
 
 def main():
     """Main entry point"""
@@ -273,7 +488,7 @@ def main():
     
     parser.add_argument(
         'command',
-        choices=['process', 'preview', 'single'],
+        choices=['process', 'preview', 'single', 'index-logo', 'merge'],
         help='Command to execute'
     )
     
@@ -291,7 +506,12 @@ def main():
     
     parser.add_argument(
         '--file',
-        help='Single PDF file to process or preview'
+        help='Single PDF file to process or preview, logo image to index, or catalog to write'
+    )
+    
+    parser.add_argument(
+        '--label',
+        help='Name of the logo variant added by index-logo (default: file name)'
     )
     
     parser.add_argument(
@@ -300,6 +520,12 @@ def main():
         help='Configuration file path (default: config.json)'
     )
     
+    parser.add_argument(
+        '--limit',
+        type=int,
+        help='Stop preview after the first N replacements'
+    )
+    
     parser.add_argument(
         '--verbose',
         action='store_true',
@@ -329,7 +555,7 @@ def main():
         if not args.file:
             print(f"{Fore.RED}Error: --file argument required for preview mode")
             sys.exit(1)
-        processor.preview_replacements(args.file)
+        processor.preview_replacements(args.file, args.limit)
     
     elif args.command == 'single':
         if not args.file:
@@ -343,6 +569,20 @@ def main():
             print(f"{Fore.GREEN}✓ Successfully processed: {output_path}")
         else:
             print(f"{Fore.RED}✗ Failed to process file")
+        processor.close()
+    
+    elif args.command == 'index-logo':
+        if not args.file:
+            print(f"{Fore.RED}Error: --file argument required to index a logo")
+            sys.exit(1)
+        processor.index_logo(args.file, args.label)
+    
+    elif args.command == 'merge':
+        if not args.file:
+            print(f"{Fore.RED}Error: --file argument required for the merged catalog")
+            sys.exit(1)
+        if not processor.merge_catalog(args.output, args.file):
+            sys.exit(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,156 @@
+"""
+PDF Merging Module - Assembles catalogs from processed datasheets
+"""
+
+import re
+import hashlib
+import logging
+from pathlib import Path
+from typing import Dict, List, Any, Optional
+
+import fitz  # PyMuPDF
+
+logger = logging.getLogger(__name__)
+
+# Indirect reference inside an object's source
+REFERENCE = re.compile(r'\b(\d+) 0 R\b')
+
+# Stream lengths differ with the source file's layout, not the content
+LENGTH_KEY = re.compile(r'/Length\s+\d+(?:\s+0\s+R)?')
+
+# Objects tied to one page or to the document structure are never shared
+DISTINCT_TYPES = re.compile(r'/Type\s*/(?:Page|Pages|Catalog|Annot)\b')
+
+
+class PDFMerger:
+    """Merges PDFs with PyMuPDF page insertion, sharing identical streams
+
+    Inputs are opened one at a time and closed once their pages are
+    inserted. After each insertion the new streams (fonts, images, ICC
+    profiles, ...) are hashed, and references to a stream already
+    present from an earlier input are redirected to that first copy, so
+    a logo or font shared by every datasheet is stored once. Duplicates
+    become unreferenced and are dropped on save. Hashing keeps this
+    linear in the size of the inputs, where garbage=4 compares objects
+    pairwise. Optionally the output gets a combined outline: one entry
+    per input with its own outline nested below.
+    """
+
+    def __init__(self, toc: bool = True):
+        """Configure whether the output gets a combined outline"""
+        self.toc = toc
+
+    def merge(self, pdf_files: List[Path], output_path: Path,
+              titles: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Merge ``pdf_files`` in order into ``output_path``
+
+        ``titles`` name the top-level outline entries; each input's title
+        metadata or file name is used otherwise. Returns page, stream and
+        size counts.
+        """
+        merged = fitz.open()
+        digests: Dict[str, int] = {}
+        outline = []
+        report = {'files': len(pdf_files), 'pages': 0, 'shared_objects': 0,
+                  'shared_streams': 0, 'shared_bytes': 0}
+
+        try:
+            for index, pdf_file in enumerate(pdf_files):
+                first_xref = merged.xref_length()
+                start = len(merged)
+                with fitz.open(str(pdf_file)) as source:
+                    merged.insert_pdf(source)
+                    title = titles[index] if titles else (source.metadata or {}).get('title')
+                    outline.append([1, title or Path(pdf_file).stem, start + 1])
+                    outline.extend([level + 1, text, page + start]
+                                   for level, text, page in source.get_toc(simple=True))
+                self._share_objects(merged, first_xref, digests, report)
+
+            report['pages'] = len(merged)
+            if self.toc:
+                merged.set_toc(outline)
+            # Duplicates are already unreferenced; garbage=3 and up would
+            # compare every pair of objects again
+            merged.save(str(output_path), garbage=2, deflate=True, use_objstms=1)
+        finally:
+            merged.close()
+
+        report['size'] = Path(output_path).stat().st_size
+        logger.info(f"Merged {len(pdf_files)} PDFs ({report['pages']} pages) into {output_path}, "
+                    f"{report['shared_streams']} duplicate streams "
+                    f"({report['shared_bytes']} bytes) shared")
+        return report
+
+    def _share_objects(self, doc: 'fitz.Document', first_xref: int,
+                       digests: Dict[str, int], report: Dict[str, Any]):
+        """Point references among the objects from ``first_xref`` on at earlier identical objects
+
+        Repeats for the objects whose references changed: once a font
+        program is shared, its descriptors match, then its font
+        dictionaries, then the forms using them.
+        """
+        shared: Dict[int, int] = {}
+        contents: Dict[int, str] = {}
+        pending = range(first_xref, doc.xref_length())
+
+        while pending:
+            found = {}
+            for xref in pending:
+                digest = self._digest(doc, xref, contents)
+                if digest is None:
+                    continue
+                first = digests.setdefault(digest, xref)
+                if first != xref:
+                    found[xref] = first
+            if not found:
+                return
+
+            shared.update(found)
+            for xref in found:
+                if xref in contents:
+                    report['shared_streams'] += 1
+                    report['shared_bytes'] += len(doc.xref_stream_raw(xref) or b'')
+            report['shared_objects'] += len(found)
+            pending = self._redirect(doc, first_xref, shared)
+
+    @staticmethod
+    def _digest(doc: 'fitz.Document', xref: int, contents: Dict[int, str]) -> Optional[str]:
+        """Hash of an object's source and stream, None for objects that must stay distinct"""
+        source = doc.xref_object(xref, compressed=True)
+        if source == 'null' or DISTINCT_TYPES.search(source):
+            return None
+        if doc.xref_is_stream(xref):
+            if xref not in contents:
+                contents[xref] = hashlib.sha1(doc.xref_stream_raw(xref) or b'').hexdigest()
+            source = f"{LENGTH_KEY.sub('', source)}\n{contents[xref]}"
+        return hashlib.sha1(source.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _redirect(doc: 'fitz.Document', first_xref: int, shared: Dict[int, int]) -> List[int]:
+        """Rewrite references to shared objects from ``first_xref`` on, returning the objects changed"""
+        def replace(match):
+            xref = int(match.group(1))
+            while xref in shared:
+                xref = shared[xref]
+            return f"{xref} 0 R"
+
+        changed = []
+        for xref in range(first_xref, doc.xref_length()):
+            if xref in shared:
+                continue
+            if doc.xref_is_stream(xref):
+                # update_object would drop the stream, so go key by key
+                for key in doc.xref_get_keys(xref):
+                    kind, value = doc.xref_get_key(xref, key)
+                    if kind in ('xref', 'array', 'dict'):
+                        updated = REFERENCE.sub(replace, value)
+                        if updated != value:
+                            doc.xref_set_key(xref, key, updated)
+                            changed.append(xref)
+            else:
+                source = doc.xref_object(xref, compressed=True)
+                updated = REFERENCE.sub(replace, source)
+                if updated != source:
+                    doc.update_object(xref, updated)
+                    changed.append(xref)
+        return sorted(set(changed))
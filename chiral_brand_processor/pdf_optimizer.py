@@ -0,0 +1,419 @@
+"""
+PDF Optimization Module - Shrinks finished PDFs for sending by email
+"""
+
+import io
+import os
+import math
+import zlib
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Tuple, Any, Optional, Iterator
+
+import numpy as np
+import fitz  # PyMuPDF
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# JPEG quality for each processing.quality level (an int is used as is)
+JPEG_QUALITY = {'low': 50, 'standard': 75, 'high': 85, 'maximum': 95}
+
+# Images are only downsampled when this far above the target resolution,
+# so a 320 dpi scan is left alone for a 300 dpi target
+DOWNSAMPLE_THRESHOLD = 1.5
+
+# Re-encoded images must be at least this much smaller to be kept
+MIN_GAIN = 0.05
+
+# Images with more colours than this are photos, the rest flat graphics
+MAX_PALETTE = 256
+
+# Already lossy streams are only re-encoded when they are downsampled
+LOSSY_FILTERS = ('DCTDecode', 'JPXDecode')
+
+# Bilevel codecs that a palette image would not beat
+SKIPPED_FILTERS = ('CCITTFaxDecode', 'JBIG2Decode')
+
+# Keys of a font descriptor that hold the embedded font program
+FONT_FILE_KEYS = ('FontFile', 'FontFile2', 'FontFile3')
+
+# How the optimized file is written for each processing.compression level;
+# every stream is deflated and objects go into object streams either way.
+# 'incremental' keeps the input's revisions, which an optimizer cannot do.
+SAVE_OPTIONS = {
+    'standard': {'garbage': 3},
+    'maximum': {'garbage': 4, 'clean': True}
+}
+
+CODEC_JPEG = 'jpeg'
+CODEC_PALETTE = 'palette'
+CODEC_FLATE = 'flate'
+
+# Bytes saved are reported per category; structure is everything else
+# (unused objects, deflated streams, object streams)
+CATEGORIES = ('images', 'fonts', 'structure')
+
+
+def pack_indices(indices: np.ndarray, bits: int) -> bytes:
+    """Pack a 2-D array of palette indices into rows of ``bits``-bit samples"""
+    if bits == 8:
+        return indices.astype(np.uint8).tobytes()
+    per_byte = 8 // bits
+    height, width = indices.shape
+    padded = np.zeros((height, -(-width // per_byte) * per_byte), dtype=np.uint8)
+    padded[:, :width] = indices
+    groups = padded.reshape(height, -1, per_byte)
+    shifts = (np.arange(per_byte - 1, -1, -1) * bits).astype(np.uint8)
+    return (groups << shifts).sum(axis=2, dtype=np.uint8).tobytes()
+
+
+def snap_to_palette(image: Image.Image, colors: List[Any]) -> Image.Image:
+    """Map resampled pixels back onto the colours of a flat graphic
+
+    Each pixel takes its nearest palette colour exactly; PIL's quantize
+    approximates the lookup and shifts colours such as white.
+    """
+    pixels = np.asarray(image).astype(np.int32)
+    palette = np.array(colors, dtype=np.int32)
+    best = np.full(pixels.shape[:2], np.iinfo(np.int32).max, dtype=np.int32)
+    nearest = np.zeros(pixels.shape[:2], dtype=np.intp)
+    for index, color in enumerate(palette):
+        distance = (pixels - color) ** 2
+        if distance.ndim == 3:
+            distance = distance.sum(axis=2)
+        closer = distance < best
+        best[closer] = distance[closer]
+        nearest[closer] = index
+    return Image.fromarray(palette[nearest].astype(np.uint8), image.mode)
+
+
+def encode_image(image: Image.Image, jpeg_quality: int, allow_jpeg: bool = True,
+                 allow_palette: bool = True) -> Tuple[str, bytes, Dict[str, str]]:
+    """Encode gray or RGB pixels with the codec that suits them
+
+    Flat graphics become a deflated palette image with as few bits per
+    sample as the palette allows, photos become JPEG. Returns the codec,
+    the stream and the image dictionary entries that go with it.
+    """
+    pixels = np.asarray(image)
+    base = '/DeviceGray' if image.mode == 'L' else '/DeviceRGB'
+    keys = {'Width': str(image.width), 'Height': str(image.height)}
+
+    if allow_palette and image.getcolors(MAX_PALETTE) is not None:
+        if image.mode == 'L':
+            flat = pixels.reshape(-1).astype(np.uint32)
+        else:
+            flat = pixels.reshape(-1, 3).astype(np.uint32)
+            flat = (flat[:, 0] << 16) | (flat[:, 1] << 8) | flat[:, 2]
+        colors, indices = np.unique(flat, return_inverse=True)
+        bits = next(bits for bits in (1, 2, 4, 8) if len(colors) <= 1 << bits)
+        if image.mode == 'L':
+            lookup = colors.astype(np.uint8).tobytes()
+        else:
+            lookup = np.stack([colors >> 16, (colors >> 8) & 0xFF, colors & 0xFF], axis=1).astype(np.uint8).tobytes()
+        keys.update(
+            Filter='/FlateDecode',
+            BitsPerComponent=str(bits),
+            ColorSpace=f'[/Indexed {base} {len(colors) - 1} <{lookup.hex()}>]'
+        )
+        stream = zlib.compress(pack_indices(indices.reshape(image.height, image.width), bits), 9)
+        return CODEC_PALETTE, stream, keys
+
+    keys.update(BitsPerComponent='8', ColorSpace=base)
+    if allow_jpeg:
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=jpeg_quality, optimize=True)
+        keys['Filter'] = '/DCTDecode'
+        return CODEC_JPEG, buffer.getvalue(), keys
+
+    keys['Filter'] = '/FlateDecode'
+    return CODEC_FLATE, zlib.compress(pixels.tobytes(), 9), keys
+
+
+def recompress_image(doc: 'fitz.Document', job: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Decode, resample and re-encode one image, None if nothing is gained"""
+    pix = fitz.Pixmap(doc, job['xref'])
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.n not in (1, 3):
+        return None  # CMYK, separations, ... keep their colour space
+
+    image = Image.frombytes('L' if pix.n == 1 else 'RGB', (pix.width, pix.height), pix.samples)
+    if job['scale'] < 1:
+        colors = image.getcolors(MAX_PALETTE) if job['palette'] else None
+        size = (max(1, round(pix.width * job['scale'])), max(1, round(pix.height * job['scale'])))
+        image = image.resize(size, Image.LANCZOS)
+        if colors is not None:
+            # Keep flat graphics flat rather than letting them turn into photos
+            image = snap_to_palette(image, [color for _, color in colors])
+
+    codec, stream, keys = encode_image(image, job['jpeg_quality'], job['jpeg'], job['palette'])
+    if len(stream) > job['length'] * (1 - MIN_GAIN):
+        return None
+    return {
+        'xref': job['xref'],
+        'codec': codec,
+        'stream': stream,
+        'keys': keys,
+        'downsampled': job['scale'] < 1
+    }
+
+
+def stream_bytes(doc: 'fitz.Document') -> Dict[str, int]:
+    """Stored size of the image streams and embedded font programs of ``doc``"""
+    sizes = {'images': 0, 'fonts': 0}
+    for xref in range(1, doc.xref_length()):
+        if doc.xref_get_key(xref, 'Subtype') == ('name', '/Image'):
+            sizes['images'] += len(doc.xref_stream_raw(xref) or b'')
+        elif doc.xref_get_key(xref, 'Type') == ('name', '/FontDescriptor'):
+            for key in FONT_FILE_KEYS:
+                value_kind, value = doc.xref_get_key(xref, key)
+                if value_kind == 'xref':
+                    sizes['fonts'] += len(doc.xref_stream_raw(int(value.split()[0])) or b'')
+    return sizes
+
+
+# State of a PDFOptimizer worker process: the document it has open
+_image_worker: Dict[str, Any] = {}
+
+
+def _recompress_chunk(task: Tuple[Path, Tuple, List[Dict[str, Any]]]) -> List[Optional[Dict[str, Any]]]:
+    """Recompress one chunk of images, opening the document on first use
+
+    Outputs are optimized in place, so a path can name a new file on the
+    next call; the open document is keyed by the file's stat as well.
+    """
+    path, stamp, jobs = task
+    if _image_worker.get('key') != (path, stamp):
+        if 'doc' in _image_worker:
+            _image_worker['doc'].close()
+        _image_worker.update(key=(path, stamp), doc=fitz.open(str(path)))
+    return [recompress_image(_image_worker['doc'], job) for job in jobs]
+
+
+class PDFOptimizer:
+    """Shrinks finished PDFs: images, fonts and file structure
+
+    Images shown at more than ``dpi`` (at their largest placement) are
+    downsampled, and images that are downsampled or stored losslessly are
+    re-encoded per image: JPEG at ``quality`` for photos, a deflated
+    palette for flat graphics. Only streams that get smaller are kept.
+    The image work is spread over a process pool, each worker opening the
+    document itself. Fonts are subset and the file is written with
+    garbage collection at the ``compression`` level and object streams.
+    optimize() reports the bytes saved per category.
+    """
+
+    def __init__(self, dpi: int = 300, quality: Any = 'high', workers: int = 0,
+                 chunk_size: int = 8, compression: str = 'maximum'):
+        """Configure the target resolution, JPEG quality, worker count (0 = one per CPU) and save level"""
+        self.dpi = dpi
+        if compression not in SAVE_OPTIONS:
+            logger.warning(f"Unknown compression '{compression}' for the optimizer, using 'maximum'")
+            compression = 'maximum'
+        self.save_options = dict(SAVE_OPTIONS[compression], deflate=True, deflate_images=True,
+                                 deflate_fonts=True, use_objstms=1)
+        if isinstance(quality, int):
+            self.jpeg_quality = quality
+        else:
+            self.jpeg_quality = JPEG_QUALITY.get(quality, JPEG_QUALITY['standard'])
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = max(1, chunk_size)
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    @classmethod
+    def from_config(cls, processing: Dict[str, Any]) -> Optional['PDFOptimizer']:
+        """Create an optimizer from the ``processing`` config section, None if off
+
+        ``optimize_workers`` is separate from the page pool's ``workers``:
+        both pools live for the whole batch. The optimized file is saved
+        at the ``compression`` level; with 'incremental' the outputs must
+        keep the input's revisions, so they are not optimized at all.
+        """
+        if not processing.get('optimize', False):
+            return None
+        compression = processing.get('compression', 'standard')
+        if compression == 'incremental':
+            logger.warning("processing.compression 'incremental' keeps the original revision "
+                           "in each output, so processing.optimize is ignored")
+            return None
+        return cls(
+            dpi=processing.get('dpi', 300),
+            quality=processing.get('quality', 'high'),
+            workers=processing.get('optimize_workers', 1),
+            compression=compression
+        )
+
+    def optimize(self, pdf_path: Path, output_path: Optional[Path] = None) -> Dict[str, Any]:
+        """Write an optimized copy of ``pdf_path`` (in place by default)
+
+        The result replaces ``output_path`` atomically when it is smaller
+        than the input; otherwise ``output_path`` gets the input unchanged.
+        Returns the sizes, the bytes saved per category and the codec
+        chosen for each re-encoded image.
+        """
+        pdf_path = Path(pdf_path)
+        output_path = Path(output_path) if output_path is not None else pdf_path
+        original_size = pdf_path.stat().st_size
+        codecs = {CODEC_JPEG: 0, CODEC_PALETTE: 0, CODEC_FLATE: 0, 'downsampled': 0, 'unchanged': 0}
+
+        doc = fitz.open(str(pdf_path))
+        try:
+            before = stream_bytes(doc)
+            jobs = self.plan(doc)
+            results = list(self._recompress(pdf_path, doc, jobs))
+            for result in results:
+                if result is None:
+                    codecs['unchanged'] += 1
+                    continue
+                self._apply(doc, result)
+                codecs[result['codec']] += 1
+                codecs['downsampled'] += result['downsampled']
+
+            try:
+                doc.subset_fonts()
+            except Exception as e:
+                logger.warning(f"Could not subset fonts of {pdf_path.name}: {e}")
+
+            fd, tmp_path = tempfile.mkstemp(dir=str(output_path.parent), suffix='.pdf')
+            os.close(fd)
+            try:
+                doc.save(tmp_path, **self.save_options)
+            except Exception:
+                os.remove(tmp_path)
+                raise
+        finally:
+            doc.close()
+
+        optimized_size = os.path.getsize(tmp_path)
+        if optimized_size < original_size:
+            with fitz.open(tmp_path) as optimized:
+                after = stream_bytes(optimized)
+            os.replace(tmp_path, output_path)
+        else:
+            after = before
+            optimized_size = original_size
+            if output_path != pdf_path:
+                shutil.copyfile(str(pdf_path), tmp_path)
+                os.replace(tmp_path, output_path)
+            else:
+                os.remove(tmp_path)
+
+        saved = {category: before[category] - after[category] for category in ('images', 'fonts')}
+        saved['structure'] = original_size - optimized_size - saved['images'] - saved['fonts']
+        report = {
+            'original_size': original_size,
+            'optimized_size': optimized_size,
+            'saved': saved,
+            'images': codecs
+        }
+        logger.info(f"Optimized {output_path.name}: {original_size} -> {optimized_size} bytes "
+                    f"(images {saved['images']}, fonts {saved['fonts']}, "
+                    f"structure {saved['structure']})")
+        return report
+
+    def plan(self, doc: 'fitz.Document') -> List[Dict[str, Any]]:
+        """Images worth re-encoding, with the scale that brings them to ``dpi``
+
+        Placements are matched to xrefs by pixel size without decoding
+        anything; xrefs that share a size all take the lowest resolution
+        seen, which can only make the downsampling more cautious.
+        """
+        resolution: Dict[int, float] = {}
+        items: Dict[int, Tuple] = {}
+        for page in doc:
+            sizes: Dict[Tuple[int, int], List[int]] = {}
+            for item in page.get_images(full=True):
+                sizes.setdefault((item[2], item[3]), []).append(item[0])
+                items[item[0]] = item
+            for info in page.get_image_info():
+                a, b, c, d = info['transform'][:4]
+                shown_width, shown_height = math.hypot(a, b), math.hypot(c, d)
+                if shown_width <= 0 or shown_height <= 0:
+                    continue
+                dpi = min(info['width'] * 72 / shown_width, info['height'] * 72 / shown_height)
+                for xref in sizes.get((info['width'], info['height']), []):
+                    resolution[xref] = min(resolution.get(xref, dpi), dpi)
+
+        jobs = []
+        planned = set()
+        for xref, dpi in sorted(resolution.items()):
+            smask, bpc, image_filter = items[xref][1], items[xref][4], items[xref][8]
+            if xref in planned or bpc < 8 or image_filter in SKIPPED_FILTERS:
+                continue
+            if (doc.xref_get_key(xref, 'ImageMask')[1] == 'true' or
+                    doc.xref_get_key(xref, 'Mask')[0] == 'array'):
+                continue  # Stencils and colour-key masks depend on the exact samples
+
+            scale = self.dpi / dpi if dpi > self.dpi * DOWNSAMPLE_THRESHOLD else 1.0
+            if scale == 1.0 and image_filter in LOSSY_FILTERS:
+                continue
+            jobs.append(self._job(doc, xref, scale, jpeg=True, palette=True))
+            planned.add(xref)
+
+            # Soft masks follow their image down; they must stay DeviceGray
+            if smask and scale < 1 and smask not in planned:
+                if doc.xref_get_key(xref, 'Matte')[0] == 'null':
+                    jobs.append(self._job(doc, smask, scale, jpeg=False, palette=False))
+                    planned.add(smask)
+        return jobs
+
+    def _job(self, doc: 'fitz.Document', xref: int, scale: float, jpeg: bool,
+             palette: bool) -> Dict[str, Any]:
+        """Work order for recompress_image"""
+        return {
+            'xref': xref,
+            'scale': scale,
+            'length': len(doc.xref_stream_raw(xref) or b''),
+            'jpeg_quality': self.jpeg_quality,
+            'jpeg': jpeg,
+            'palette': palette
+        }
+
+    def _recompress(self, pdf_path: Path, doc: 'fitz.Document',
+                    jobs: List[Dict[str, Any]]) -> Iterator[Optional[Dict[str, Any]]]:
+        """recompress_image results for ``jobs``, in the pool when worthwhile"""
+        chunks = [jobs[start:start + self.chunk_size] for start in range(0, len(jobs), self.chunk_size)]
+        if self.workers == 1 or len(chunks) < 2:
+            for job in jobs:
+                yield recompress_image(doc, job)
+            return
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        stat = pdf_path.stat()
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        tasks = [(pdf_path, stamp, chunk) for chunk in chunks]
+        for results in self._executor.map(_recompress_chunk, tasks):
+            yield from results
+
+    @staticmethod
+    def _apply(doc: 'fitz.Document', result: Dict[str, Any]):
+        """Store a re-encoded image stream under its original xref"""
+        xref = result['xref']
+        doc.update_stream(xref, result['stream'], compress=False)
+        for key, value in result['keys'].items():
+            doc.xref_set_key(xref, key, value)
+        for key in ('DecodeParms', 'Decode', 'SMaskInData'):
+            if doc.xref_get_key(xref, key)[0] != 'null':
+                doc.xref_set_key(xref, key, 'null')
+
+    def close(self):
+        """Stop the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self) -> 'PDFOptimizer':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -4,33 +4,108 @@ PDF Processing Module - Handles PDF manipulation and conversion
 
 import io
 import os
+import mmap
+import shutil
+import hashlib
 import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import Dict, List, Tuple, Optional, Any
+from typing import Dict, List, Tuple, Optional, Any, Callable, Iterator
+from collections.abc import MutableMapping
 import logging
 import fitz  # PyMuPDF
 from PIL import Image, ImageDraw, ImageFont
 import pytesseract
 from pdf2image import convert_from_path
 import pdfplumber
-from PyPDF2 import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import letter, A4
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.lib.utils import ImageReader
 
+from link_validator import index_links
+from logo_detector import LogoDetector
+from pdf_merger import PDFMerger
+from pdf_optimizer import PDFOptimizer
+from text_replacer import CJK_PATTERN, TextReplacer
+from watermark import Watermark
+
 logger = logging.getLogger(__name__)
 
+# Span flag bits set by PyMuPDF text extraction
+SPAN_FLAG_ITALIC = 2
+SPAN_FLAG_BOLD = 16
+
+# Smallest fraction of the original size a replacement may shrink to
+MIN_FONT_SCALE = 0.6
+
+# Background modes of logo renditions: keep transparency, or flatten onto
+# white for images that were opaque
+RENDITION_ALPHA = 'alpha'
+RENDITION_OPAQUE = 'opaque'
+
+# Inputs at least this large are opened through a read-only memory map
+DEFAULT_MMAP_THRESHOLD_MB = 32
+
+# How save_pdf writes edited documents (processing.compression).
+# 'incremental' appends the changes to a copy of the input, which keeps
+# the original revision (replaced text included) inside the file; the
+# others rewrite the whole file with these save options. 'draft' is only
+# for files that the optimizer reads and writes out again (main.py).
+COMPRESSION_INCREMENTAL = 'incremental'
+COMPRESSION_DRAFT = 'draft'
+DEFAULT_COMPRESSION = 'standard'
+SAVE_OPTIONS = {
+    COMPRESSION_DRAFT: {'garbage': 1, 'deflate': True},
+    'standard': {'garbage': 3, 'deflate': True},
+    'maximum': {'garbage': 4, 'deflate': True, 'clean': True}
+}
+
+
+def extract_spans(page: 'fitz.Page', textpage: Optional['fitz.TextPage'] = None) -> List[Dict[str, Any]]:
+    """Text spans of a page with positions, in reading order"""
+    spans = []
+    blocks = page.get_text("dict", textpage=textpage)
+    for block in blocks.get("blocks", []):
+        if block.get("type") == 0:  # Text block
+            for line in block.get("lines", []):
+                for span in line.get("spans", []):
+                    spans.append({
+                        'text': span.get("text", ""),
+                        'bbox': span.get("bbox"),
+                        'font': span.get("font"),
+                        'size': span.get("size"),
+                        'flags': span.get("flags"),
+                        'color': span.get("color"),
+                        'origin': span.get("origin")
+                    })
+    return spans
+
+
 class PDFProcessor:
     """Handles PDF reading, modification, and writing operations"""
     
-    def __init__(self):
+    def __init__(self, mmap_threshold_mb: float = DEFAULT_MMAP_THRESHOLD_MB,
+                 compression: str = DEFAULT_COMPRESSION):
         """Initialize PDF processor"""
         self.supported_formats = ['.pdf']
         self.temp_dir = tempfile.mkdtemp()
+        self.logo_renditions = LogoRenditionCache()
+        self.mmap_threshold = mmap_threshold_mb * 1024 * 1024
+        if compression != COMPRESSION_INCREMENTAL and compression not in SAVE_OPTIONS:
+            logger.warning(f"Unknown compression '{compression}', using 'standard'")
+            compression = 'standard'
+        self.compression = compression
         self.setup_fonts()
     
+    @classmethod
+    def from_config(cls, processing: Dict[str, Any]) -> 'PDFProcessor':
+        """Create a processor from the ``processing`` config section"""
+        return cls(
+            mmap_threshold_mb=processing.get('mmap_threshold_mb', DEFAULT_MMAP_THRESHOLD_MB),
+            compression=processing.get('compression', DEFAULT_COMPRESSION)
+        )
+    
     def setup_fonts(self):
         """Setup custom fonts for PDF generation"""
         try:
@@ -50,7 +125,15 @@ class PDFProcessor:
             logger.warning(f"Could not register custom fonts: {e}")
     
     def load_pdf(self, pdf_path: Path) -> Dict[str, Any]:
-        """Load and parse PDF file"""
+        """Load and parse PDF file
+        
+        Pages are LazyPage objects: text, spans and images are extracted on
+        first access and can be released again, so memory follows the pages
+        being worked on rather than the document size. The document stays
+        open until close_pdf() is called. Files of at least
+        ``mmap_threshold_mb`` are read through a memory map, so their bytes
+        live in the page cache instead of being copied into the process.
+        """
         if not pdf_path.exists():
             raise FileNotFoundError(f"PDF file not found: {pdf_path}")
         
@@ -64,55 +147,20 @@ class PDFProcessor:
         
         try:
             # Use PyMuPDF for comprehensive PDF handling
-            doc = fitz.open(str(pdf_path))
+            doc, mapped = self._open_document(pdf_path)
+            if mapped is not None:
+                pdf_data['mapped'] = mapped
             
             # Extract metadata
             pdf_data['metadata'] = doc.metadata
             pdf_data['page_count'] = len(doc)
+            pdf_data['document'] = doc
             
-            # Process each page
-            for page_num, page in enumerate(doc):
-                page_data = {
-                    'number': page_num + 1,
-                    'width': page.rect.width,
-                    'height': page.rect.height,
-                    'text': page.get_text(),
-                    'blocks': [],
-                    'images': []
-                }
-                
-                # Extract text blocks with positions
-                blocks = page.get_text("dict")
-                for block in blocks.get("blocks", []):
-                    if block.get("type") == 0:  # Text block
-                        for line in block.get("lines", []):
-                            for span in line.get("spans", []):
-                                page_data['blocks'].append({
-                                    'text': span.get("text", ""),
-                                    'bbox': span.get("bbox"),
-                                    'font': span.get("font"),
-                                    'size': span.get("size"),
-                                    'flags': span.get("flags"),
-                                    'color': span.get("color")
-                                })
-                
-                # Extract images
-                image_list = page.get_images()
-                for img_index, img in enumerate(image_list):
-                    xref = img[0]
-                    pix = fitz.Pixmap(doc, xref)
-                    if pix.n - pix.alpha < 4:  # GRAY or RGB
-                        img_data = pix.tobytes("png")
-                        page_data['images'].append({
-                            'index': img_index,
-                            'data': img_data,
-                            'bbox': page.get_image_bbox(img)
-                        })
-                    pix = None
-                
-                pdf_data['pages'].append(page_data)
+            # Images are shared by xref across all pages of the document
+            image_cache = ImageCache(doc)
+            pdf_data['image_cache'] = image_cache
             
-            doc.close()
+            pdf_data['pages'] = [LazyPage(doc, page_num, image_cache) for page_num in range(len(doc))]
             
         except Exception as e:
             logger.error(f"Error loading PDF: {e}")
@@ -120,12 +168,393 @@ class PDFProcessor:
         
         return pdf_data
     
-    def save_pdf(self, pdf_data: Dict[str, Any], output_path: Path):
-        """Save modified PDF data to file"""
+    def close_pdf(self, pdf_data: Dict[str, Any]):
+        """Release the pages of a loaded PDF and close its document"""
+        for page_data in pdf_data.get('pages', []):
+            if isinstance(page_data, LazyPage):
+                page_data.release(force=True)
+        
+        image_cache = pdf_data.pop('image_cache', None)
+        if image_cache is not None:
+            image_cache.clear()
+        
+        doc = pdf_data.pop('document', None)
+        if doc is not None:
+            doc.close()
+        self._unmap(pdf_data.pop('mapped', None))
+    
+    def _open_document(self, pdf_path: Path) -> Tuple['fitz.Document', Optional[memoryview]]:
+        """Open a PDF, through a read-only memory map when it is large
+        
+        Returns the document and the mapped view (None when opened by
+        path), which must stay alive until the document is closed.
+        """
+        if os.path.getsize(pdf_path) < self.mmap_threshold:
+            return fitz.open(str(pdf_path)), None
+        with open(pdf_path, 'rb') as f:
+            mapped = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+        try:
+            return fitz.open(stream=mapped, filetype='pdf'), mapped
+        except Exception:
+            self._unmap(mapped)
+            raise
+    
+    @staticmethod
+    def _unmap(mapped: Optional[memoryview]):
+        """Release a view returned by _open_document and its memory map"""
+        if mapped is not None:
+            mapped_file = mapped.obj
+            mapped.release()
+            mapped_file.close()
+    
+    def triage(self, pdf_data: Dict[str, Any], has_hits: Callable[[str], bool]) -> Dict[str, Any]:
+        """Mark pages whose plain text has no hits as pass-through
+        
+        Only the plain text of each page is extracted and checked with
+        ``has_hits`` (TextReplacer.has_hits). Pass-through pages are skipped
+        by the text stages: no span extraction and no text rewrite on save.
+        Logo replacement still looks at them, since headers and footers
+        carry the old logo whether or not the page text has hits. Results
+        are stored in ``pdf_data['triage']``.
+        """
+        hit_pages = []
+        
+        for page_index, page_data in enumerate(pdf_data['pages']):
+            if has_hits(page_data.get('text') or ''):
+                hit_pages.append(page_data.get('number', page_index + 1))
+            else:
+                page_data['pass_through'] = True
+                if isinstance(page_data, LazyPage):
+                    page_data.release()
+        
+        return self._triage_summary(pdf_data, hit_pages)
+    
+    def _triage_summary(self, pdf_data: Dict[str, Any], hit_pages: List[int]) -> Dict[str, Any]:
+        """Store and log the triage result of a document"""
+        triage = {
+            'pages': len(pdf_data['pages']),
+            'hit_pages': hit_pages,
+            'pass_through': len(pdf_data['pages']) - len(hit_pages)
+        }
+        pdf_data['triage'] = triage
+        logger.info(f"Triage: {len(hit_pages)}/{triage['pages']} pages with hits")
+        return triage
+    
+    def replace_text_parallel(self, pdf_data: Dict[str, Any], pool: 'PagePool') -> Dict[str, Any]:
+        """Replace text on the pages of a loaded PDF in the pool's worker processes
+        
+        Equivalent to PDFProcessor.triage (when the pool triages) followed by
+        TextReplacer.replace_all, but with the page work spread over the
+        pool. Workers only send back edited spans, so the parent never
+        extracts text itself and applies everything in the one save.
+        """
+        chunks = pool.map(pdf_data['path'], pdf_data['page_count'])
+        hit_pages = pool.replacer.merge_page_results(pdf_data, chunks)
+        if pool.triage:
+            self._triage_summary(pdf_data, hit_pages)
+        return pdf_data
+    
+    def save_pdf(self, pdf_data: Dict[str, Any], output_path: Path,
+                 watermark: Optional[Watermark] = None, compression: Optional[str] = None):
+        """Save modified PDF data to file
+        
+        Documents loaded from disk with an edit script are edited in place
+        (see edit_pdf_in_place); anything else is rebuilt page by page.
+        A ``watermark`` is stamped in the same pass, before the save.
+        ``compression`` overrides the configured one for this save only.
+        """
+        source = pdf_data.get('path')
+        if source and Path(source).exists() and 'edit_script' in pdf_data:
+            self.edit_pdf_in_place(pdf_data, output_path, watermark, compression)
+        else:
+            self.rebuild_pdf(pdf_data, output_path, watermark)
+    
+    def edit_pdf_in_place(self, pdf_data: Dict[str, Any], output_path: Path,
+                          watermark: Optional[Watermark] = None, compression: Optional[str] = None):
+        """Write the original PDF with only the changed spans and logos replaced
+        
+        Each span touched by the edit script is removed with a redaction
+        annotation (leaving images and vector graphics alone, see
+        _redact_spans) and its new text is inserted at the same baseline,
+        size and colour. Vector logos are removed the same way, dropping
+        only the line art they cover, and the new logo is placed in their
+        area. Each logo rendition is embedded once and every placement
+        refers to that xref. Pages without edits are not modified at all,
+        apart from the ``watermark`` if one is given.
+        
+        With ``compression`` (by default the configured one) 'incremental'
+        the input is copied and the changes are appended to it as an
+        update section, so unchanged objects are never rewritten. The
+        previous revision, with the old brand text and logos, stays
+        readable in the file, so this is only for drafts. 'standard',
+        'maximum' and 'draft' write a new, garbage-collected file instead.
+        
+        The output is written to a temporary file next to ``output_path``
+        and moved onto it only once saved, so a failed edit never leaves a
+        partial or unbranded file there.
+        """
+        changed = pdf_data['edit_script'].changed_spans()
+        vector_logos = {
+            page_index: page_data['vector_logos']
+            for page_index, page_data in enumerate(pdf_data['pages'])
+            if page_data.get('vector_logos')
+        }
+        
+        compression = compression or self.compression
+        staging = self._staging_path(output_path)
+        doc = mapped = None
+        try:
+            doc, incremental = self._open_for_edit(pdf_data['path'], staging, compression)
+            if not incremental:
+                doc, mapped = self._open_document(Path(pdf_data['path']))
+            
+            for page_index, span_indices in changed.items():
+                page = doc[page_index]
+                spans = [pdf_data['pages'][page_index]['blocks'][i] for i in span_indices]
+                spans += self._redact_spans(page, spans)
+                
+                for span in spans:
+                    if span.get('text', '').strip() and span.get('bbox'):
+                        self._insert_span(page, span)
+            
+            # Logo rendition -> xref of its single copy in the output
+            shared: Dict[Tuple, int] = {}
+            
+            # Logos swapped by replace_logo; every use of the image follows
+            replaced_xrefs = set()
+            aliases: Dict[int, int] = {}
+            for page_index, page_data in enumerate(pdf_data['pages']):
+                if isinstance(page_data, LazyPage) and not page_data.is_loaded('images'):
+                    continue  # Released pages have no replaced images
+                for img_data in page_data.get('images', []):
+                    xref = img_data.get('xref')
+                    if not img_data.get('replaced') or not xref or xref in replaced_xrefs:
+                        continue
+                    replaced_xrefs.add(xref)
+                    rendition = img_data.get('rendition')
+                    if rendition in shared:
+                        aliases[xref] = shared[rendition]
+                    else:
+                        self._replace_image(doc[page_index], xref, img_data['data'])
+                        if rendition is not None:
+                            shared[rendition] = xref
+            if aliases:
+                self._alias_images(doc, aliases)
+            
+            for page_index, hits in vector_logos.items():
+                page = doc[page_index]
+                for hit in hits:
+                    page.add_redact_annot(fitz.Rect(hit['rect']), fill=False)
+                page.apply_redactions(
+                    images=fitz.PDF_REDACT_IMAGE_NONE,
+                    graphics=fitz.PDF_REDACT_LINE_ART_REMOVE_IF_COVERED,
+                    text=fitz.PDF_REDACT_TEXT_NONE
+                )
+                for hit in hits:
+                    rendition = hit.get('rendition')
+                    if rendition in shared:
+                        page.insert_image(fitz.Rect(hit['rect']), xref=shared[rendition])
+                    else:
+                        xref = page.insert_image(fitz.Rect(hit['rect']), stream=hit['data'])
+                        if rendition is not None:
+                            shared[rendition] = xref
+            
+            if watermark:
+                watermark.apply(doc)
+            
+            if incremental:
+                doc.save(str(staging), incremental=True, deflate=True,
+                         encryption=fitz.PDF_ENCRYPT_KEEP)
+            else:
+                doc.save(str(staging), **SAVE_OPTIONS.get(compression, SAVE_OPTIONS['standard']))
+            doc.close()
+            os.replace(staging, output_path)
+            
+            logger.info(f"PDF saved {'incrementally' if incremental else 'successfully'} to {output_path} "
+                        f"({sum(len(s) for s in changed.values())} spans on {len(changed)} pages changed, "
+                        f"{sum(len(h) for h in vector_logos.values())} vector logos replaced)")
+            
+        except Exception as e:
+            logger.error(f"Error saving PDF: {e}")
+            raise
+        finally:
+            if doc is not None and not doc.is_closed:
+                doc.close()
+            self._unmap(mapped)
+            if staging.exists():
+                staging.unlink()  # Only left over when saving failed
+    
+    def _redact_spans(self, page: 'fitz.Page', spans: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Remove the text of ``spans`` from a page, sparing the text around it
+        
+        A redaction removes every glyph whose font box touches it, and the
+        boxes of tightly set lines overlap, so each span's box is clipped
+        clear of the unchanged spans it overlaps. Unchanged spans that
+        still lose glyphs are removed whole; they are returned so they can
+        be drawn again along with ``spans``.
+        """
+        boxes = [fitz.Rect(span['bbox']) for span in spans if span.get('bbox')]
+        keys = {self._span_key(span) for span in spans if span.get('bbox')}
+        neighbours = [span for span in extract_spans(page)
+                      if self._span_key(span) not in keys
+                      and any(box.intersects(span['bbox']) for box in boxes)]
+        
+        for box in boxes:
+            page.add_redact_annot(self._clip_box(box, neighbours), fill=False)
+        page.apply_redactions(
+            images=fitz.PDF_REDACT_IMAGE_NONE,
+            graphics=fitz.PDF_REDACT_LINE_ART_NONE
+        )
+        if not neighbours:
+            return []
+        
+        # Spans are intact when their text still starts at the same origin
+        remaining = {(span['text'], self._span_key(span)) for span in extract_spans(page)}
+        damaged = [span for span in neighbours if (span['text'], self._span_key(span)) not in remaining]
+        if damaged:
+            intact = [span for span in neighbours if span not in damaged]
+            for span in damaged:
+                page.add_redact_annot(self._clip_box(fitz.Rect(span['bbox']), intact), fill=False)
+            page.apply_redactions(
+                images=fitz.PDF_REDACT_IMAGE_NONE,
+                graphics=fitz.PDF_REDACT_LINE_ART_NONE
+            )
+            logger.debug(f"Redrawing {len(damaged)} spans next to edited text on page {page.number + 1}")
+        return damaged
+    
+    @staticmethod
+    def _span_key(span: Dict[str, Any]) -> Tuple[float, ...]:
+        """Position of a span, stable across extractions of the same page"""
+        return tuple(round(value, 1) for value in (span.get('origin') or span['bbox'][:2]))
+    
+    @staticmethod
+    def _clip_box(box: 'fitz.Rect', spans: List[Dict[str, Any]]) -> 'fitz.Rect':
+        """``box`` cut back so it no longer overlaps the boxes of ``spans``
+        
+        Lines above or below are cut off vertically and neighbours on the
+        same line horizontally. The whole box is kept if nothing would be
+        left of it.
+        """
+        clipped = fitz.Rect(box)
+        for span in spans:
+            other = fitz.Rect(span['bbox'])
+            overlap = clipped & other
+            if overlap.is_empty:
+                continue
+            if overlap.height <= overlap.width:
+                if other.y0 + other.y1 > clipped.y0 + clipped.y1:
+                    clipped.y1 = other.y0
+                else:
+                    clipped.y0 = other.y1
+            elif other.x0 + other.x1 > clipped.x0 + clipped.x1:
+                clipped.x1 = other.x0
+            else:
+                clipped.x0 = other.x1
+        return box if clipped.is_empty else clipped
+    
+    @staticmethod
+    def _staging_path(output_path: Path) -> Path:
+        """New temporary file in the directory of ``output_path`` to save into first"""
+        fd, tmp_path = tempfile.mkstemp(dir=str(Path(output_path).parent), suffix='.pdf')
+        os.close(fd)
+        return Path(tmp_path)
+    
+    def _open_for_edit(self, source: Path, staging: Path,
+                       compression: str) -> Tuple[Optional['fitz.Document'], bool]:
+        """Open a copy of ``source`` at ``staging`` for an incremental save
+        
+        Returns (document, True), or (None, False) when a full rewrite is
+        configured or the file cannot be updated incrementally (repaired
+        on open, for instance).
+        """
+        if compression != COMPRESSION_INCREMENTAL:
+            return None, False
+        
+        shutil.copyfile(str(source), str(staging))
+        doc = fitz.open(str(staging))
+        if doc.can_save_incrementally():
+            return doc, True
+        
+        logger.info(f"{source} cannot be saved incrementally, rewriting it")
+        doc.close()
+        return None, False
+    
+    @staticmethod
+    def _set_xobject(doc: 'fitz.Document', page: 'fitz.Page', referencer: int,
+                     name: str, value: str):
+        """Set the XObject resource ``name`` of a page (or of form ``referencer``)"""
+        # xref_set_key does not follow indirect objects along a key path
+        owner, key = referencer or page.xref, 'Resources'
+        for part in ('XObject', name):
+            kind, target = doc.xref_get_key(owner, key)
+            if kind == 'xref':
+                owner, key = int(target.split()[0]), part
+            elif kind == 'dict':
+                key = f"{key}/{part}"
+            else:
+                return
+        doc.xref_set_key(owner, key, value)
+    
+    def _replace_image(self, page: 'fitz.Page', xref: int, data: bytes):
+        """Replace the image ``xref`` everywhere it is used, keeping one copy"""
+        names = {image[7] for image in page.get_images(full=True)}
+        page.replace_image(xref, stream=data)
+        # replace_image leaves its temporary copy in the page resources
+        for image in page.get_images(full=True):
+            if image[7] not in names:
+                self._set_xobject(page.parent, page, image[9], image[7], "null")
+    
+    def _alias_images(self, doc: 'fitz.Document', aliases: Dict[int, int]):
+        """Point every resource entry naming an image in ``aliases`` at its target xref
+        
+        The aliased images are left unreferenced and dropped on save.
+        """
+        for page in doc:
+            for image in page.get_images(full=True):
+                if image[0] in aliases:
+                    self._set_xobject(doc, page, image[9], image[7], f"{aliases[image[0]]} 0 R")
+    
+    def _font(self, fontname: str) -> 'fitz.Font':
+        """Built-in font used for replacement text, loaded once"""
+        fonts = self.__dict__.setdefault('_fonts', {})
+        if fontname not in fonts:
+            fonts[fontname] = fitz.Font(fontname)
+        return fonts[fontname]
+    
+    def _insert_span(self, page: 'fitz.Page', span: Dict[str, Any]):
+        """Draw a span's replacement text where the original span was"""
+        text = span['text']
+        bbox = fitz.Rect(span['bbox'])
+        flags = span.get('flags') or 0
+        
+        if CJK_PATTERN.search(text):
+            font = self._font('cjk')
+        elif flags & SPAN_FLAG_BOLD:
+            font = self._font('hebi' if flags & SPAN_FLAG_ITALIC else 'hebo')
+        else:
+            font = self._font('heit' if flags & SPAN_FLAG_ITALIC else 'helv')
+        
+        # Shrink text that would overrun the original span, within limits
+        fontsize = span.get('size') or 11
+        width = font.text_length(text, fontsize=fontsize)
+        if width > bbox.width > 0:
+            fontsize *= max(bbox.width / width, MIN_FONT_SCALE)
+        
+        color = span.get('color')
+        writer = fitz.TextWriter(page.rect)
+        writer.append(span.get('origin') or bbox.bl, text, font=font, fontsize=fontsize)
+        writer.write_text(page, color=fitz.sRGB_to_pdf(color) if isinstance(color, int) else (0, 0, 0))
+    
+    def rebuild_pdf(self, pdf_data: Dict[str, Any], output_path: Path,
+                    watermark: Optional[Watermark] = None):
+        """Build a new PDF from the extracted page data"""
         try:
             # Create new PDF document
             doc = fitz.open()
             
+            # Source image xref (or logo rendition) -> xref of its copy in the new document
+            inserted: Dict[Any, int] = {}
+            
             for page_data in pdf_data['pages']:
                 # Create new page with same dimensions
                 page = doc.new_page(
@@ -145,16 +574,30 @@ class PDFProcessor:
                             color=block.get('color', (0, 0, 0))
                         )
                 
-                # Add images
+                # Add images, embedding each source image and logo rendition only once
                 for img_data in page_data.get('images', []):
-                    if img_data.get('data'):
+                    img_rect = img_data.get('bbox', fitz.Rect(0, 0, 100, 100))
+                    key = img_data.get('rendition') if img_data.get('replaced') else img_data.get('xref')
+                    if key and key in inserted:
+                        page.insert_image(img_rect, xref=inserted[key])
+                    elif img_data.get('data'):
                         # Insert image
-                        img_rect = img_data.get('bbox', fitz.Rect(0, 0, 100, 100))
-                        page.insert_image(img_rect, stream=img_data['data'])
+                        new_xref = page.insert_image(img_rect, stream=img_data['data'])
+                        if key:
+                            inserted[key] = new_xref
             
-            # Save document
-            doc.save(str(output_path), deflate=True, garbage=3)
-            doc.close()
+            if watermark:
+                watermark.apply(doc)
+            
+            # Save document, replacing the output only once it is complete
+            staging = self._staging_path(output_path)
+            try:
+                doc.save(str(staging), deflate=True, garbage=3)
+                os.replace(staging, output_path)
+            finally:
+                doc.close()
+                if staging.exists():
+                    staging.unlink()
             
             logger.info(f"PDF saved successfully to {output_path}")
             
@@ -162,50 +605,77 @@ class PDFProcessor:
             logger.error(f"Error saving PDF: {e}")
             raise
     
-    def replace_logo(self, pdf_data: Dict[str, Any], logo_path: Path) -> Dict[str, Any]:
-        """Replace existing logos with new CHIRAL logo"""
+    def replace_logo(self, pdf_data: Dict[str, Any], logo_path: Path,
+                     detector: Optional[LogoDetector] = None) -> Dict[str, Any]:
+        """Replace existing logos with new CHIRAL logo
+        
+        Images are recognised by ``detector`` when it has known logos;
+        otherwise any image starting in the top 150 points counts as a logo.
+        Logos drawn as vector graphics are found by the detector's template
+        matching and listed under the page's ``vector_logos``.
+        """
         try:
             # Load new logo
             if not logo_path.exists():
                 logger.warning(f"Logo file not found: {logo_path}")
                 return pdf_data
             
-            logo_img = Image.open(logo_path)
+            logo_digest = self.logo_renditions.load(logo_path)
+            use_index = detector is not None and not detector.empty
+            if not use_index:
+                logger.warning(f"No logo index: replacing every image in the top 150 points "
+                               f"of {pdf_data.get('path', 'the document')}")
             
             # Process each page
+            # Pages passed through by triage too: logos do not depend on text hits
             for page_data in pdf_data['pages']:
                 # Detect and replace logo areas
-                # This is simplified - in production, you'd use more sophisticated logo detection
                 images_to_replace = []
                 
                 for img_index, img_data in enumerate(page_data.get('images', [])):
                     bbox = img_data.get('bbox')
-                    if bbox:
-                        # Check if image is likely a logo (top area, reasonable size)
-                        if bbox[1] < 150:  # Top 150 pixels
+                    if not bbox:
+                        continue
+                    if use_index:
+                        if self._match_logo(pdf_data, img_data, detector):
                             images_to_replace.append(img_index)
+                    elif bbox[1] < 150:  # Top 150 pixels
+                        images_to_replace.append(img_index)
+                
+                # Vector logos need the page itself, which only lazy pages keep
+                vector_logos = []
+                if detector is not None and isinstance(page_data, LazyPage):
+                    vector_logos = detector.find_vector_logos(page_data.page)
+                    for hit in vector_logos:
+                        rect = fitz.Rect(hit['rect'])
+                        hit['rendition'], hit['data'] = self.logo_renditions.get(
+                            logo_digest, rect.width, rect.height, RENDITION_ALPHA
+                        )
+                    if vector_logos:
+                        page_data['vector_logos'] = vector_logos
+                
+                # Lazily loaded pages without a logo can drop their images again
+                if isinstance(page_data, LazyPage):
+                    if images_to_replace or vector_logos:
+                        page_data.mark_modified()
+                    else:
+                        page_data.release()
                 
                 # Replace detected logos
                 for img_index in images_to_replace:
                     if img_index < len(page_data['images']):
                         # Convert new logo to appropriate size
-                        old_bbox = page_data['images'][img_index].get('bbox')
+                        img_data = page_data['images'][img_index]
+                        old_bbox = img_data.get('bbox')
                         if old_bbox:
                             width = old_bbox[2] - old_bbox[0]
                             height = old_bbox[3] - old_bbox[1]
                             
-                            # Resize logo to fit
-                            resized_logo = logo_img.resize(
-                                (int(width), int(height)),
-                                Image.Resampling.LANCZOS
-                            )
-                            
-                            # Convert to bytes
-                            img_byte_arr = io.BytesIO()
-                            resized_logo.save(img_byte_arr, format='PNG')
-                            
                             # Replace image data
-                            page_data['images'][img_index]['data'] = img_byte_arr.getvalue()
+                            img_data['rendition'], img_data['data'] = self.logo_renditions.get(
+                                logo_digest, width, height, self._background_mode(pdf_data, img_data)
+                            )
+                            img_data['replaced'] = True
             
             return pdf_data
             
@@ -213,6 +683,32 @@ class PDFProcessor:
             logger.error(f"Error replacing logo: {e}")
             return pdf_data
     
+    def _background_mode(self, pdf_data: Dict[str, Any], img_data: Dict[str, Any]) -> str:
+        """Keep the new logo transparent only where the old one was"""
+        image_cache = pdf_data.get('image_cache')
+        xref = img_data.get('xref')
+        if image_cache is None or not xref:
+            return RENDITION_ALPHA
+        return RENDITION_ALPHA if image_cache.stream(xref).get('smask') else RENDITION_OPAQUE
+    
+    def _match_logo(self, pdf_data: Dict[str, Any], img_data: Dict[str, Any],
+                    detector: LogoDetector) -> bool:
+        """Classify one image against the logo index, labelling it on a match"""
+        image_cache = pdf_data.get('image_cache')
+        xref = img_data.get('xref')
+        if image_cache is not None and xref:
+            stream = image_cache.stream(xref)
+            mask = image_cache.data(stream['smask']) if stream.get('smask') else None
+            match = detector.classify(stream['image'], mask,
+                                      fallback=lambda: image_cache.png(xref))
+        else:
+            match = detector.classify(img_data['data'])
+        
+        if match is None:
+            return False
+        img_data['logo'] = match['label']
+        return True
+    
     def extract_text_with_positions(self, pdf_path: Path) -> List[Dict]:
         """Extract text with position information for precise replacement"""
         text_elements = []
@@ -244,92 +740,40 @@ class PDFProcessor:
         
         return text_elements
     
-    def merge_pdfs(self, pdf_files: List[Path], output_path: Path):
-        """Merge multiple PDF files into one"""
+    def merge_pdfs(self, pdf_files: List[Path], output_path: Path, toc: bool = True,
+                   titles: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Merge multiple PDF files into one (see PDFMerger)"""
         try:
-            pdf_writer = PdfWriter()
-            
-            for pdf_file in pdf_files:
-                pdf_reader = PdfReader(str(pdf_file))
-                for page in pdf_reader.pages:
-                    pdf_writer.add_page(page)
-            
-            with open(output_path, 'wb') as output_file:
-                pdf_writer.write(output_file)
-            
-            logger.info(f"Merged {len(pdf_files)} PDFs into {output_path}")
+            return PDFMerger(toc=toc).merge(pdf_files, output_path, titles)
             
         except Exception as e:
             logger.error(f"Error merging PDFs: {e}")
             raise
     
     def add_watermark(self, pdf_path: Path, watermark_text: str, output_path: Path):
-        """Add watermark to PDF pages"""
+        """Add watermark to PDF pages (see Watermark)"""
         try:
-            # Create watermark PDF
-            watermark_pdf = tempfile.NamedTemporaryFile(suffix='.pdf', delete=False)
-            c = canvas.Canvas(watermark_pdf.name, pagesize=A4)
-            c.setFont("Helvetica", 50)
-            c.setFillAlpha(0.1)
-            c.saveState()
-            c.translate(300, 400)
-            c.rotate(45)
-            c.drawCentredString(0, 0, watermark_text)
-            c.restoreState()
-            c.save()
-            
-            # Apply watermark
-            pdf_reader = PdfReader(str(pdf_path))
-            watermark_reader = PdfReader(watermark_pdf.name)
-            pdf_writer = PdfWriter()
-            
-            watermark_page = watermark_reader.pages[0]
-            
-            for page in pdf_reader.pages:
-                page.merge_page(watermark_page)
-                pdf_writer.add_page(page)
-            
-            with open(output_path, 'wb') as output_file:
-                pdf_writer.write(output_file)
-            
-            # Cleanup
-            os.unlink(watermark_pdf.name)
+            doc = fitz.open(str(pdf_path))
+            pages = Watermark(watermark_text).apply(doc)
+            doc.save(str(output_path), garbage=3, deflate=True)
+            doc.close()
             
-            logger.info(f"Added watermark to {output_path}")
+            logger.info(f"Added watermark to {pages} pages of {output_path}")
             
         except Exception as e:
             logger.error(f"Error adding watermark: {e}")
             raise
     
-    def optimize_pdf(self, pdf_path: Path, output_path: Path, quality: str = 'standard'):
-        """Optimize PDF file size and quality"""
+    def optimize_pdf(self, pdf_path: Path, output_path: Path, quality: str = 'standard') -> Dict[str, Any]:
+        """Optimize PDF file size and quality (see PDFOptimizer)"""
         try:
-            doc = fitz.open(str(pdf_path))
-            
-            # Set compression based on quality
-            compression_settings = {
-                'low': {'deflate': True, 'garbage': 4, 'clean': True},
-                'standard': {'deflate': True, 'garbage': 3, 'clean': False},
-                'high': {'deflate': False, 'garbage': 0, 'clean': False}
-            }
-            
-            settings = compression_settings.get(quality, compression_settings['standard'])
-            
-            # Save with optimization
-            doc.save(
-                str(output_path),
-                deflate=settings['deflate'],
-                garbage=settings['garbage'],
-                clean=settings['clean']
-            )
-            doc.close()
+            with PDFOptimizer(quality=quality, workers=1) as optimizer:
+                report = optimizer.optimize(pdf_path, output_path)
             
             # Report file size reduction
-            original_size = pdf_path.stat().st_size
-            new_size = output_path.stat().st_size
-            reduction = (1 - new_size/original_size) * 100
-            
+            reduction = (1 - report['optimized_size'] / report['original_size']) * 100
             logger.info(f"PDF optimized: {reduction:.1f}% size reduction")
+            return report
             
         except Exception as e:
             logger.error(f"Error optimizing PDF: {e}")
@@ -370,4 +814,353 @@ class PDFProcessor:
             if os.path.exists(self.temp_dir):
                 shutil.rmtree(self.temp_dir)
         except Exception as e:
-            logger.warning(f"Could not clean up temp files: {e}")
\ No newline at end of file
+            logger.warning(f"Could not clean up temp files: {e}")
+
+
+# State of a PagePool worker process: its replacer and the document it has open
+_page_worker: Dict[str, Any] = {}
+
+
+def _init_page_worker(replacer: TextReplacer, triage: bool):
+    """Set up a PagePool worker process"""
+    _page_worker.update(replacer=replacer, triage=triage, processor=PDFProcessor())
+
+
+def _replace_page_chunk(task: Tuple[Path, int, int]) -> Dict[str, Any]:
+    """Replace text on one chunk of pages, opening the document on first use"""
+    path, start, stop = task
+    pdf_data = _page_worker.get('pdf_data')
+    processor = _page_worker['processor']
+    if pdf_data is None or pdf_data['path'] != path:
+        if pdf_data is not None:
+            processor.close_pdf(pdf_data)
+        pdf_data = processor.load_pdf(path)
+        _page_worker['pdf_data'] = pdf_data
+    return _page_worker['replacer'].replace_page_range(pdf_data, start, stop, _page_worker['triage'])
+
+
+class PagePool:
+    """Process pool that splits the pages of one document into chunks
+    
+    PyMuPDF documents must not be shared between threads or processes, so
+    every worker opens the document itself, once per document, and keeps
+    it open for its following chunks. Workers are started with ``spawn``
+    rather than forked from a process holding open documents. The pool is
+    created on first use and reused across documents until close().
+    """
+    
+    def __init__(self, replacer: TextReplacer, workers: int = 0, chunk_size: int = 16,
+                 triage: bool = True):
+        """Configure a pool of ``workers`` processes (0 = one per CPU)"""
+        self.replacer = replacer
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = max(1, chunk_size)
+        self.triage = triage
+        self._executor: Optional[ProcessPoolExecutor] = None
+    
+    @classmethod
+    def from_config(cls, replacer: TextReplacer, processing: Dict[str, Any]) -> Optional['PagePool']:
+        """Create a pool from the ``processing`` config section, None if serial"""
+        workers = processing.get('workers', 1)
+        if workers == 1:
+            return None
+        return cls(replacer, workers, processing.get('chunk_size', 16),
+                   processing.get('triage', True))
+    
+    def chunks(self, page_count: int) -> List[Tuple[int, int]]:
+        """(start, stop) page ranges of at most ``chunk_size`` pages"""
+        return [(start, min(start + self.chunk_size, page_count))
+                for start in range(0, page_count, self.chunk_size)]
+    
+    def map(self, pdf_path: Path, page_count: int) -> Iterator[Dict[str, Any]]:
+        """Chunk results of replace_page_range over the whole document, in page order"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_page_worker,
+                initargs=(self.replacer, self.triage)
+            )
+        tasks = [(Path(pdf_path), start, stop) for start, stop in self.chunks(page_count)]
+        return self._executor.map(_replace_page_chunk, tasks)
+    
+    def close(self):
+        """Stop the worker processes"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+    
+    def __enter__(self) -> 'PagePool':
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class LazyPage(MutableMapping):
+    """One page of an open document, extracted on first access
+    
+    Behaves like the page dicts TextReplacer and PDFProcessor work on
+    (``number``, ``width``, ``height``, ``text``, ``blocks``, ``images``,
+    ``links``), but each extracted key is only computed when first read.
+    release() drops the extracted data again unless the page is modified:
+    assigning an extracted key marks it so, and callers that change nested
+    values (span dicts, image dicts) call mark_modified() themselves.
+    """
+    
+    EXTRACTED_KEYS = ('width', 'height', 'text', 'blocks', 'images', 'links')
+    
+    def __init__(self, doc: 'fitz.Document', index: int,
+                 image_cache: Optional['ImageCache'] = None):
+        """Bind to page ``index`` of ``doc`` without extracting anything"""
+        self.doc = doc
+        self.index = index
+        self.image_cache = image_cache if image_cache is not None else ImageCache(doc)
+        self.modified = False
+        self._data: Dict[str, Any] = {'number': index + 1}
+        self._page = None
+        self._textpage = None
+    
+    @property
+    def page(self) -> 'fitz.Page':
+        """The underlying PyMuPDF page, loaded on demand"""
+        if self._page is None:
+            self._page = self.doc[self.index]
+        return self._page
+    
+    def _textpage_for_page(self):
+        """Text page shared by the plain-text and span extraction"""
+        if self._textpage is None:
+            self._textpage = self.page.get_textpage()
+        return self._textpage
+    
+    def _extract(self, key: str) -> Any:
+        """Compute one extracted key"""
+        if key == 'width':
+            return self.page.rect.width
+        if key == 'height':
+            return self.page.rect.height
+        if key == 'text':
+            return self.page.get_text(textpage=self._textpage_for_page())
+        if key == 'links':
+            # URLs and emails, checked against the replacement edits later
+            text = self['text']
+            return index_links(text) if isinstance(text, str) else []
+        if key == 'blocks':
+            return self._extract_blocks()
+        return self._extract_images()
+    
+    def _extract_blocks(self) -> List[Dict[str, Any]]:
+        """Text spans with positions"""
+        return extract_spans(self.page, self._textpage_for_page())
+    
+    def _extract_images(self) -> List['ImageRef']:
+        """Placements of images on the page, referenced by xref without decoding
+        
+        get_image_info(xrefs=True) decodes every image to match placements
+        to xrefs by digest. Pixel sizes are enough unless two images on the
+        page share one, so the digest route is only taken then.
+        """
+        sizes: Dict[Tuple[int, int], set] = {}
+        for item in self.page.get_images(full=True):
+            sizes.setdefault((item[2], item[3]), set()).add(item[0])
+        
+        if any(len(xrefs) > 1 for xrefs in sizes.values()):
+            infos = self.page.get_image_info(xrefs=True)
+        else:
+            infos = []
+            for info in self.page.get_image_info():
+                xrefs = sizes.get((info['width'], info['height']))
+                infos.append(dict(info, xref=next(iter(xrefs)) if xrefs else 0))
+        
+        images = []
+        for info in infos:
+            if not info.get('xref'):
+                continue  # Inline image, not addressable by xref
+            images.append(ImageRef(self.image_cache, len(images), info))
+        return images
+    
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._data:
+            if key not in self.EXTRACTED_KEYS:
+                raise KeyError(key)
+            self._data[key] = self._extract(key)
+        return self._data[key]
+    
+    def __setitem__(self, key: str, value: Any):
+        if key == 'text' and 'links' not in self._data and 'text' in self._data:
+            # Links index the text the edits were computed against
+            self._data['links'] = self._extract('links')
+        if key in self.EXTRACTED_KEYS:
+            self.modified = True
+        self._data[key] = value
+    
+    def __delitem__(self, key: str):
+        del self._data[key]
+    
+    def __iter__(self):
+        yield from self._data
+        for key in self.EXTRACTED_KEYS:
+            if key not in self._data:
+                yield key
+    
+    def __len__(self) -> int:
+        return len(set(self._data) | set(self.EXTRACTED_KEYS))
+    
+    def is_loaded(self, key: str) -> bool:
+        """Whether ``key`` has been extracted or assigned"""
+        return key in self._data
+    
+    def mark_modified(self):
+        """Keep the extracted data on release(); it holds changes to save"""
+        self.modified = True
+    
+    def release(self, force: bool = False):
+        """Drop extracted data of an unmodified page (or any page with ``force``)"""
+        if self.modified and not force:
+            return
+        for key in self.EXTRACTED_KEYS:
+            self._data.pop(key, None)
+        self._textpage = None
+        self._page = None
+
+
+class ImageCache:
+    """Image streams and pixels of one document, each xref fetched at most once
+    
+    ``data`` is the image's original compressed stream as stored in the
+    PDF (JPEG, JPX, ...), suitable for passing through unchanged. Stages
+    that need pixels use ``pixmap``/``png``, which decode once and convert
+    CMYK and other colour spaces to RGB.
+    """
+    
+    def __init__(self, doc: 'fitz.Document'):
+        """Create an empty cache for ``doc``"""
+        self.doc = doc
+        self._streams: Dict[int, Dict[str, Any]] = {}
+        self._pixmaps: Dict[int, 'fitz.Pixmap'] = {}
+        self.decodes = 0
+    
+    def stream(self, xref: int) -> Dict[str, Any]:
+        """extract_image() result for ``xref``"""
+        if xref not in self._streams:
+            self._streams[xref] = self.doc.extract_image(xref)
+        return self._streams[xref]
+    
+    def data(self, xref: int) -> bytes:
+        """Original image bytes of ``xref``"""
+        return self.stream(xref)['image']
+    
+    def pixmap(self, xref: int) -> 'fitz.Pixmap':
+        """Decoded RGB (or gray) pixels of ``xref``, alpha kept"""
+        pix = self._pixmaps.get(xref)
+        if pix is None:
+            pix = fitz.Pixmap(self.doc, xref)
+            self.decodes += 1
+            if pix.colorspace is not None and pix.colorspace.n > 3:
+                pix = fitz.Pixmap(fitz.csRGB, pix)  # CMYK
+            self._pixmaps[xref] = pix
+        return pix
+    
+    def png(self, xref: int) -> bytes:
+        """PNG encoding of the decoded pixels of ``xref``"""
+        return self.pixmap(xref).tobytes("png")
+    
+    def clear(self):
+        """Drop all cached streams and pixels"""
+        self._streams.clear()
+        self._pixmaps.clear()
+
+
+class LogoRenditionCache:
+    """Resized PNG renditions of replacement logos, shared across documents
+    
+    Renditions are keyed by (source digest, pixel size, background mode),
+    so each is resized and encoded once per batch however many pages and
+    documents place it. The key doubles as the identity the savers use to
+    embed a rendition only once per output document.
+    """
+    
+    def __init__(self):
+        """Create an empty cache"""
+        self._sources: Dict[str, Image.Image] = {}
+        self._renditions: Dict[Tuple[str, int, int, str], bytes] = {}
+        self.hits = 0
+        self.misses = 0
+    
+    def load(self, logo_path: Path) -> str:
+        """Digest of a logo file, decoding it on first use"""
+        data = Path(logo_path).read_bytes()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest not in self._sources:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+            self._sources[digest] = image
+        return digest
+    
+    def get(self, digest: str, width: float, height: float,
+            background: str = RENDITION_ALPHA) -> Tuple[Tuple[str, int, int, str], bytes]:
+        """(key, PNG bytes) of the logo ``digest`` resized to fit ``width`` x ``height``"""
+        key = (digest, max(1, int(width)), max(1, int(height)), background)
+        data = self._renditions.get(key)
+        if data is not None:
+            self.hits += 1
+            return key, data
+        
+        self.misses += 1
+        resized_logo = self._sources[digest].resize(key[1:3], Image.Resampling.LANCZOS)
+        if background == RENDITION_OPAQUE:
+            # Opaque images need no soft mask; flatten onto white paper
+            resized_logo = resized_logo.convert('RGBA')
+            paper = Image.new('RGBA', resized_logo.size, (255, 255, 255, 255))
+            resized_logo = Image.alpha_composite(paper, resized_logo).convert('RGB')
+        
+        img_byte_arr = io.BytesIO()
+        resized_logo.save(img_byte_arr, format='PNG')
+        data = img_byte_arr.getvalue()
+        self._renditions[key] = data
+        return key, data
+    
+    def info(self) -> Dict[str, int]:
+        """Counters for the processing report"""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._renditions)}
+
+
+class ImageRef(MutableMapping):
+    """One placement of an image on a page, referring to its xref
+    
+    Holds ``index``, ``xref``, ``bbox``, ``width``, ``height`` and
+    ``colorspace``; ``data`` is read from the image cache on first access
+    as the original stream. Stages that replace the image assign ``data``.
+    """
+    
+    def __init__(self, image_cache: ImageCache, index: int, info: Dict[str, Any]):
+        """Create a reference from a get_image_info() entry"""
+        self.image_cache = image_cache
+        self._data: Dict[str, Any] = {
+            'index': index,
+            'xref': info['xref'],
+            'bbox': tuple(info['bbox']),
+            'width': info.get('width'),
+            'height': info.get('height'),
+            'colorspace': info.get('cs-name')
+        }
+    
+    def __getitem__(self, key: str) -> Any:
+        if key == 'data' and key not in self._data:
+            return self.image_cache.data(self._data['xref'])
+        return self._data[key]
+    
+    def __setitem__(self, key: str, value: Any):
+        self._data[key] = value
+    
+    def __delitem__(self, key: str):
+        del self._data[key]
+    
+    def __iter__(self):
+        yield from self._data
+        if 'data' not in self._data:
+            yield 'data'
+    
+    def __len__(self) -> int:
+        return len(self._data) + ('data' not in self._data)
@@ -61,16 +61,12 @@ def process_pdf_as_text(pdf_path):
     
     print(f"💾 Saved extracted text to: {text_path}")
     
-    # Apply our brand replacement logic
-    from demo_processor import DemoTextReplacer
+    # Apply our brand replacement logic, streaming from the saved text file
+    from demo_processor import DemoTextReplacer, read_sample_lines
     replacer = DemoTextReplacer()
     
-    processed_text, changes = replacer.process_text(extracted_text)
-    
-    # Save processed text
     output_path = Path("output") / f"Chiral_{Path(pdf_path).stem}_PDF_Processed.txt"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(processed_text)
+    changes = replacer.process_file(text_path, output_path)
     
     print(f"✅ Processed PDF content saved to: {output_path}")
     print(f"📈 Total changes made: {changes}")
@@ -78,11 +74,11 @@ def process_pdf_as_text(pdf_path):
     # Show sample of changes
     print(f"\n📋 Sample of processed content:")
     print("-" * 40)
-    lines = processed_text.split('\n')[:10]
-    for line in lines:
+    lines = read_sample_lines(output_path, 11)
+    for line in lines[:10]:
         if line.strip():
             print(f"   {line}")
-    if len(processed_text.split('\n')) > 10:
+    if len(lines) > 10:
         print("   ...")
     
     return True
@@ -7,7 +7,7 @@ import os
 import subprocess
 import tempfile
 from pathlib import Path
-from demo_processor import DemoTextReplacer
+from demo_processor import DemoTextReplacer, read_sample_lines
 
 def try_pdf_to_text(pdf_path):
     """Try multiple methods to extract text from PDF"""
@@ -124,14 +124,10 @@ def process_single_real_pdf(pdf_path):
         f.write(extracted_text)
     print(f"💾 Saved extracted text: {text_path}")
     
-    # Apply CHIRAL brand replacements
+    # Apply CHIRAL brand replacements, streaming from the saved text file
     replacer = DemoTextReplacer()
-    processed_text, changes = replacer.process_text(extracted_text)
-    
-    # Save processed result
     output_path = Path("output") / f"Chiral_{pdf_path.stem}_PDF_Processed.txt"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(processed_text)
+    changes = replacer.process_file(text_path, output_path)
     
     print(f"✅ Processed file saved: {output_path}")
     print(f"📈 Brand changes made: {changes}")
@@ -140,8 +136,7 @@ def process_single_real_pdf(pdf_path):
     if changes > 0:
         print(f"\n📋 Preview of processed content:")
         print("-" * 40)
-        lines = processed_text.split('\n')[:8]
-        for line in lines:
+        for line in read_sample_lines(output_path, 8):
             if line.strip() and len(line.strip()) > 5:
                 print(f"   {line.strip()[:80]}...")
         print("-" * 40)
@@ -0,0 +1,158 @@
+"""
+Rule Cache Module - Stores compiled rule sets on disk keyed by config hash
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import unicodedata
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+from text_replacer import RuleMatcher, ProductNamer, merge_rules
+
+logger = logging.getLogger(__name__)
+
+# Bump when the artifact layout or the way rule tables are derived changes
+CACHE_VERSION = 2
+
+# Config sections that affect the compiled rule set
+CACHED_SECTIONS = ('text_replacements', 'product_naming', 'language_settings')
+
+# Next to the package, so every entry point and working directory shares it
+DEFAULT_CACHE_DIR = Path(__file__).resolve().parent / ".cache" / "rules"
+
+# Config digest -> rule set loaded or compiled in this process
+_rule_sets: Dict[str, 'CompiledRuleSet'] = {}
+
+
+def config_digest(config: Dict[str, Any]) -> str:
+    """Hash of the config sections that the compiled rule set depends on
+
+    The artifact version and the Unicode version used to normalise rule
+    keys are part of the hash, so neither an older layout nor keys
+    normalised by another Python are ever read back.
+    """
+    relevant = {section: config.get(section) for section in CACHED_SECTIONS}
+    payload = json.dumps(
+        {'version': CACHE_VERSION, 'unicode': unicodedata.unidata_version, 'config': relevant},
+        sort_keys=True,
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CompiledRuleSet:
+    """Compiled replacement rules, product naming and Chinese rules for one config
+
+    The matcher covers the main rules and, when Chinese support is on, the
+    Chinese rules as well; main rules win on duplicate keys.
+    """
+
+    def __init__(self, rules: Dict[str, str], product_naming: Dict[str, Any],
+                 chinese_rules: Dict[str, str], matcher: RuleMatcher,
+                 namer: ProductNamer, digest: str):
+        """Initialize from already compiled parts"""
+        self.rules = rules
+        self.product_naming = product_naming
+        self.chinese_rules = chinese_rules
+        self.matcher = matcher
+        self.namer = namer
+        self.digest = digest
+
+    @classmethod
+    def from_config(cls, config: Dict[str, Any]) -> 'CompiledRuleSet':
+        """Compile a rule set from a loaded configuration"""
+        rules = dict(config.get('text_replacements', {}))
+        naming = config.get('product_naming', {})
+        product_naming = {
+            'remove_prefix': list(naming.get('remove_prefix', [])),
+            'add_prefix': naming.get('add_prefix', 'Chiral'),
+            'model_names': list(naming.get('model_names', []))
+        }
+        language = config.get('language_settings', {})
+        chinese_rules = dict(language.get('chinese_replacements', {}))
+        if language.get('support_chinese', True):
+            matcher = RuleMatcher(merge_rules(rules, chinese_rules))
+        else:
+            matcher = RuleMatcher(rules)
+
+        return cls(rules, product_naming, chinese_rules, matcher,
+                   ProductNamer.from_config(product_naming), config_digest(config))
+
+    def to_dict(self) -> Dict[str, Any]:
+        """JSON form of the rule set: rule tables and pattern sources, no pickles"""
+        return {
+            'version': CACHE_VERSION,
+            'digest': self.digest,
+            'rules': self.rules,
+            'product_naming': self.product_naming,
+            'chinese_rules': self.chinese_rules,
+            'matcher': self.matcher.to_dict(),
+            'namer': self.namer.to_dict()
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'CompiledRuleSet':
+        """Rebuild a rule set from a cached artifact"""
+        return cls(
+            data['rules'],
+            data['product_naming'],
+            data['chinese_rules'],
+            RuleMatcher.from_dict(data['matcher']),
+            ProductNamer.from_dict(data['namer']),
+            data['digest']
+        )
+
+
+def load_rule_set(config: Dict[str, Any], cache_dir: Optional[Path] = None) -> CompiledRuleSet:
+    """Return the compiled rule set for a config, using the on-disk cache when valid
+
+    Within a process every caller shares one rule set per config. A new
+    process reads the artifact written by an earlier run instead of
+    deriving the rule tables again; only the patterns its text actually
+    routes to are compiled, on first use. Any change to the relevant
+    config sections gives a new key, so stale artifacts are never read.
+    """
+    digest = config_digest(config)
+    rule_set = _rule_sets.get(digest)
+    if rule_set is not None:
+        return rule_set
+
+    cache_dir = Path(cache_dir) if cache_dir is not None else DEFAULT_CACHE_DIR
+    cache_file = cache_dir / f"ruleset_{digest[:16]}.json"
+
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') == CACHE_VERSION and data.get('digest') == digest:
+            rule_set = CompiledRuleSet.from_dict(data)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Ignoring unreadable rule cache {cache_file}: {e}")
+
+    if rule_set is None:
+        rule_set = CompiledRuleSet.from_config(config)
+        _write_artifact(rule_set, cache_file)
+
+    _rule_sets[digest] = rule_set
+    return rule_set
+
+
+def _write_artifact(rule_set: CompiledRuleSet, cache_file: Path):
+    """Write a rule set artifact atomically, so concurrent runs never read a partial file"""
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=str(cache_file.parent), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(rule_set.to_dict(), f, ensure_ascii=False)
+            os.replace(tmp_path, cache_file)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+    except OSError as e:
+        logger.warning(f"Could not write rule cache {cache_file}: {e}")
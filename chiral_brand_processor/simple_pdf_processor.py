@@ -53,14 +53,10 @@ def process_real_pdf(pdf_path):
         f.write(text)
     print(f"💾 Saved: {extract_path}")
     
-    # Apply brand processing
+    # Apply brand processing, streaming from the saved text file
     replacer = DemoTextReplacer()
-    processed, changes = replacer.process_text(text)
-    
-    # Save processed result
     output_path = Path("output") / f"Chiral_{pdf_path.stem}_Real.txt"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(processed)
+    changes = replacer.process_file(extract_path, output_path)
     
     print(f"✅ Processed: {output_path}")
     print(f"📈 Changes: {changes}")
@@ -11,14 +11,21 @@ import unittest
 from pathlib import Path
 from unittest.mock import Mock, patch, MagicMock
 import shutil
+import fitz
 
 # Add the current directory to the path
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
 from main import ChiralBrandProcessor
-from pdf_processor import PDFProcessor
-from text_replacer import TextReplacer
+from pdf_processor import PDFProcessor, PagePool
+from text_replacer import TextReplacer, EditScript
 from logo_generator import LogoGenerator
+import rule_cache
+from rule_cache import load_rule_set, config_digest
+from fuzzy_matcher import FuzzyBrandMatcher
+from link_validator import LinkValidator, index_links
+from logo_detector import LogoDetector
+from pdf_optimizer import PDFOptimizer
 
 class TestChiralBrandProcessor(unittest.TestCase):
     """Test the main brand processor"""
@@ -149,6 +156,368 @@ class TestPDFProcessor(unittest.TestCase):
         self.assertIn('metadata', result)
         self.assertEqual(len(result['pages']), 1)
     
+    def test_in_place_save_touches_only_changed_pages(self):
+        """Test that only pages with edits are rewritten on save"""
+        source = Path(self.test_dir) / "source.pdf"
+        doc = fitz.open()
+        doc.new_page().insert_text((72, 72), "Made by DEEP Robotics", fontsize=12)
+        doc.new_page().insert_text((72, 72), "Specifications", fontsize=12)
+        doc.save(str(source))
+        doc.close()
+        
+        pdf_data = self.processor.load_pdf(source)
+        TextReplacer({"DEEP Robotics": "CHIRAL"}).replace_all(pdf_data)
+        output = Path(self.test_dir) / "output.pdf"
+        self.processor.save_pdf(pdf_data, output)
+        
+        original = fitz.open(str(source))
+        result = fitz.open(str(output))
+        self.assertIn("Made by CHIRAL", result[0].get_text())
+        self.assertNotIn("DEEP", result[0].get_text())
+        self.assertEqual(result[1].read_contents(), original[1].read_contents())
+        original.close()
+        result.close()
+    
+    def test_in_place_save_keeps_neighbouring_lines(self):
+        """Test that redacting a changed line spares the lines its box overlaps"""
+        source = Path(self.test_dir) / "source.pdf"
+        lines = ["Quadruped robots for industry", "Made by DEEP Robotics", "Quality assured since 2017"]
+        doc = fitz.open()
+        page = doc.new_page()
+        for number, line in enumerate(lines):
+            # 12pt text on 12pt leading: the font boxes of the lines overlap
+            page.insert_text((72, 72 + 12 * number), line, fontsize=12)
+        doc.save(str(source))
+        doc.close()
+        
+        pdf_data = self.processor.load_pdf(source)
+        boxes = [fitz.Rect(span['bbox']) for span in pdf_data['pages'][0]['blocks']]
+        self.assertTrue(boxes[0].intersects(boxes[1]) and boxes[1].intersects(boxes[2]))
+        TextReplacer({"DEEP Robotics": "CHIRAL"}).replace_all(pdf_data)
+        output = Path(self.test_dir) / "output.pdf"
+        self.processor.save_pdf(pdf_data, output)
+        self.processor.close_pdf(pdf_data)
+        
+        result = fitz.open(str(output))
+        self.assertEqual(result[0].get_text(sort=True).split("\n")[:3],
+                         ["Quadruped robots for industry", "Made by CHIRAL", "Quality assured since 2017"])
+        result.close()
+        
+        # A neighbour that cannot be spared is drawn again from its text
+        pdf_data = self.processor.load_pdf(source)
+        TextReplacer({"DEEP Robotics": "CHIRAL"}).replace_all(pdf_data)
+        with patch.object(PDFProcessor, '_clip_box', side_effect=lambda box, spans: box):
+            self.processor.save_pdf(pdf_data, output)
+        self.processor.close_pdf(pdf_data)
+        
+        result = fitz.open(str(output))
+        text = result[0].get_text()
+        for line in ("Quadruped robots for industry", "Made by CHIRAL", "Quality assured since 2017"):
+            self.assertIn(line, text)
+        self.assertNotIn("DEEP", text)
+        result.close()
+    
+    def test_in_place_save_leaves_font_subsetting_to_optimizer(self):
+        """Test that saving does not subset fonts and the optimizer does"""
+        source = Path(self.test_dir) / "source.pdf"
+        doc = fitz.open()
+        doc.new_page().insert_text((72, 72), "DEEP Robotics quadruped", fontsize=12)
+        doc.save(str(source))
+        doc.close()
+        
+        pdf_data = self.processor.load_pdf(source)
+        TextReplacer({"DEEP Robotics": "绮光机器人"}).replace_all(pdf_data)
+        draft = Path(self.test_dir) / "draft.pdf"
+        with patch.object(fitz.Document, 'subset_fonts', side_effect=AssertionError("fonts subset")):
+            self.processor.save_pdf(pdf_data, draft)
+        self.processor.close_pdf(pdf_data)
+        
+        # The CJK replacement font is embedded whole until the optimizer runs
+        output = Path(self.test_dir) / "output.pdf"
+        report = PDFOptimizer(workers=1).optimize(draft, output)
+        self.assertGreater(report['saved']['fonts'], 1000000)
+        with fitz.open(str(output)) as result:
+            self.assertIn("绮光机器人 quadruped", result[0].get_text())
+    
+    def test_incremental_save_appends_to_mapped_input(self):
+        """Test memory-mapped loading and incremental versus full saves"""
+        source = Path(self.test_dir) / "source.pdf"
+        doc = fitz.open()
+        doc.new_page().insert_text((72, 72), "Made by DEEP Robotics", fontsize=12)
+        doc.new_page().insert_text((72, 72), "Specifications", fontsize=12)
+        doc.save(str(source))
+        doc.close()
+        original = source.read_bytes()
+        
+        outputs = {}
+        for compression in ('incremental', 'standard'):
+            processor = PDFProcessor(mmap_threshold_mb=0, compression=compression)
+            pdf_data = processor.load_pdf(source)
+            self.assertIsInstance(pdf_data['mapped'], memoryview)
+            TextReplacer({"DEEP Robotics": "CHIRAL"}).replace_all(pdf_data)
+            outputs[compression] = Path(self.test_dir) / f"{compression}.pdf"
+            processor.save_pdf(pdf_data, outputs[compression])
+            processor.close_pdf(pdf_data)
+            self.assertNotIn('mapped', pdf_data)
+            processor.cleanup()
+            
+            result = fitz.open(str(outputs[compression]))
+            self.assertIn("Made by CHIRAL", result[0].get_text())
+            self.assertEqual(result[1].get_text().strip(), "Specifications")
+            result.close()
+        
+        # The incremental output is the input plus an update section
+        incremental = outputs['incremental'].read_bytes()
+        self.assertTrue(incremental.startswith(original))
+        self.assertGreater(len(incremental), len(original))
+        self.assertFalse(outputs['standard'].read_bytes().startswith(original))
+        self.assertEqual(source.read_bytes(), original)
+        
+        # A failed edit leaves neither an unbranded copy nor a temporary file
+        for compression in ('incremental', 'standard'):
+            processor = PDFProcessor(compression=compression)
+            pdf_data = processor.load_pdf(source)
+            TextReplacer({"DEEP Robotics": "CHIRAL"}).replace_all(pdf_data)
+            failed = Path(self.test_dir) / f"failed_{compression}.pdf"
+            with patch.object(PDFProcessor, '_insert_span', side_effect=RuntimeError("font")):
+                with self.assertRaises(RuntimeError):
+                    processor.save_pdf(pdf_data, failed)
+            processor.close_pdf(pdf_data)
+            processor.cleanup()
+            self.assertFalse(failed.exists())
+        self.assertEqual(sorted(path.name for path in Path(self.test_dir).iterdir()),
+                         ["incremental.pdf", "source.pdf", "standard.pdf"])
+    
+    def test_lazy_pages(self):
+        """Test that pages extract on first access and release unchanged data"""
+        source = Path(self.test_dir) / "lazy.pdf"
+        doc = fitz.open()
+        for text in ("DEEP Robotics", "Payload 10 kg"):
+            doc.new_page().insert_text((72, 72), text, fontsize=12)
+        doc.save(str(source))
+        doc.close()
+        
+        pdf_data = self.processor.load_pdf(source)
+        first, second = pdf_data['pages']
+        self.assertFalse(first.is_loaded('text'))
+        self.assertEqual(first['number'], 1)
+        self.assertIn("DEEP Robotics", first['text'])
+        self.assertEqual(first['blocks'][0]['text'], "DEEP Robotics")
+        
+        TextReplacer({"DEEP Robotics": "CHIRAL"}).replace_all(pdf_data)
+        
+        # The edited page keeps its changes, the untouched one is released
+        self.assertTrue(first.modified)
+        self.assertEqual(first['blocks'][0]['text'], "CHIRAL")
+        self.assertFalse(second.is_loaded('text'))
+        self.assertIn("Payload", second['text'])
+        
+        self.processor.close_pdf(pdf_data)
+        self.assertNotIn('document', pdf_data)
+    
+    def test_triage_passes_untouched_pages_through(self):
+        """Test that pages without hits skip span extraction and replacement"""
+        source = Path(self.test_dir) / "triage.pdf"
+        doc = fitz.open()
+        for text in ("Payload 10 kg", "Jueying Lite3", "Runtime 2 h"):
+            doc.new_page().insert_text((72, 72), text, fontsize=12)
+        doc.save(str(source))
+        doc.close()
+        
+        replacer = TextReplacer({"DEEP Robotics": "CHIRAL"})
+        pdf_data = self.processor.load_pdf(source)
+        triage = self.processor.triage(pdf_data, replacer.has_hits)
+        
+        # Product naming counts as a hit even without rule matches
+        self.assertEqual(triage['hit_pages'], [2])
+        self.assertEqual(triage['pass_through'], 2)
+        
+        replacer.replace_all(pdf_data)
+        first, second, _ = pdf_data['pages']
+        self.assertTrue(first['pass_through'])
+        self.assertFalse(first.is_loaded('blocks'))
+        self.assertEqual(second['blocks'][0]['text'], "Chiral Lite3")
+        self.processor.close_pdf(pdf_data)
+        
+        # Logos in the header of pages without text hits are still replaced
+        from PIL import Image
+        header = Path(self.test_dir) / "header.png"
+        Image.new('RGB', (200, 60), (200, 30, 30)).save(header)
+        doc = fitz.open(str(source))
+        doc[0].insert_image(fitz.Rect(72, 20, 172, 50), filename=str(header))
+        doc.save(str(source), incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        doc.close()
+        logo = Path(self.test_dir) / "logo.png"
+        Image.new('RGB', (200, 60), (30, 58, 95)).save(logo)
+        
+        pdf_data = self.processor.load_pdf(source)
+        self.processor.triage(pdf_data, replacer.has_hits)
+        replacer.replace_all(pdf_data)
+        self.processor.replace_logo(pdf_data, logo)
+        self.assertTrue(pdf_data['pages'][0]['pass_through'])
+        self.assertTrue(pdf_data['pages'][0]['images'][0]['replaced'])
+        output = Path(self.test_dir) / "triage_out.pdf"
+        self.processor.save_pdf(pdf_data, output)
+        self.processor.close_pdf(pdf_data)
+        
+        result = fitz.open(str(output))
+        pixel = result[0].get_pixmap(clip=fitz.Rect(110, 30, 130, 40)).pixel(5, 5)
+        self.assertEqual(pixel, (30, 58, 95))
+        self.assertEqual(result[0].get_text().strip(), "Payload 10 kg")
+        result.close()
+    
+    def test_page_pool_matches_serial_processing(self):
+        """Test that pages replaced in worker processes give the same result as serially"""
+        source = Path(self.test_dir) / "pool.pdf"
+        doc = fitz.open()
+        for text in ("DEEP Robotics X30", "Payload 10 kg", "Jueying Lite3 by DEEP Robotics",
+                     "Runtime 2 h", "Contact www.deeprobotics.cn"):
+            doc.new_page().insert_text((72, 72), text, fontsize=12)
+        doc.save(str(source))
+        doc.close()
+        
+        replacer = TextReplacer({"DEEP Robotics": "CHIRAL",
+                                 "www.deeprobotics.cn": "www.chiralrobotics.com"})
+        serial = self.processor.load_pdf(source)
+        self.processor.triage(serial, replacer.has_hits)
+        replacer.replace_all(serial)
+        
+        # A fresh replacer, so the workers do not start from the serial run's cache
+        pooled = TextReplacer(dict(replacer.rules))
+        parallel = self.processor.load_pdf(source)
+        with PagePool(pooled, workers=2, chunk_size=2) as pool:
+            self.processor.replace_text_parallel(parallel, pool)
+        
+        # Span cache lookups made in the workers are counted in the parent
+        serial_cache, pooled_cache = replacer.cache_info(), pooled.cache_info()
+        self.assertGreater(pooled_cache['misses'], 0)
+        self.assertEqual(pooled_cache['hits'] + pooled_cache['misses'],
+                         serial_cache['hits'] + serial_cache['misses'])
+        
+        self.assertEqual(parallel['triage']['hit_pages'], [1, 3, 5])
+        self.assertEqual(parallel['edit_script'].to_dict(), serial['edit_script'].to_dict())
+        self.assertEqual(parallel['replacement_stats'].as_dict(), serial['replacement_stats'].as_dict())
+        self.assertTrue(parallel['pages'][1]['pass_through'])
+        self.assertEqual(parallel['pages'][4]['links'], serial['pages'][4]['links'])
+        
+        outputs = []
+        for name, pdf_data in (("serial", serial), ("parallel", parallel)):
+            output = Path(self.test_dir) / f"{name}.pdf"
+            self.processor.save_pdf(pdf_data, output)
+            self.processor.close_pdf(pdf_data)
+            with fitz.open(str(output)) as out:
+                outputs.append([page.get_text() for page in out])
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertIn("Chiral Lite3 by CHIRAL", outputs[1][2])
+    
+    def test_images_referenced_by_xref(self):
+        """Test that repeated images share one xref and decode at most once"""
+        source = Path(self.test_dir) / "images.pdf"
+        doc = fitz.open()
+        cmyk = fitz.Pixmap(fitz.csCMYK, fitz.IRect(0, 0, 8, 8))
+        cmyk.clear_with(128)
+        logo_xref = 0
+        for _ in range(3):
+            page = doc.new_page()
+            logo_xref = page.insert_image(fitz.Rect(20, 20, 60, 60), pixmap=cmyk, xref=logo_xref)
+        doc.save(str(source))
+        doc.close()
+        
+        pdf_data = self.processor.load_pdf(source)
+        # Placements are matched to xrefs without decoding any image
+        with patch(f"{fitz.Pixmap.__module__}.Pixmap", side_effect=AssertionError("image decoded")):
+            refs = [page['images'][0] for page in pdf_data['pages']]
+        self.assertEqual(len({ref['xref'] for ref in refs}), 1)
+        
+        # Original stream passes through without decoding
+        cache = pdf_data['image_cache']
+        self.assertTrue(refs[0]['data'])
+        self.assertEqual(cache.decodes, 0)
+        
+        # CMYK is converted, not dropped, and decoded only once
+        for ref in refs:
+            self.assertEqual(cache.pixmap(ref['xref']).n, 3)
+        self.assertEqual(cache.decodes, 1)
+        
+        output = Path(self.test_dir) / "rebuilt.pdf"
+        self.processor.rebuild_pdf(pdf_data, output)
+        rebuilt = fitz.open(str(output))
+        self.assertEqual(len({img[0] for page in rebuilt for img in page.get_images()}), 1)
+        rebuilt.close()
+        self.processor.close_pdf(pdf_data)
+    
+    def test_merge_shares_common_resources(self):
+        """Test that merged datasheets store shared logos and fonts once"""
+        import io
+        from PIL import Image, ImageDraw
+        logo = Image.new('RGB', (300, 100), 'white')
+        ImageDraw.Draw(logo).rectangle((20, 20, 280, 80), fill=(30, 58, 95))
+        buffer = io.BytesIO()
+        logo.save(buffer, 'PNG')
+        
+        sources = []
+        for name in ("Chiral_X30_Datasheet", "Chiral_Lite3_Datasheet"):
+            path = Path(self.test_dir) / f"{name}.pdf"
+            doc = fitz.open()
+            for page_number in range(2):
+                page = doc.new_page()
+                page.insert_image(fitz.Rect(72, 36, 222, 86), stream=buffer.getvalue())
+                page.insert_font(fontname="helv", fontbuffer=fitz.Font("helv").buffer)
+                page.insert_text((72, 144), f"{name} page {page_number + 1}", fontname="helv")
+            doc.set_toc([[1, "Specifications", 2]])
+            doc.save(str(path))
+            doc.close()
+            sources.append(path)
+        
+        output = Path(self.test_dir) / "catalog.pdf"
+        result = self.processor.merge_pdfs(sources, output, titles=["X30", "Lite3"])
+        
+        self.assertEqual(result['pages'], 4)
+        self.assertGreaterEqual(result['shared_streams'], 2)  # Logo and font program
+        self.assertLess(result['size'], sum(path.stat().st_size for path in sources))
+        
+        merged = fitz.open(str(output))
+        self.assertEqual({page.get_images()[0][0] for page in merged}, {merged[0].get_images()[0][0]})
+        self.assertIn("Chiral_Lite3_Datasheet page 2", merged[3].get_text())
+        self.assertEqual(merged.get_toc(), [
+            [1, "X30", 1], [2, "Specifications", 2],
+            [1, "Lite3", 3], [2, "Specifications", 4]
+        ])
+        merged.close()
+    
+    def test_watermark_shares_one_form_across_pages(self):
+        """Test that every page refers to one watermark form, centred whatever its geometry"""
+        from watermark import Watermark
+        
+        def stamped_objects(page_count):
+            doc = fitz.open()
+            for page_number in range(page_count):
+                page = doc.new_page(width=842, height=595) if page_number % 2 else doc.new_page()
+                page.insert_text((72, 72), f"Page {page_number + 1}")
+            doc[-1].set_rotation(90)
+            before = doc.xref_length()
+            Watermark("CHIRAL").apply(doc)
+            return doc, doc.xref_length() - before
+        
+        doc, added = stamped_objects(3)
+        self.assertEqual(stamped_objects(30)[1], added)  # Constant, not per page
+        
+        output = Path(self.test_dir) / "watermarked.pdf"
+        doc.save(str(output), garbage=3, deflate=True)
+        doc.close()
+        
+        stamped = fitz.open(str(output))
+        self.assertEqual(len({page.get_xobjects()[0][0] for page in stamped}), 1)
+        for page in stamped:
+            words = [word for word in page.get_text("words") if word[4] == "CHIRAL"]
+            self.assertEqual(len(words), 1)
+            # Text positions are unrotated, like the crop box
+            centre = fitz.Rect(words[0][:4]).tl + fitz.Rect(words[0][:4]).br
+            self.assertAlmostEqual(centre.x / 2, page.cropbox.width / 2, delta=5)
+            self.assertAlmostEqual(centre.y / 2, page.cropbox.height / 2, delta=5)
+            self.assertIn("Page", page.get_text())
+        stamped.close()
+    
     def test_nonexistent_file(self):
         """Test handling of non-existent PDF files"""
         nonexistent_path = Path(os.path.join(self.test_dir, "nonexistent.pdf"))
@@ -190,6 +559,34 @@ class TestTextReplacer(unittest.TestCase):
         self.assertNotIn("云深处科技", result)
         self.assertEqual(count, 1)
     
+    def test_unicode_normalization(self):
+        """Test that decomposed input matches rules written in composed form"""
+        replacer = TextReplacer({"Café Robotics": "CHIRAL"})
+        decomposed = "Visit Cafe\u0301 Robotics"
+        
+        result, count = replacer._replace_text(decomposed)
+        self.assertEqual(result, "Visit CHIRAL")
+        self.assertEqual(count, 1)
+        
+        # ASCII text is returned as-is without normalisation
+        text = "DEEP Robotics"
+        self.assertIs(replacer.matcher.replace(text)[0], text)
+    
+    def test_overlapping_rules_longest_match(self):
+        """Test that overlapping rules resolve longest-first in one pass"""
+        replacer = TextReplacer({
+            "深处": "",
+            "云深处": "CHIRAL",
+            "云深处科技": "CHIRAL Tech",
+            "DEEP": "X",
+            "DEEP Robotics": "CHIRAL"
+        })
+        result, counts = replacer.replace_text("云深处科技 云深处 深处 DEEP Robotics deep")
+
+        self.assertEqual(result, "CHIRAL Tech CHIRAL  CHIRAL X")
+        self.assertEqual(counts, {"深处": 1, "云深处": 1, "云深处科技": 1,
+                                  "DEEP": 1, "DEEP Robotics": 1})
+
     def test_case_sensitivity(self):
         """Test case sensitivity handling"""
         test_text = "deep robotics and DEEP ROBOTICS and Deep Robotics"
@@ -208,6 +605,223 @@ class TestTextReplacer(unittest.TestCase):
         self.assertIn("Chiral X20", result)
         self.assertNotIn("Jueying", result)
     
+    def test_product_namer_single_pass(self):
+        """Test prefixed, Chinese-prefixed and standalone model names"""
+        namer = self.replacer.product_namer
+        result, count = namer.rename("Jueying Lite3, 绝影X30 and J60; Chiral X20 stays")
+        
+        self.assertEqual(result, "Chiral Lite3, Chiral X30 and Chiral J60; Chiral X20 stays")
+        self.assertEqual(count, 3)
+        
+        # Idempotent on already rebranded text
+        self.assertEqual(namer.rename(result), (result, 0))
+        self.assertEqual(namer.strip_prefixes("JueyingLite3"), "Lite3")
+        
+        # A prefix without a model is not a product name
+        for text in ("https://www.jueying.com", "sales@jueying.cn", "the Jueying series"):
+            self.assertEqual(namer.rename(text), (text, 0))
+    
+    def test_streaming_matches_in_memory(self):
+        """Test that chunked replacement catches matches across chunk edges"""
+        import io
+        text = ("Intro DEEP Robotics at www.deeprobotics.cn, JueyingLite3 and "
+                "云深处科技 team. " * 20)
+        expected, expected_count = self.replacer._replace_text(text)
+        
+        for chunk_size in (1, 5, 17, 4096):
+            output = io.StringIO()
+            counts = self.replacer.replace_stream(io.StringIO(text), output, chunk_size)
+            self.assertEqual(output.getvalue(), expected)
+            self.assertEqual(sum(counts.values()), expected_count)
+        
+        # Product name rewrites are counted too, even with no rule hits
+        renamed = [0]
+        output = io.StringIO()
+        counts = self.replacer.replace_stream(io.StringIO("Jueying Lite3 quadruped, J60 joint"),
+                                              output, 4, renamed)
+        self.assertEqual(output.getvalue(), "Chiral Lite3 quadruped, Chiral J60 joint")
+        self.assertEqual((counts, renamed), ({}, [2]))
+    
+    def test_page_mode_maps_matches_to_spans(self):
+        """Test that one page-level pass updates page text and spans"""
+        pdf_data = {
+            'pages': [{
+                'text': 'DEEP Robotics\nVisit www.deeprobotics.cn\nsee 云深处科技 DEEP \nRobotics\n',
+                'blocks': [
+                    {'text': 'DEEP '},
+                    {'text': 'Robotics'},
+                    {'text': 'Visit www.deeprobotics.cn'},
+                    {'text': 'see 云深处科技 DEEP '},
+                    {'text': 'Robotics'}
+                ]
+            }]
+        }
+        
+        self.replacer.replace_all(pdf_data)
+        page = pdf_data['pages'][0]
+        
+        self.assertEqual(page['text'], 'CHIRAL\nVisit www.chiralrobotics.com\nsee CHIRAL DEEP \nRobotics\n')
+        self.assertEqual([b['text'] for b in page['blocks']],
+                         ['CHIRAL', '', 'Visit www.chiralrobotics.com', 'see CHIRAL DEEP ', 'Robotics'])
+        
+        # Product names split across spans are renamed in the spans as well,
+        # after rule edits have shifted the spans
+        pdf_data = {
+            'pages': [{
+                'text': 'DEEP Robotics Jueying Lite3 datasheet\nJueying \nX30 by DEEP Robotics\n',
+                'blocks': [
+                    {'text': 'DEEP Robotics Jueying '},
+                    {'text': 'Lite3 datasheet'},
+                    {'text': 'Jueying '},
+                    {'text': 'X30 by DEEP Robotics'}
+                ]
+            }]
+        }
+        
+        self.replacer.replace_all(pdf_data)
+        page = pdf_data['pages'][0]
+        
+        self.assertEqual(page['text'], 'CHIRAL Chiral Lite3 datasheet\nChiral X30 by CHIRAL\n')
+        self.assertEqual([b['text'] for b in page['blocks']],
+                         ['CHIRAL Chiral Lite3', ' datasheet', 'Chiral X30', ' by CHIRAL'])
+        self.assertEqual(''.join(b['text'] for b in page['blocks']),
+                         page['text'].replace('\n', ''))
+    
+    def test_iter_replacements_is_lazy(self):
+        """Test that preview hits carry page and bbox and respect the limit"""
+        pdf_data = {
+            'pages': [
+                {'number': 1, 'text': 'no brand here', 'blocks': [{'text': 'no brand here', 'bbox': (0, 0, 9, 9)}]},
+                {'number': 2, 'text': 'Made by DEEP Robotics\nwww.deeprobotics.cn',
+                 'blocks': [{'text': 'Made by DEEP Robotics', 'bbox': (10, 20, 90, 30)},
+                            {'text': 'www.deeprobotics.cn', 'bbox': (10, 40, 90, 50)}]}
+            ]
+        }
+        
+        hits = list(self.replacer.iter_replacements(pdf_data))
+        self.assertEqual([(h['page'], h['rule'], h['bbox']) for h in hits],
+                         [(2, 'DEEP Robotics', (10, 20, 90, 30)),
+                          (2, 'www.deeprobotics.cn', (10, 40, 90, 50))])
+        
+        self.assertEqual(len(list(self.replacer.iter_replacements(pdf_data, limit=1))), 1)
+        self.assertEqual(len(self.replacer.find_replacements(pdf_data)), 2)
+    
+    def test_stats_from_replacement_pass_merge(self):
+        """Test that stats come from the replacement pass and merge across documents"""
+        first = {'path': 'a.pdf', 'pages': [{'text': 'DEEP Robotics and DEEP Robotics', 'blocks': []}]}
+        second = {'path': 'b.pdf', 'pages': [{'text': 'www.deeprobotics.cn', 'blocks': []},
+                                             {'text': 'DEEP Robotics', 'blocks': []}]}
+        
+        self.replacer.replace_all(first)
+        self.replacer.replace_all(second)
+        corpus = first['replacement_stats'].merge(second['replacement_stats'])
+        
+        self.assertEqual(corpus.as_dict(), {'DEEP Robotics': 3, 'www.deeprobotics.cn': 1})
+        self.assertEqual(corpus.page_totals(), {('a.pdf', 1): 2, ('b.pdf', 1): 1, ('b.pdf', 2): 1})
+        
+        # Merging stats built from a different rule set remaps columns by key
+        other = TextReplacer({"China": "[Address TBD]", "DEEP Robotics": "CHIRAL"})
+        third = {'path': 'c.pdf', 'pages': [{'text': 'China DEEP Robotics', 'blocks': []}]}
+        other.replace_all(third)
+        corpus.merge(third['replacement_stats'])
+        self.assertEqual(corpus.as_dict()['DEEP Robotics'], 4)
+        self.assertEqual(corpus.as_dict()['China'], 1)
+        self.assertEqual(corpus.page_totals()[('c.pdf', 1)], 2)
+    
+    def test_span_cache_hits_and_eviction(self):
+        """Test that repeated span texts are served from the bounded cache"""
+        # Each uncached span stores its replacement and its product naming result
+        replacer = TextReplacer(self.replacement_rules, cache_size=4)
+        
+        first = replacer._replace_text("DEEP Robotics footer")
+        self.assertEqual(replacer._replace_text("DEEP Robotics footer"), first)
+        self.assertEqual(replacer.cache_info()['hits'], 1)
+        
+        replacer._replace_text("page 2")
+        replacer._replace_text("page 3")
+        info = replacer.cache_info()
+        self.assertEqual(info['size'], 4)
+        self.assertEqual(info['evictions'], 2)
+        
+        # Disabled cache still replaces
+        uncached = TextReplacer(self.replacement_rules, cache_size=0)
+        self.assertEqual(uncached._replace_text("DEEP Robotics footer"), first)
+        self.assertEqual(uncached.cache_info()['size'], 0)
+    
+    def test_script_prefilter_routes_spans(self):
+        """Test that spans are routed to rules of a compatible script"""
+        matcher = self.replacer.matcher
+        
+        # Numbers and units contain no rule start character
+        self.assertIsNone(matcher.route("24.5 kg / 3.2 m/s"))
+        
+        # ASCII spans never see CJK rules
+        regex, _ = matcher.route("Deep robotics")
+        self.assertNotIn("云深处科技", regex.pattern)
+        
+        # CJK spans see every rule and still match ASCII ones
+        result, count = self.replacer._replace_text("联系 DEEP Robotics 云深处科技")
+        self.assertEqual(result, "联系 CHIRAL CHIRAL")
+        self.assertEqual(count, 2)
+    
+    def test_edit_script_round_trip(self):
+        """Test that the edit script replays and reverts page-mode edits"""
+        page_text = "Jueying Lite3 by DEEP Robotics\nCafe\u0301 云深处科技\n"
+        original = {'pages': [{'number': 1, 'text': page_text,
+                               'blocks': [{'text': "Jueying Lite3 by DEEP "},
+                                          {'text': "Robotics"},
+                                          {'text': "Cafe\u0301 云深处科技"}]}]}
+        
+        pdf_data = json.loads(json.dumps(original))
+        self.replacer.replace_all(pdf_data)
+        self.replacer.rename_products(pdf_data)
+        blocks = [block['text'] for block in pdf_data['pages'][0]['blocks']]
+        self.assertEqual(blocks, ["Chiral Lite3 by CHIRAL", "", "Caf\u00e9 CHIRAL"])
+        
+        script = pdf_data['edit_script']
+        # DEEP Robotics in the page text and in both spans it crosses
+        self.assertEqual(script.rule_counts()[0], 3)
+        
+        # Serialised form replays onto the original and reverts the result
+        restored = EditScript.from_dict(json.loads(json.dumps(script.to_dict())))
+        replayed = restored.apply(json.loads(json.dumps(original)))
+        self.assertEqual(replayed['pages'][0]['text'], pdf_data['pages'][0]['text'])
+        
+        restored.revert(pdf_data)
+        self.assertEqual(pdf_data['pages'][0]['text'], page_text)
+        self.assertEqual(pdf_data['pages'][0]['blocks'], original['pages'][0]['blocks'])
+    
+    def test_link_validation_uses_edit_log(self):
+        """Test that only links touched by applied edits are validated"""
+        text = "Mail info@deeprobotics.cn or see https://deeprobotics.cn/x and https://other.com"
+        pdf_data = {'pages': [{'number': 1, 'text': text, 'blocks': [], 'links': index_links(text)}]}
+        self.assertEqual([link[2] for link in pdf_data['pages'][0]['links']], ['email', 'url', 'url'])
+        
+        replacer = TextReplacer({"deeprobotics.cn": "chiral robotics.com"})
+        replacer.replace_all(pdf_data)
+        self.assertEqual(pdf_data['pages'][0]['edits'][0][2], "chiral robotics.com")
+        
+        broken = LinkValidator().validate(pdf_data)
+        self.assertEqual(sorted(link['kind'] for link in broken), ['email', 'url'])
+        self.assertEqual(broken[0]['page'], 1)
+        
+        # Product naming edits are logged against the original text as well
+        named = "DEEP Robotics at https://jueyingx30.com"
+        named_data = {'pages': [{'number': 1, 'text': named, 'blocks': [], 'links': index_links(named)}]}
+        TextReplacer({"DEEP Robotics": "CHIRAL"}).replace_all(named_data)
+        self.assertEqual([edit[:3] for edit in named_data['pages'][0]['edits']],
+                         [(0, 13, "CHIRAL"), (25, 35, "Chiral X30")])
+        broken = LinkValidator().validate(named_data)
+        self.assertEqual([link['modified'] for link in broken], ["https://Chiral X30.com"])
+        
+        # A well-formed replacement leaves nothing to report
+        pdf_data['pages'][0].update(text=text, links=index_links(text))
+        TextReplacer({"deeprobotics.cn": "chiralrobotics.com"}).replace_all(pdf_data)
+        self.assertEqual(LinkValidator().validate(pdf_data), [])
+        
+        # Only the kinds enabled in quality_control are checked
+        self.assertIsNone(LinkValidator.from_config({}))
+    
     def test_url_preservation(self):
         """Test that URLs are properly replaced without breaking"""
         original = "Visit us at www.deeprobotics.cn and https://www.deeprobotics.cn/products"
@@ -246,6 +860,443 @@ class TestTextReplacer(unittest.TestCase):
         self.assertEqual(stats['www.deeprobotics.cn'], 1)
 
 
+class TestRuleCache(unittest.TestCase):
+    """Test the on-disk compiled rule set cache"""
+    
+    def setUp(self):
+        """Set up test environment"""
+        self.cache_dir = Path(tempfile.mkdtemp())
+        rule_cache._rule_sets.clear()
+        self.config = {
+            "text_replacements": {"DEEP Robotics": "CHIRAL", "云深处": "CHIRAL"},
+            "product_naming": {"remove_prefix": ["Jueying"], "add_prefix": "Chiral"},
+            "language_settings": {"chinese_replacements": {"机器狗": "Quadruped Robot"}}
+        }
+    
+    def tearDown(self):
+        """Clean up test environment"""
+        rule_cache._rule_sets.clear()
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+    
+    def test_rule_set_compiled_once_per_config(self):
+        """Test that loading the same config again returns the same compiled set"""
+        first = load_rule_set(self.config, self.cache_dir)
+        second = load_rule_set(json.loads(json.dumps(self.config)), self.cache_dir)
+        self.assertIs(second, first)
+        self.assertEqual(first.matcher.replace("DEEP Robotics 云深处 deep robotics")[0],
+                         "CHIRAL CHIRAL CHIRAL")
+        self.assertEqual(first.chinese_rules, {"机器狗": "Quadruped Robot"})
+        
+        replacer = TextReplacer(first.rules, rule_set=first)
+        self.assertIs(replacer.matcher, first.matcher)
+    
+    def test_cached_rule_set_round_trip(self):
+        """Test that a new process reads the artifact instead of compiling"""
+        fresh = load_rule_set(self.config, self.cache_dir)
+        artifacts = list(self.cache_dir.glob("ruleset_*.json"))
+        self.assertEqual(len(artifacts), 1)
+        self.assertEqual(json.loads(artifacts[0].read_text(encoding='utf-8'))['version'],
+                         rule_cache.CACHE_VERSION)
+        
+        # As in a new process: nothing in memory, the artifact on disk
+        rule_cache._rule_sets.clear()
+        with patch.object(rule_cache.CompiledRuleSet, 'from_config') as compile_rules:
+            cached = load_rule_set(self.config, self.cache_dir)
+        compile_rules.assert_not_called()
+        self.assertIsNot(cached, fresh)
+        
+        # Patterns compile on first use, only for the scripts seen
+        self.assertEqual(cached.matcher._patterns, {})
+        text = "DEEP Robotics 云深处 deep robotics, Jueying Lite3"
+        self.assertEqual(cached.matcher.replace("DEEP Robotics"), fresh.matcher.replace("DEEP Robotics"))
+        self.assertEqual(len(cached.matcher._patterns), 1)
+        self.assertEqual(cached.matcher.replace(text), fresh.matcher.replace(text))
+        self.assertEqual(cached.namer.rename(text), fresh.namer.rename(text))
+        self.assertEqual(cached.chinese_rules, {"机器狗": "Quadruped Robot"})
+        
+        # Unreadable or outdated artifacts are compiled again and replaced
+        artifacts[0].write_text('{"version": 1', encoding='utf-8')
+        rule_cache._rule_sets.clear()
+        with self.assertLogs('rule_cache', level='WARNING'):
+            rebuilt = load_rule_set(self.config, self.cache_dir)
+        self.assertEqual(rebuilt.matcher.replace(text), fresh.matcher.replace(text))
+        self.assertEqual(json.loads(artifacts[0].read_text(encoding='utf-8'))['digest'], fresh.digest)
+    
+    def test_chinese_rules_share_matcher(self):
+        """Test that configured Chinese rules run in the main single pass"""
+        self.config["language_settings"]["chinese_replacements"]["云深处"] = "ignored"
+        rule_set = load_rule_set(self.config, self.cache_dir)
+        replacer = TextReplacer(rule_set.rules, rule_set=rule_set)
+        
+        self.assertEqual(replacer.handle_chinese_text("云深处的机器狗"), "CHIRAL的Quadruped Robot")
+        
+        # Disabling Chinese support leaves only the main rules
+        self.config["language_settings"]["support_chinese"] = False
+        rule_set = load_rule_set(self.config, self.cache_dir)
+        self.assertNotIn("机器狗", rule_set.matcher.keys)
+    
+    def test_config_change_invalidates_cache(self):
+        """Test that changing a relevant section produces a new artifact"""
+        first = load_rule_set(self.config, self.cache_dir)
+        
+        self.config["text_replacements"]["China"] = "[Address TBD]"
+        second = load_rule_set(self.config, self.cache_dir)
+        
+        self.assertNotEqual(first.digest, second.digest)
+        self.assertIn("China", second.matcher.keys)
+        self.assertEqual(len(list(self.cache_dir.glob("ruleset_*.json"))), 2)
+        
+        # Sections the rule set does not depend on do not change the key
+        self.config["logo_settings"] = {"color": "#000000"}
+        self.assertEqual(config_digest(self.config), second.digest)
+
+
+class TestFuzzyMatcher(unittest.TestCase):
+    """Test near-match detection of brand names"""
+    
+    def setUp(self):
+        """Set up test environment"""
+        self.matcher = FuzzyBrandMatcher({"DEEP Robotics": "CHIRAL"}, max_distance=2)
+    
+    def test_detects_mangled_brand_names(self):
+        """Test OCR errors, letter spacing and line-break hyphenation"""
+        for text in ["By DEEP Rob0tics Ltd", "D E E P Robotics", "DeepRobotics",
+                     "Deep Ro-\nbotics", "DEEP Robotlcs"]:
+            hits = self.matcher.find(text)
+            self.assertEqual(len(hits), 1, text)
+            self.assertEqual(hits[0]['term'], "DEEP Robotics")
+        
+        hit = self.matcher.find("By DEEP Rob0tics Ltd")[0]
+        self.assertEqual(hit['matched'], "DEEP Rob0tics")
+        self.assertEqual(hit['distance'], 0)
+        
+        self.assertEqual(self.matcher.find("Deep learning for robots"), [])
+        
+        # Hits are whole words: no partial or shortened brand names
+        for text in ["sleep robotics", "the deep robotic arm", "xDEEP Robotics"]:
+            self.assertEqual(self.matcher.find(text), [], text)
+        replacer = FuzzyBrandMatcher({"DEEP Robotics": "CHIRAL"}, max_distance=2, replace=True)
+        self.assertEqual(replacer.replace("DEEP Roboticss and sleep robotics")[0],
+                         "CHIRAL and sleep robotics")
+    
+    def test_page_mode_flags_or_replaces(self):
+        """Test that fuzzy hits are flagged by default and replaced on request"""
+        pdf_data = {'pages': [{'number': 1, 'text': "DEEP Robotics and DEEP Rob0tics",
+                               'blocks': [{'text': "DEEP Robotics and "},
+                                          {'text': "DEEP Rob0tics"}]}]}
+        
+        replacer = TextReplacer({"DEEP Robotics": "CHIRAL"}, fuzzy_matcher=self.matcher)
+        result = replacer.replace_all(json.loads(json.dumps(pdf_data)))
+        self.assertEqual(result['pages'][0]['text'], "CHIRAL and DEEP Rob0tics")
+        self.assertEqual(len(result['fuzzy_hits']), 1)
+        self.assertEqual(result['fuzzy_hits'][0]['page'], 1)
+        
+        replacer.fuzzy_matcher = FuzzyBrandMatcher({"DEEP Robotics": "CHIRAL"}, replace=True)
+        result = replacer.replace_all(json.loads(json.dumps(pdf_data)))
+        self.assertEqual(result['pages'][0]['text'], "CHIRAL and CHIRAL")
+        self.assertEqual(result['pages'][0]['blocks'][1]['text'], "CHIRAL")
+    
+    def test_disabled_by_default(self):
+        """Test that the matcher is only built when enabled in config"""
+        self.assertIsNone(FuzzyBrandMatcher.from_config({}))
+        matcher = FuzzyBrandMatcher.from_config(
+            {"enabled": True, "terms": ["DEEP Robotics"]}, {"DEEP Robotics": "CHIRAL"}
+        )
+        self.assertEqual(matcher.replacements, ["CHIRAL"])
+
+
+class TestLogoDetector(unittest.TestCase):
+    """Test perceptual-hash logo detection"""
+    
+    def setUp(self):
+        """Set up test environment"""
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.detector = LogoDetector(self.test_dir / "logo_index.json")
+        self.logo = self._image(self._draw_logo((240, 80)), 'PNG')
+        self.detector.add(self.logo, "header")
+    
+    def tearDown(self):
+        """Clean up test environment"""
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    @staticmethod
+    def _draw_logo(size):
+        """A simple two-tone mark standing in for the old brand logo"""
+        from PIL import Image, ImageDraw
+        width, height = size
+        image = Image.new('RGB', size, 'white')
+        draw = ImageDraw.Draw(image)
+        draw.ellipse((width * 0.05, height * 0.1, width * 0.3, height * 0.9), fill=(20, 40, 120))
+        draw.rectangle((width * 0.4, height * 0.3, width * 0.95, height * 0.7), fill=(20, 40, 120))
+        return image
+    
+    @staticmethod
+    def _image(image, fmt):
+        """Encode a PIL image"""
+        import io
+        buffer = io.BytesIO()
+        image.save(buffer, format=fmt)
+        return buffer.getvalue()
+    
+    def _photo(self, size=(240, 80)):
+        """Noise image that shares nothing with the logo"""
+        import numpy as np
+        from PIL import Image
+        pixels = np.random.RandomState(0).randint(0, 255, (size[1], size[0], 3), dtype=np.uint8)
+        return self._image(Image.fromarray(pixels), 'JPEG')
+    
+    def test_classifies_variants_and_caches_by_digest(self):
+        """Test that rescaled, recompressed logos match and other images do not"""
+        variant = self._image(self._draw_logo((120, 40)), 'JPEG')
+        match = self.detector.classify(variant)
+        self.assertEqual(match['label'], "header")
+        self.assertIsNone(self.detector.classify(self._photo()))
+        
+        # The same stream is only decoded once
+        self.detector.classify(variant)
+        info = self.detector.info()
+        self.assertEqual(info['lookups'], 3)
+        self.assertEqual(info['decodes'], 2)
+        
+        # The index survives a save/load round trip
+        self.detector.save()
+        reloaded = LogoDetector(self.detector.index_path)
+        self.assertEqual(reloaded.entries, self.detector.entries)
+        self.assertTrue(LogoDetector(self.test_dir / "missing.json").empty)
+    
+    def test_index_path_follows_config_not_working_directory(self):
+        """Test that relative index paths resolve against the config directory"""
+        detector = LogoDetector.from_config({"index_path": "logo_index.json"}, self.test_dir)
+        self.assertEqual(detector.index_path, self.test_dir / "logo_index.json")
+        
+        # Without a setting the index shipped with the package is used
+        shipped = LogoDetector.from_config({})
+        self.assertTrue(shipped.index_path.is_absolute())
+        self.assertFalse(shipped.empty)
+    
+    def test_light_logo_on_transparency_is_not_blank(self):
+        """Test that a white logo with a soft mask is hashed against dark paper"""
+        from PIL import Image
+        mark = self._draw_logo((240, 80)).convert('L').point(lambda v: 255 if v < 128 else 0)
+        white = Image.new('RGB', (240, 80), 'white')
+        self.detector.add(self._image(white, 'PNG'), "white", mask=self._image(mark, 'PNG'))
+        
+        match = self.detector.classify(self._image(white, 'JPEG'), self._image(mark, 'PNG'))
+        self.assertEqual(match['label'], "white")
+        # On white paper the logo would vanish; on dark paper it is the
+        # same logo as one flattened onto a dark background
+        flattened = Image.new('RGB', (240, 80), 'black')
+        flattened.paste(white, mask=mark)
+        self.assertEqual(self.detector.classify(self._image(flattened, 'PNG'))['label'], "white")
+        
+    def test_replace_logo_uses_index_not_position(self):
+        """Test that a footer logo is replaced while a header photo is kept"""
+        pdf_path = self.test_dir / "logos.pdf"
+        doc = fitz.open()
+        page = doc.new_page(width=595, height=842)
+        page.insert_image(fitz.Rect(50, 20, 290, 100), stream=self._photo())
+        page.insert_image(fitz.Rect(50, 740, 290, 820), stream=self.logo)
+        doc.save(str(pdf_path))
+        doc.close()
+        
+        logo_path = self.test_dir / "chiral.png"
+        logo_path.write_bytes(self._image(self._draw_logo((300, 100)), 'PNG'))
+        
+        processor = PDFProcessor()
+        pdf_data = processor.load_pdf(pdf_path)
+        try:
+            processor.replace_logo(pdf_data, logo_path, self.detector)
+            images = sorted(pdf_data['pages'][0]['images'], key=lambda img: img['bbox'][1])
+            self.assertFalse(images[0].get('replaced', False))
+            self.assertTrue(images[1].get('replaced', False))
+            self.assertEqual(images[1]['logo'], "header")
+        finally:
+            processor.close_pdf(pdf_data)
+    
+    def test_logo_rendition_embedded_once(self):
+        """Test that logos embedded separately per page share one replacement xref"""
+        from PIL import Image
+        pdf_path = self.test_dir / "pages.pdf"
+        doc = fitz.open()
+        for shade in range(3):
+            # Slightly different pixels, so each page embeds its own copy
+            logo = self._draw_logo((240, 80))
+            logo.putpixel((0, 0), (255 - shade, 255, 255))
+            page = doc.new_page(width=595, height=842)
+            page.insert_image(fitz.Rect(50, 740, 290, 820), stream=self._image(logo, 'PNG'))
+        doc.save(str(pdf_path))
+        doc.close()
+        
+        logo_path = self.test_dir / "chiral.png"
+        logo_path.write_bytes(self._image(Image.new('RGB', (300, 100), 'red'), 'PNG'))
+        
+        processor = PDFProcessor()
+        pdf_data = processor.load_pdf(pdf_path)
+        try:
+            self.assertEqual(len({page['images'][0]['xref'] for page in pdf_data['pages']}), 3)
+            processor.replace_logo(pdf_data, logo_path, self.detector)
+            pdf_data['edit_script'] = EditScript()
+            output_path = self.test_dir / "out.pdf"
+            processor.save_pdf(pdf_data, output_path)
+        finally:
+            processor.close_pdf(pdf_data)
+        
+        self.assertEqual(processor.logo_renditions.info(), {'hits': 2, 'misses': 1, 'size': 1})
+        with fitz.open(str(output_path)) as out:
+            xrefs = {image[0] for page in out for image in page.get_images()}
+            self.assertEqual(len(xrefs), 1)
+            self.assertEqual(out[2].get_pixmap(clip=fitz.Rect(100, 760, 101, 761)).pixel(0, 0),
+                             (255, 0, 0))
+    
+    def test_vector_logo_replaced_in_place(self):
+        """Test that a logo drawn as vector graphics is found, removed and replaced"""
+        pdf_path = self.test_dir / "vector.pdf"
+        doc = fitz.open()
+        page = doc.new_page(width=595, height=842)
+        page.insert_text((50, 400), "Specifications", fontsize=14)
+        color = (20 / 255, 40 / 255, 120 / 255)
+        left, top, width, height = 50, 740, 240, 80
+        page.draw_oval(fitz.Rect(left + width * 0.05, top + height * 0.1,
+                                 left + width * 0.3, top + height * 0.9), color=None, fill=color)
+        page.draw_rect(fitz.Rect(left + width * 0.4, top + height * 0.3,
+                                 left + width * 0.95, top + height * 0.7), color=None, fill=color)
+        doc.save(str(pdf_path))
+        doc.close()
+        
+        logo_path = self.test_dir / "chiral.png"
+        logo_path.write_bytes(self.logo)
+        
+        processor = PDFProcessor()
+        pdf_data = processor.load_pdf(pdf_path)
+        try:
+            processor.replace_logo(pdf_data, logo_path, self.detector)
+            hits = pdf_data['pages'][0]['vector_logos']
+            self.assertEqual(len(hits), 1)
+            self.assertEqual(hits[0]['label'], "header")
+            self.assertEqual(len(hits[0]['drawings']), 2)
+            self.assertGreater(hits[0]['rect'][1], 700)
+            
+            pdf_data['edit_script'] = EditScript()
+            output_path = self.test_dir / "out.pdf"
+            processor.save_pdf(pdf_data, output_path)
+        finally:
+            processor.close_pdf(pdf_data)
+        
+        with fitz.open(str(output_path)) as out:
+            self.assertEqual(out[0].get_drawings(), [])
+            self.assertEqual(len(out[0].get_images()), 1)
+            self.assertIn("Specifications", out[0].get_text())
+
+
+class TestPDFOptimizer(unittest.TestCase):
+    """Test output size optimization"""
+    
+    def setUp(self):
+        """Set up test environment"""
+        self.test_dir = Path(tempfile.mkdtemp())
+        self.source = self.test_dir / "source.pdf"
+    
+    def tearDown(self):
+        """Clean up test environment"""
+        shutil.rmtree(self.test_dir, ignore_errors=True)
+    
+    @staticmethod
+    def _image(image, fmt, **params):
+        """Encoded bytes of a PIL image"""
+        import io
+        buffer = io.BytesIO()
+        image.save(buffer, fmt, **params)
+        return buffer.getvalue()
+    
+    def _write_source(self, photo_rect):
+        """A page with a noisy photo in ``photo_rect`` and a flat two-colour graphic"""
+        import numpy as np
+        from PIL import Image, ImageDraw
+        noise = np.random.default_rng(0).integers(0, 255, (600, 800, 3), dtype=np.uint8)
+        photo = self._image(Image.fromarray(noise), 'JPEG', quality=95)
+        flat = Image.new('RGB', (900, 300), 'white')
+        ImageDraw.Draw(flat).rectangle((100, 100, 400, 200), fill=(30, 58, 95))
+        
+        doc = fitz.open()
+        page = doc.new_page()
+        page.insert_image(photo_rect, stream=photo)
+        page.insert_image(fitz.Rect(72, 400, 372, 500), stream=self._image(flat, 'PNG'))
+        page.insert_text((72, 700), "Made by CHIRAL", fontsize=12)
+        doc.save(str(self.source))
+        doc.close()
+    
+    def test_downsamples_photos_and_palettes_flat_graphics(self):
+        """Test per-image codec choice and the bytes saved per category"""
+        # 800 px over 200 pt is 288 dpi; the flat graphic is 216 dpi
+        self._write_source(fitz.Rect(72, 72, 272, 222))
+        output = self.test_dir / "output.pdf"
+        report = PDFOptimizer(dpi=96, quality='standard', workers=1).optimize(self.source, output)
+        
+        self.assertEqual(report['images']['downsampled'], 2)
+        self.assertEqual(report['images']['jpeg'], 1)
+        self.assertEqual(report['images']['palette'], 1)
+        self.assertEqual(report['original_size'], self.source.stat().st_size)
+        self.assertEqual(report['optimized_size'], output.stat().st_size)
+        self.assertEqual(sum(report['saved'].values()),
+                         report['original_size'] - report['optimized_size'])
+        self.assertGreater(report['saved']['images'], 0)
+        
+        doc = fitz.open(str(output))
+        images = {item[8]: item for item in doc[0].get_images(full=True)}
+        self.assertEqual(images['DCTDecode'][2:4], (267, 200))
+        self.assertEqual(images['FlateDecode'][2:5], (400, 133, 1))
+        self.assertEqual(images['FlateDecode'][5], 'Indexed')
+        # Flat colours survive resampling exactly
+        pix = doc[0].get_pixmap(clip=fitz.Rect(72, 400, 372, 500))
+        self.assertEqual(pix.pixel(2, 2), (255, 255, 255))
+        self.assertEqual(pix.pixel(80, 50), (30, 58, 95))
+        self.assertIn("Made by CHIRAL", doc[0].get_text())
+        doc.close()
+    
+    def test_leaves_low_resolution_jpegs_alone(self):
+        """Test that JPEGs at or below the target resolution are not re-encoded"""
+        # 800 px over 600 pt is 96 dpi
+        self._write_source(fitz.Rect(0, 0, 600, 450))
+        doc = fitz.open(str(self.source))
+        jobs = PDFOptimizer(dpi=150, workers=1).plan(doc)
+        doc.close()
+        
+        self.assertEqual(len(jobs), 1)  # Only the losslessly stored graphic
+        self.assertEqual(jobs[0]['scale'], 1.0)
+        self.assertIsNone(PDFOptimizer.from_config({}))
+        self.assertIsNotNone(PDFOptimizer.from_config({"optimize": True}))
+    
+    def test_optimizer_settings_leave_page_pool_and_save_alone(self):
+        """Test that the optimizer has its own workers and follows the compression setting"""
+        processing = {"optimize": True, "workers": 0, "compression": "maximum"}
+        self.assertEqual(PDFOptimizer.from_config(processing).workers, 1)
+        self.assertEqual(PDFOptimizer.from_config(dict(processing, optimize_workers=3)).workers, 3)
+        self.assertEqual(PDFOptimizer.from_config(processing).save_options['garbage'], 4)
+        self.assertEqual(PDFOptimizer.from_config(dict(processing, compression="standard")).save_options['garbage'], 3)
+        
+        # Incremental outputs keep the input's revisions, so nothing is optimized
+        processing['compression'] = "incremental"
+        with self.assertLogs('pdf_optimizer', level='WARNING'):
+            self.assertIsNone(PDFOptimizer.from_config(processing))
+        
+        processor = PDFProcessor.from_config(processing)
+        self.assertEqual(processor.compression, "incremental")
+        processor.cleanup()
+    
+    def test_optimizer_writes_output_from_draft(self):
+        """Test that a draft save is optimized into a separate output"""
+        self._write_source(fitz.Rect(72, 72, 272, 222))
+        draft = self.test_dir / "draft.pdf"
+        output = self.test_dir / "output.pdf"
+        shutil.copyfile(str(self.source), str(draft))
+        
+        report = PDFOptimizer(workers=1, compression='standard').optimize(draft, output)
+        self.assertEqual(draft.stat().st_size, report['original_size'])
+        self.assertEqual(output.stat().st_size, report['optimized_size'])
+        with fitz.open(str(output)) as doc:
+            self.assertIn("Made by CHIRAL", doc[0].get_text())
+
+
 class TestLogoGenerator(unittest.TestCase):
     """Test logo generation functionality"""
     
@@ -500,6 +1551,10 @@ def main():
         TestChiralBrandProcessor,
         TestPDFProcessor,
         TestTextReplacer,
+        TestRuleCache,
+        TestFuzzyMatcher,
+        TestLogoDetector,
+        TestPDFOptimizer,
         TestLogoGenerator,
         TestIntegration
     ]
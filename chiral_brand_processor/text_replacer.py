@@ -3,98 +3,1234 @@ Text Replacement Module - Handles intelligent text substitution
 """
 
 import re
+import json
 import logging
-from typing import Dict, List, Tuple, Any, Optional
-from difflib import SequenceMatcher
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Tuple, Any, Optional, Iterator, Iterable, Callable, TextIO
 import unicodedata
 
+from link_validator import index_links
+
 logger = logging.getLogger(__name__)
 
+# Default read size for streaming replacement (characters)
+STREAM_CHUNK_SIZE = 1 << 20
+
+# Characters kept before the unprocessed text so lookbehinds and \b still see them
+STREAM_CONTEXT = 32
+
+# Longest input memoized by the span cache; page texts are not worth keeping
+MAX_CACHED_TEXT_LENGTH = 1024
+
+# Rule ids recorded in edit scripts for edits that do not come from a rule
+RULE_FUZZY = -1
+RULE_NAMING = -2
+RULE_NORMALIZE = -3
+
+# Edit script stages, applied in this order within a span
+STAGE_NORMALIZE = 0
+STAGE_RULES = 1
+STAGE_NAMING = 2
+
+# Span index of the page text itself in edit scripts
+PAGE_TEXT = -1
+
+
+def rule_pattern_source(old_text: str) -> str:
+    """Regex source for a single replacement rule"""
+    if old_text.isascii() and old_text.replace(' ', '').isalnum():
+        # For alphanumeric strings, use word boundaries. CJK text has no
+        # spaces between words, so \b would reject matches inside a sentence
+        return r'\b' + re.escape(old_text) + r'\b'
+    # For other strings (URLs, emails, etc.), exact match
+    return re.escape(old_text)
+
+
+def stream_sub(chunks: Iterable[str], regex: re.Pattern, repl: Callable, window: int,
+               context: int = STREAM_CONTEXT) -> Iterator[str]:
+    """Substitute ``regex`` over text arriving in chunks, yielding output pieces
+    
+    ``window`` must cover the longest possible match plus one character of
+    lookahead. That many characters are carried into the next buffer so a
+    match straddling a chunk edge is still found, and memory stays bounded
+    by chunk size plus window regardless of input size.
+    """
+    carry = ''
+    start = 0
+    
+    for chunk in chunks:
+        buffer = carry + chunk
+        limit = len(buffer) - window
+        if limit <= start:
+            carry = buffer
+            continue
+        
+        pieces = []
+        pos = start
+        for match in regex.finditer(buffer, start):
+            # Matches starting in the window may continue into the next chunk
+            if match.start() >= limit:
+                break
+            pieces.append(buffer[pos:match.start()])
+            pieces.append(repl(match))
+            pos = match.end()
+        
+        cut = max(pos, limit)
+        pieces.append(buffer[pos:cut])
+        yield ''.join(pieces)
+        
+        keep = max(0, cut - context)
+        carry = buffer[keep:]
+        start = cut - keep
+    
+    # Flush the remaining tail
+    pieces = []
+    pos = start
+    for match in regex.finditer(carry, start):
+        pieces.append(carry[pos:match.start()])
+        pieces.append(repl(match))
+        pos = match.end()
+    pieces.append(carry[pos:])
+    tail = ''.join(pieces)
+    if tail:
+        yield tail
+
+
+def apply_edits(text: str, edits: List[Tuple[int, int, str]]) -> str:
+    """Apply sorted, non-overlapping (start, end, replacement) edits in one join
+
+    Edits may carry extra trailing fields (such as a rule id), which are ignored.
+    """
+    pieces = []
+    pos = 0
+    for start, end, replacement, *_ in edits:
+        pieces.append(text[pos:start])
+        pieces.append(replacement)
+        pos = end
+    pieces.append(text[pos:])
+    return ''.join(pieces)
+
+
+def compose_edits(text: str, first: List[Tuple[int, int, str, int]],
+                  second: List[Tuple[int, int, str, int]]) -> List[Tuple[int, int, str, int]]:
+    """Edits against the original text that apply ``first`` and then ``second``
+
+    ``text`` is the result of applying ``first``; ``second`` is against
+    that text. Edits of the two lists that overlap there are merged into
+    one edit spanning both, tagged with the rule of the ``second`` edit.
+    """
+    if not second:
+        return list(first)
+    if not first:
+        return list(second)
+
+    # (start, end in ``text``, original start, original end, replacement, rule, from second)
+    items = []
+    shift = 0
+    for start, end, replacement, rule in first:
+        items.append((start + shift, start + shift + len(replacement), start, end, replacement, rule, False))
+        shift += len(replacement) - (end - start)
+    items.extend((start, end, None, None, replacement, rule, True)
+                 for start, end, replacement, rule in second)
+    items.sort(key=lambda item: (item[0], item[1]))
+
+    composed = []
+    shift = 0  # Length change of the ``first`` edits before the current position
+    index = 0
+    while index < len(items):
+        cluster = [items[index]]
+        cluster_end = items[index][1]
+        index += 1
+        while index < len(items) and items[index][0] < cluster_end:
+            cluster.append(items[index])
+            cluster_end = max(cluster_end, items[index][1])
+            index += 1
+
+        firsts = [item for item in cluster if not item[6]]
+        growth = sum(len(item[4]) - (item[3] - item[2]) for item in firsts)
+        if len(cluster) == 1 and firsts:
+            composed.append(firsts[0][2:6])
+        else:
+            cluster_start = cluster[0][0]
+            seconds = [(item[0] - cluster_start, item[1] - cluster_start, item[4], item[5])
+                       for item in cluster if item[6]]
+            composed.append((cluster_start - shift, cluster_end - shift - growth,
+                             apply_edits(text[cluster_start:cluster_end], seconds), seconds[-1][3]))
+        shift += growth
+    return composed
+
+
+# CJK ideographs, kana, hangul and full-width forms
+CJK_PATTERN = re.compile('[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]')
+
+SCRIPT_ASCII = 'ascii'
+SCRIPT_LATIN = 'latin'
+SCRIPT_CJK = 'cjk'
+
+# Rule scripts that can possibly match text of a given script
+ROUTE_SCRIPTS = {
+    SCRIPT_ASCII: (SCRIPT_ASCII,),
+    SCRIPT_LATIN: (SCRIPT_ASCII, SCRIPT_LATIN),
+    SCRIPT_CJK: (SCRIPT_ASCII, SCRIPT_LATIN, SCRIPT_CJK)
+}
+
+
+def normalize_text(text: str) -> str:
+    """NFC form of ``text``, skipping the work for ASCII and already normalised text"""
+    if text.isascii() or unicodedata.is_normalized('NFC', text):
+        return text
+    return unicodedata.normalize('NFC', text)
+
+
+def merge_rules(rules: Dict[str, str], extra_rules: Dict[str, str]) -> Dict[str, str]:
+    """Main rules followed by extra rules whose keys they do not already define"""
+    merged = dict(rules)
+    for old, new in extra_rules.items():
+        merged.setdefault(old, new)
+    return merged
+
+
+def text_script(text: str) -> str:
+    """Classify text as pure ASCII, other non-CJK (Latin etc.) or containing CJK"""
+    if text.isascii():
+        return SCRIPT_ASCII
+    if CJK_PATTERN.search(text):
+        return SCRIPT_CJK
+    return SCRIPT_LATIN
+
+
+def start_characters(words: Iterable[str], ignore_case: bool) -> Tuple[frozenset, frozenset]:
+    """Possible first characters of ``words`` for raw ASCII text and for casefolded text"""
+    raw = set()
+    folded = set()
+    for word in words:
+        if not word:
+            continue
+        first = word[0]
+        raw.add(first)
+        if ignore_case:
+            raw.update((first.lower(), first.upper()))
+            folded.add(first.casefold()[0])
+        else:
+            folded.add(first)
+    return frozenset(raw), frozenset(folded)
+
+
+class RuleMatcher:
+    """Finds matches for every replacement rule in one left-to-right pass
+
+    All rules are compiled into a single alternation ordered longest-first,
+    so at each position the longest applicable rule wins and ties fall back
+    to config order. Matching is therefore independent of rule order and
+    overlapping rules ("云深处科技" / "云深处" / "深处") resolve the same way
+    every time.
+
+    Before matching, text is routed by script: pure ASCII text only sees
+    ASCII rules, and text containing none of the possible rule start
+    characters skips the regex engine entirely.
+
+    Rule keys are NFC-normalised here, once; input text must be in NFC
+    form too (see normalize_text) for composed characters to match.
+    """
+
+    def __init__(self, rules: Dict[str, str], case_sensitive: bool = False):
+        """Build the combined pattern for the given rules"""
+        normalized = {}
+        for old, new in rules.items():
+            # The first rule wins if two keys only differ in normalisation
+            normalized.setdefault(normalize_text(old), new)
+        self.keys = [old for old in normalized if old]
+        self.values = [normalized[old] for old in self.keys]
+        self.max_length = max((len(old) for old in self.keys), default=0)
+        self.flags = 0 if case_sensitive else re.IGNORECASE
+
+        # Group number -> rule index
+        self._group_rule, self.source = self._build(range(len(self.keys)))
+        self._patterns: Dict[str, re.Pattern] = {}
+        self._build_routes()
+
+    @property
+    def regex(self) -> Optional[re.Pattern]:
+        """Combined pattern of all rules, None without rules"""
+        return self._pattern(self.source) if self.keys else None
+
+    def _pattern(self, source: str) -> re.Pattern:
+        """Compiled form of one of the matcher's sources, compiled on first use"""
+        pattern = self._patterns.get(source)
+        if pattern is None:
+            pattern = self._patterns[source] = re.compile(source, self.flags)
+        return pattern
+
+    def _build(self, indices: Iterable[int]) -> Tuple[List[int], str]:
+        """Group table and alternation source for a subset of rules"""
+        # Longest rule first, config order for ties
+        order = sorted(indices, key=lambda i: (-len(self.keys[i]), i))
+        source = '|'.join(f'({rule_pattern_source(self.keys[i])})' for i in order)
+        return [-1] + order, source
+
+    def _build_routes(self):
+        """Per-script rule subsets and start-character prefilters
+
+        Routes hold pattern sources; each is compiled the first time text
+        of its script needs it.
+        """
+        ignore_case = bool(self.flags & re.IGNORECASE)
+        scripts = [text_script(old) for old in self.keys]
+        self._routes = {}
+
+        for script, allowed in ROUTE_SCRIPTS.items():
+            indices = [i for i, rule_script in enumerate(scripts) if rule_script in allowed]
+            raw, folded = start_characters((self.keys[i] for i in indices), ignore_case)
+            if not indices:
+                self._routes[script] = None
+            elif len(indices) == len(self.keys):
+                self._routes[script] = (self.source, self._group_rule, raw, folded)
+            else:
+                group_rule, source = self._build(indices)
+                self._routes[script] = (source, group_rule, raw, folded)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Derived rule tables and pattern sources, for the on-disk rule cache"""
+        routes = {}
+        for script, route in self._routes.items():
+            if route is not None:
+                source, group_rule, raw, folded = route
+                route = {'source': source, 'group_rule': group_rule,
+                         'raw': ''.join(sorted(raw)), 'folded': ''.join(sorted(folded))}
+            routes[script] = route
+        return {
+            'keys': self.keys,
+            'values': self.values,
+            'flags': self.flags,
+            'source': self.source,
+            'group_rule': self._group_rule,
+            'routes': routes
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'RuleMatcher':
+        """Rebuild a matcher from to_dict() output without deriving anything again"""
+        matcher = cls.__new__(cls)
+        matcher.keys = data['keys']
+        matcher.values = data['values']
+        matcher.max_length = max((len(old) for old in matcher.keys), default=0)
+        matcher.flags = data['flags']
+        matcher.source = data['source']
+        matcher._group_rule = data['group_rule']
+        matcher._patterns = {}
+        matcher._routes = {}
+        for script, route in data['routes'].items():
+            if route is not None:
+                route = (route['source'], route['group_rule'],
+                         frozenset(route['raw']), frozenset(route['folded']))
+            matcher._routes[script] = route
+        return matcher
+
+    def route(self, text: str) -> Optional[Tuple[re.Pattern, List[int]]]:
+        """Pattern and group table for the rules that can match ``text``, or None"""
+        if not self.keys or not text:
+            return None
+
+        script = text_script(text)
+        route = self._routes[script]
+        if route is None:
+            return None
+
+        source, group_rule, raw, folded = route
+        if script == SCRIPT_ASCII:
+            if raw.isdisjoint(text):
+                return None
+        elif folded.isdisjoint(text.casefold() if self.flags & re.IGNORECASE else text):
+            return None
+        return self._pattern(source), group_rule
+
+    def finditer(self, text: str, pos: int = 0) -> Iterator[Tuple[int, int, int]]:
+        """Yield (start, end, rule index) for each non-overlapping match"""
+        route = self.route(text)
+        if route is None:
+            return
+        regex, group_rule = route
+        for match in regex.finditer(text, pos):
+            yield match.start(), match.end(), group_rule[match.lastindex]
+
+    def replace(self, text: str) -> Tuple[str, List[int]]:
+        """Apply all rules in one pass, returning new text and per-rule counts"""
+        counts = [0] * len(self.keys)
+        text = normalize_text(text)
+        route = self.route(text)
+        if route is None:
+            return text, counts
+
+        regex, group_rule = route
+        values = self.values
+
+        def substitute(match):
+            rule = group_rule[match.lastindex]
+            counts[rule] += 1
+            return values[rule]
+
+        return regex.sub(substitute, text), counts
+
+    def stream(self, chunks: Iterable[str], counts: List[int]) -> Iterator[str]:
+        """Apply all rules to chunked text, adding per-rule hits to ``counts``"""
+        if not self.keys:
+            yield from chunks
+            return
+
+        group_rule = self._group_rule
+        values = self.values
+
+        def substitute(match):
+            rule = group_rule[match.lastindex]
+            counts[rule] += 1
+            return values[rule]
+
+        # +1 so the trailing \b of the longest rule can see its next character
+        chunks = (normalize_text(chunk) for chunk in chunks)
+        yield from stream_sub(chunks, self.regex, substitute, self.max_length + 1)
+
+
+class ProductNamer:
+    """Rewrites product names in one compiled pass
+
+    Handles prefixed names ("Jueying Lite3", "绝影X30") and standalone
+    model names ("J60") from a single pattern built once from the
+    ``product_naming`` config section. An old prefix without a model
+    after it is left alone, so the words of URLs, emails and prose
+    ("Jueying series") are never cut.
+    """
+
+    DEFAULT_PREFIXES = ['Jueying', '绝影', 'JUEYING']
+    DEFAULT_MODELS = ['Lite3', 'Lite2', 'Mini', 'X20', 'X30', 'J60']
+
+    def __init__(self, remove_prefix: Optional[List[str]] = None,
+                 add_prefix: str = 'Chiral', model_names: Optional[List[str]] = None):
+        """Build the naming grammar"""
+        self.prefixes = [p for p in (remove_prefix or self.DEFAULT_PREFIXES) if p]
+        self.models = [m for m in (model_names or self.DEFAULT_MODELS) if m]
+        self.new_prefix = add_prefix
+
+        prefix_alt = '|'.join(re.escape(p) for p in sorted(self.prefixes, key=len, reverse=True))
+        model_alt = '|'.join(re.escape(m) for m in sorted(self.models, key=len, reverse=True))
+        new_prefix = re.escape(add_prefix)
+
+        # 1: old prefix + model, 2: standalone model not already prefixed
+        self.source = (
+            rf'(?i:(?:{prefix_alt})\s*({model_alt}))'
+            rf'|(?<![\w\u4e00-\u9fff])(?i:(?<!{new_prefix}\s))({model_alt})\b'
+        )
+        self.strip_source = rf'(?i:(?:{prefix_alt})\s*)'
+        self._compile()
+
+    def _compile(self):
+        """Compile the naming patterns and the canonical model lookup"""
+        self.regex = re.compile(self.source)
+        self.strip_regex = re.compile(self.strip_source)
+        self._canonical = {m.lower(): m for m in self.models}
+        self._starts, self._folded_starts = start_characters(self.prefixes + self.models, True)
+
+    @classmethod
+    def from_config(cls, naming: Dict[str, Any]) -> 'ProductNamer':
+        """Create a namer from a ``product_naming`` config section"""
+        return cls(
+            naming.get('remove_prefix'),
+            naming.get('add_prefix') or 'Chiral',
+            naming.get('model_names')
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Naming grammar and its pattern sources, for the on-disk rule cache"""
+        return {
+            'prefixes': self.prefixes,
+            'models': self.models,
+            'new_prefix': self.new_prefix,
+            'source': self.source,
+            'strip_source': self.strip_source
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'ProductNamer':
+        """Rebuild a namer from to_dict() output without deriving the grammar again"""
+        namer = cls.__new__(cls)
+        namer.prefixes = data['prefixes']
+        namer.models = data['models']
+        namer.new_prefix = data['new_prefix']
+        namer.source = data['source']
+        namer.strip_source = data['strip_source']
+        namer._compile()
+        return namer
+
+    def _expand(self, match) -> str:
+        """Replacement for one naming match"""
+        model = match.group(1) or match.group(2)
+        return f"{self.new_prefix} {self._canonical.get(model.lower(), model)}"
+
+    def _may_match(self, text: str) -> bool:
+        """False when no prefix or model can start anywhere in the text"""
+        if not text:
+            return False
+        if text.isascii():
+            return not self._starts.isdisjoint(text)
+        return not self._folded_starts.isdisjoint(text.casefold())
+
+    def rename(self, text: str) -> Tuple[str, int]:
+        """Rewrite product names, returning new text and number of rewrites"""
+        if not self._may_match(text):
+            return text, 0
+        return self.regex.subn(self._expand, text)
+
+    def find_edits(self, text: str) -> List[Tuple[int, int, str]]:
+        """(start, end, replacement) edits that rename() would apply, no-ops left out"""
+        if not self._may_match(text):
+            return []
+        edits = []
+        for match in self.regex.finditer(text):
+            replacement = self._expand(match)
+            if replacement != match.group():
+                edits.append((match.start(), match.end(), replacement))
+        return edits
+
+    @property
+    def window(self) -> int:
+        """Longest naming match considered when streaming
+        
+        Whitespace between an old prefix and the model is unbounded in the
+        pattern; runs longer than this slack are not joined across chunks.
+        """
+        longest_prefix = max((len(p) for p in self.prefixes), default=0)
+        longest_model = max((len(m) for m in self.models), default=0)
+        return longest_prefix + longest_model + 16
+
+    def stream(self, chunks: Iterable[str], counts: Optional[List[int]] = None) -> Iterator[str]:
+        """Rewrite product names in chunked text, adding rewrites to ``counts[0]``"""
+        expand = self._expand
+        if counts is not None:
+            def expand(match):
+                replacement = self._expand(match)
+                if replacement != match.group():
+                    counts[0] += 1
+                return replacement
+        
+        yield from stream_sub(chunks, self.regex, expand, self.window,
+                              max(STREAM_CONTEXT, len(self.new_prefix) + 2))
+
+    def strip_prefixes(self, text: str) -> str:
+        """Remove old prefixes without adding the new one (used for filenames)"""
+        return self.strip_regex.sub('', text)
+
+
+class ReplacementStats:
+    """Per-rule and per-page hit counts collected during replacement
+
+    Counts live in flat arrays: ``totals`` holds one slot per rule and
+    ``page_counts`` holds one row of rule slots per recorded page, labelled
+    by ``pages``. Objects pickle cheaply and merge by addition, so results
+    from several documents or worker processes combine without rescanning.
+    """
+
+    def __init__(self, rules: List[str]):
+        """Create empty statistics for the given rule keys"""
+        self.rules = list(rules)
+        self.totals = array('Q', bytes(8 * len(self.rules)))
+        self.pages: List[Tuple[str, int]] = []
+        self.page_counts = array('I')
+
+    def add_page(self, page_number: int, counts: List[int], document: str = ''):
+        """Record the per-rule counts of one page"""
+        self.pages.append((document, page_number))
+        self.page_counts.extend(counts)
+        totals = self.totals
+        for rule, count in enumerate(counts):
+            if count:
+                totals[rule] += count
+
+    def merge(self, other: 'ReplacementStats') -> 'ReplacementStats':
+        """Add another statistics object into this one and return self"""
+        if other.rules == self.rules:
+            for rule, count in enumerate(other.totals):
+                self.totals[rule] += count
+            self.pages.extend(other.pages)
+            self.page_counts.extend(other.page_counts)
+            return self
+
+        # Different rule sets: remap columns by rule key
+        for rule in other.rules:
+            if rule not in self.rules:
+                self._add_rule(rule)
+        index = {rule: i for i, rule in enumerate(self.rules)}
+        width = len(other.rules)
+        for row, label in enumerate(other.pages):
+            counts = [0] * len(self.rules)
+            for column, count in enumerate(other.page_counts[row * width:(row + 1) * width]):
+                counts[index[other.rules[column]]] = count
+            self.add_page(label[1], counts, label[0])
+        return self
+
+    def _add_rule(self, rule: str):
+        """Append a rule column, widening the existing page rows"""
+        width = len(self.rules)
+        rows = array('I')
+        for row in range(len(self.pages)):
+            rows.extend(self.page_counts[row * width:(row + 1) * width])
+            rows.append(0)
+        self.rules.append(rule)
+        self.totals.append(0)
+        self.page_counts = rows
+
+    @property
+    def total(self) -> int:
+        """Total hits over all rules"""
+        return sum(self.totals)
+
+    def as_dict(self, include_zero: bool = False) -> Dict[str, int]:
+        """Rule -> total hits"""
+        return {rule: count for rule, count in zip(self.rules, self.totals)
+                if count or include_zero}
+
+    def page_totals(self) -> Dict[Tuple[str, int], int]:
+        """(document, page) -> total hits on that page"""
+        width = len(self.rules)
+        return {
+            label: sum(self.page_counts[row * width:(row + 1) * width])
+            for row, label in enumerate(self.pages)
+        }
+
+
+class EditScript:
+    """Compact log of the edits applied to a document, replayable both ways
+
+    Each entry is one edit of one span: page index, span index (PAGE_TEXT
+    for the page text), stage, offset and length in the stage's input text,
+    rule id (negative for non-rule edits) and the ids of the replacement and
+    original text in an interned string table. Columns are flat arrays, so a
+    document's log costs a few bytes per edit plus its distinct strings.
+
+    Entries of one (page, span, stage) are recorded together and in text
+    order; applying or reverting touches each span once per stage.
+    """
+
+    VERSION = 1
+    COLUMNS = (('pages', 'I'), ('spans', 'i'), ('stages', 'B'), ('offsets', 'I'),
+               ('lengths', 'I'), ('rules', 'i'), ('replacements', 'I'), ('originals', 'I'))
+
+    def __init__(self):
+        """Create an empty edit script"""
+        for name, typecode in self.COLUMNS:
+            setattr(self, name, array(typecode))
+        self.strings: List[str] = []
+        self._string_ids: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def _intern(self, text: str) -> int:
+        """Id of ``text`` in the string table"""
+        string_id = self._string_ids.get(text)
+        if string_id is None:
+            string_id = len(self.strings)
+            self.strings.append(text)
+            self._string_ids[text] = string_id
+        return string_id
+
+    def record(self, page: int, span: int, stage: int, text: str,
+               edits: List[Tuple[int, int, str, int]]):
+        """Log sorted (start, end, replacement, rule) edits applied to ``text``"""
+        for start, end, replacement, rule in edits:
+            self.pages.append(page)
+            self.spans.append(span)
+            self.stages.append(stage)
+            self.offsets.append(start)
+            self.lengths.append(end - start)
+            self.rules.append(rule)
+            self.replacements.append(self._intern(replacement))
+            self.originals.append(self._intern(text[start:end]))
+
+    def extend(self, other: 'EditScript') -> 'EditScript':
+        """Append the entries of another script (e.g. from a page worker) and return self"""
+        ids = [self._intern(text) for text in other.strings]
+        for name in ('pages', 'spans', 'stages', 'offsets', 'lengths', 'rules'):
+            getattr(self, name).extend(getattr(other, name))
+        self.replacements.extend(ids[i] for i in other.replacements)
+        self.originals.extend(ids[i] for i in other.originals)
+        return self
+
+    def _groups(self) -> List[Tuple[int, int]]:
+        """(first, last + 1) entry ranges sharing page, span and stage"""
+        groups = []
+        first = 0
+        for i in range(1, len(self) + 1):
+            if (i == len(self) or self.pages[i] != self.pages[first]
+                    or self.spans[i] != self.spans[first]
+                    or self.stages[i] != self.stages[first]):
+                groups.append((first, i))
+                first = i
+        return groups
+
+    @staticmethod
+    def _target(pdf_data: Dict[str, Any], page: int, span: int) -> Tuple[Dict[str, Any], str]:
+        """Dict holding the text of one span (or of the page text)"""
+        page_data = pdf_data['pages'][page]
+        return page_data if span == PAGE_TEXT else page_data['blocks'][span], 'text'
+
+    def apply(self, pdf_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Replay the edits on the original document content"""
+        strings = self.strings
+        for first, last in self._groups():
+            holder, key = self._target(pdf_data, self.pages[first], self.spans[first])
+            holder[key] = apply_edits(holder[key], [
+                (self.offsets[i], self.offsets[i] + self.lengths[i], strings[self.replacements[i]])
+                for i in range(first, last)
+            ])
+        return pdf_data
+
+    def revert(self, pdf_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Undo the edits on processed content, restoring the original text"""
+        strings = self.strings
+        for first, last in reversed(self._groups()):
+            holder, key = self._target(pdf_data, self.pages[first], self.spans[first])
+            edits = []
+            shift = 0
+            for i in range(first, last):
+                # Offsets are in the stage's input; move them into its output
+                replacement = strings[self.replacements[i]]
+                start = self.offsets[i] + shift
+                edits.append((start, start + len(replacement), strings[self.originals[i]]))
+                shift += len(replacement) - self.lengths[i]
+            holder[key] = apply_edits(holder[key], edits)
+        return pdf_data
+
+    def changed_spans(self) -> Dict[int, List[int]]:
+        """Page index -> spans whose visible text was edited (not only normalised)"""
+        changed: Dict[int, set] = {}
+        for page, span, stage in zip(self.pages, self.spans, self.stages):
+            if span != PAGE_TEXT and stage != STAGE_NORMALIZE:
+                changed.setdefault(page, set()).add(span)
+        return {page: sorted(spans) for page, spans in changed.items()}
+
+    def rule_counts(self) -> Dict[int, int]:
+        """Rule id -> number of logged edits"""
+        counts: Dict[int, int] = {}
+        for rule in self.rules:
+            counts[rule] = counts.get(rule, 0) + 1
+        return counts
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Serialisable form of the script"""
+        data = {name: getattr(self, name).tolist() for name, _ in self.COLUMNS}
+        data['version'] = self.VERSION
+        data['strings'] = self.strings
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'EditScript':
+        """Rebuild a script from to_dict() output"""
+        if data.get('version') != cls.VERSION:
+            raise ValueError(f"Unsupported edit script version: {data.get('version')}")
+        script = cls()
+        for name, typecode in cls.COLUMNS:
+            setattr(script, name, array(typecode, data[name]))
+        script.strings = list(data['strings'])
+        script._string_ids = {text: i for i, text in enumerate(script.strings)}
+        return script
+
+    def save(self, path: Path):
+        """Write the script as JSON, typically next to the output PDF"""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def load(cls, path: Path) -> 'EditScript':
+        """Read a script written by save()"""
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
+
+
+class LRUCache:
+    """Bounded least-recently-used cache with hit, miss and eviction counters"""
+
+    COUNTERS = ('hits', 'misses', 'evictions')
+
+    def __init__(self, max_size: int = 4096):
+        """Create an empty cache holding at most ``max_size`` entries"""
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Return the cached value, marking it most recently used"""
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entry when full"""
+        if self.max_size <= 0:
+            return
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drop all entries, keeping the counters"""
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def info(self) -> Dict[str, int]:
+        """Counters for reporting"""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'size': len(self._entries),
+            'max_size': self.max_size
+        }
+
+    def counts_since(self, info: Dict[str, int]) -> Dict[str, int]:
+        """Hits, misses and evictions since ``info`` was taken"""
+        return {counter: getattr(self, counter) - info[counter] for counter in self.COUNTERS}
+
+    def merge(self, counts: Dict[str, int]) -> 'LRUCache':
+        """Add the counts of another cache, such as a page worker's (see counts_since)"""
+        for counter in self.COUNTERS:
+            setattr(self, counter, getattr(self, counter) + counts.get(counter, 0))
+        return self
+
+
 class TextReplacer:
     """Handles text replacement operations with context awareness"""
     
-    def __init__(self, replacement_rules: Dict[str, str]):
-        """Initialize text replacer with replacement rules"""
+    def __init__(self, replacement_rules: Dict[str, str], rule_set: Optional[Any] = None,
+                 product_naming: Optional[Dict[str, Any]] = None, cache_size: int = 4096,
+                 fuzzy_matcher: Optional[Any] = None):
+        """Initialize text replacer with replacement rules
+        
+        ``rule_set`` is an optional CompiledRuleSet (see rule_cache.py) whose
+        compiled matcher and product namer are reused instead of building
+        new ones. ``product_naming`` is the config section used otherwise.
+        ``cache_size`` bounds the memo of repeated span texts (0 disables it).
+        ``fuzzy_matcher`` is an optional FuzzyBrandMatcher (see
+        fuzzy_matcher.py) run over each page in page mode.
+        """
         self.rules = replacement_rules
         self.case_sensitive = False
         self.context_window = 50  # Characters around replacement for context
+        self.rule_set = rule_set
+        self.fuzzy_matcher = fuzzy_matcher
         
-        # Compile regex patterns for efficiency
-        self.patterns = self._compile_patterns()
+        # Combined single-pass matcher used for the actual replacement
+        if self.rule_set is not None:
+            self.matcher = self.rule_set.matcher
+        else:
+            self.matcher = RuleMatcher(self.rules, self.case_sensitive)
         
-        # Product naming patterns
-        self.product_patterns = {
-            'models': ['Lite3', 'Lite2', 'Mini', 'X20', 'X30', 'J60'],
-            'prefixes_to_remove': ['Jueying', '绝影', 'JUEYING'],
-            'new_prefix': 'Chiral'
-        }
-    
-    def _compile_patterns(self) -> Dict[str, re.Pattern]:
-        """Compile regex patterns for replacements"""
-        patterns = {}
-        
-        for old_text, new_text in self.rules.items():
-            # Create pattern with word boundaries where appropriate
-            if old_text.replace(' ', '').isalnum():
-                # For alphanumeric strings, use word boundaries
-                pattern = re.compile(
-                    r'\b' + re.escape(old_text) + r'\b',
-                    re.IGNORECASE if not self.case_sensitive else 0
-                )
-            else:
-                # For other strings (URLs, emails, etc.), exact match
-                pattern = re.compile(
-                    re.escape(old_text),
-                    re.IGNORECASE if not self.case_sensitive else 0
-                )
-            
-            patterns[old_text] = pattern
+        # Product naming grammar
+        if self.rule_set is not None:
+            self.product_namer = self.rule_set.namer
+        else:
+            self.product_namer = ProductNamer.from_config(product_naming or {})
         
-        return patterns
+        # Memo of repeated span texts (headers, footers, table labels)
+        self.span_cache = LRUCache(cache_size)
+        self.rule_key = self.rule_set.digest if self.rule_set is not None else self.matcher.source
     
-    def replace_all(self, pdf_data: Dict[str, Any]) -> Dict[str, Any]:
-        """Replace all text in PDF data according to rules"""
+    def replace_all(self, pdf_data: Dict[str, Any], page_mode: bool = True) -> Dict[str, Any]:
+        """Replace all text in PDF data according to rules
+        
+        In page mode the matcher runs once over each page's text and the
+        resulting edits are mapped onto the spans in ``blocks``; otherwise
+        the page text and every span are processed independently.
+        """
         replaced_count = 0
         
+        # Hit counts are a by-product of the replacement pass
+        stats = ReplacementStats(self.matcher.keys)
+        pdf_data['replacement_stats'] = stats
+        
+        # Near-matches found by the fuzzy matcher, replaced or only flagged
+        fuzzy_hits: List[Dict[str, Any]] = []
+        if self.fuzzy_matcher is not None:
+            pdf_data['fuzzy_hits'] = fuzzy_hits
+        
+        # Log of the page-mode edits, used for rollback
+        script = EditScript()
+        pdf_data['edit_script'] = script
+        
         try:
             # Process each page
-            for page_data in pdf_data['pages']:
-                # Replace in full text
-                if 'text' in page_data:
-                    page_data['text'], count = self._replace_text(page_data['text'])
-                    replaced_count += count
-                
-                # Replace in text blocks
-                for block in page_data.get('blocks', []):
-                    if 'text' in block:
-                        block['text'], count = self._replace_text(block['text'])
-                        replaced_count += count
+            for page_index in range(len(pdf_data['pages'])):
+                replaced_count += self._replace_one_page(
+                    pdf_data, page_index, page_mode, stats, fuzzy_hits, script
+                )
             
             logger.info(f"Total replacements made: {replaced_count}")
+            if fuzzy_hits:
+                logger.info(f"Fuzzy brand matches found: {len(fuzzy_hits)}")
             
         except Exception as e:
             logger.error(f"Error during text replacement: {e}")
         
         return pdf_data
     
+    def _replace_one_page(self, pdf_data: Dict[str, Any], page_index: int, page_mode: bool,
+                          stats: ReplacementStats, fuzzy_hits: List[Dict[str, Any]],
+                          script: EditScript) -> int:
+        """Replace text on one page of ``pdf_data`` and return its replacement count"""
+        page_data = pdf_data['pages'][page_index]
+        if page_data.get('pass_through'):
+            return 0  # Triaged as having no hits (PDFProcessor.triage)
+        page_number = page_data.get('number', page_index + 1)
+        document = str(pdf_data.get('path', ''))
+        
+        if page_mode and page_data.get('text'):
+            page_hits = len(fuzzy_hits)
+            page_edits = len(script)
+            counts = self._replace_page(page_data, fuzzy_hits, script, page_index)
+            for hit in fuzzy_hits[page_hits:]:
+                hit['page'] = page_number
+            stats.add_page(page_number, counts, document)
+            
+            # Lazily loaded pages (pdf_processor.LazyPage) keep only what changed
+            if hasattr(page_data, 'release'):
+                if len(script) > page_edits:
+                    page_data.mark_modified()
+                else:
+                    page_data.release()
+            return sum(counts)
+        
+        replaced_count = 0
+        
+        # Replace in full text
+        if 'text' in page_data:
+            page_data['text'], counts = self.matcher.replace(page_data['text'])
+            page_data['text'] = self._update_product_names(page_data['text'])
+            stats.add_page(page_number, counts, document)
+            replaced_count += sum(counts)
+        
+        # Replace in text blocks
+        for block in page_data.get('blocks', []):
+            if 'text' in block:
+                block['text'], count = self._replace_text(block['text'])
+                replaced_count += count
+        
+        return replaced_count
+    
+    def replace_page_range(self, pdf_data: Dict[str, Any], start: int, stop: int,
+                           triage: bool = False) -> Dict[str, Any]:
+        """Replace text on pages ``start`` to ``stop`` and return compact results
+        
+        Runs in page workers (pdf_processor.PagePool), each with its own open
+        copy of the document. Per page, the result holds whether it passed
+        triage and, if edited, its final text, edit log, link index and the
+        edited spans only; per chunk, the statistics, fuzzy hits, edit
+        script and the span cache counts of this chunk. merge_page_results()
+        applies them to the parent's pdf_data and span cache.
+        """
+        cache_before = self.span_cache.info()
+        stats = ReplacementStats(self.matcher.keys)
+        fuzzy_hits: List[Dict[str, Any]] = []
+        script = EditScript()
+        pages = []
+        
+        for page_index in range(start, stop):
+            page_data = pdf_data['pages'][page_index]
+            result = {'index': page_index, 'pass_through': False}
+            pages.append(result)
+            
+            if triage and not self.has_hits(page_data.get('text') or ''):
+                result['pass_through'] = True
+            else:
+                page_edits = len(script)
+                self._replace_one_page(pdf_data, page_index, True, stats, fuzzy_hits, script)
+                if len(script) > page_edits:
+                    spans = sorted(set(script.spans[page_edits:]) - {PAGE_TEXT})
+                    blocks = page_data['blocks']
+                    result.update(
+                        text=page_data['text'],
+                        edits=page_data.get('edits', []),
+                        links=page_data.get('links', []),
+                        spans={span_index: blocks[span_index] for span_index in spans}
+                    )
+            
+            if hasattr(page_data, 'release'):
+                page_data.release(force=True)
+        
+        return {'pages': pages, 'stats': stats, 'fuzzy_hits': fuzzy_hits, 'script': script,
+                'cache': self.span_cache.counts_since(cache_before)}
+    
+    def merge_page_results(self, pdf_data: Dict[str, Any],
+                           chunks: Iterable[Dict[str, Any]]) -> List[int]:
+        """Apply replace_page_range() results, in page order, to ``pdf_data``
+        
+        Sets the same ``replacement_stats``, ``fuzzy_hits`` and
+        ``edit_script`` as replace_all(). Edited pages get their final
+        text, edit log and link index, and ``blocks`` becomes a {span index:
+        span} dict of the edited spans, which is all the in-place save and
+        the edit script look up. The workers' span cache counts are added
+        to this replacer's, so cache_info() covers the whole document.
+        Returns the numbers of pages with hits.
+        """
+        stats = ReplacementStats(self.matcher.keys)
+        pdf_data['replacement_stats'] = stats
+        fuzzy_hits: List[Dict[str, Any]] = []
+        if self.fuzzy_matcher is not None:
+            pdf_data['fuzzy_hits'] = fuzzy_hits
+        script = EditScript()
+        pdf_data['edit_script'] = script
+        hit_pages = []
+        
+        for chunk in chunks:
+            stats.merge(chunk['stats'])
+            self.span_cache.merge(chunk['cache'])
+            fuzzy_hits.extend(chunk['fuzzy_hits'])
+            script.extend(chunk['script'])
+            
+            for result in chunk['pages']:
+                page_data = pdf_data['pages'][result['index']]
+                if result['pass_through']:
+                    page_data['pass_through'] = True
+                    continue
+                hit_pages.append(page_data.get('number', result['index'] + 1))
+                if 'spans' in result:
+                    page_data['links'] = result['links']
+                    page_data['text'] = result['text']
+                    page_data['edits'] = result['edits']
+                    page_data['blocks'] = result['spans']
+        
+        logger.info(f"Total replacements made: {stats.total}")
+        if fuzzy_hits:
+            logger.info(f"Fuzzy brand matches found: {len(fuzzy_hits)}")
+        return hit_pages
+    
+    def _replace_page(self, page_data: Dict[str, Any],
+                      fuzzy_hits: Optional[List[Dict[str, Any]]] = None,
+                      script: Optional[EditScript] = None, page_index: int = 0) -> List[int]:
+        """Run the matcher once over the page text and apply edits to both views
+        
+        Returns the per-rule hit counts of the page. Fuzzy matches are
+        appended to ``fuzzy_hits`` and, if the matcher replaces, edited in
+        alongside the exact matches. The applied (start, end, replacement,
+        rule) edits, product naming included, are kept in
+        ``page_data['edits']`` against the original text for link
+        validation and, per span, logged to ``script`` when given.
+        """
+        spans = page_data.get('blocks', [])
+        original_text = page_data['text']
+        page_text = self._normalize(page_data, PAGE_TEXT, script, page_index)
+        if page_text is not original_text:
+            # Decomposed characters on the page; bring the spans into the same form
+            for span_index, span in enumerate(spans):
+                if span.get('text'):
+                    self._normalize(span, span_index, script, page_index)
+            if 'links' in page_data:
+                page_data['links'] = index_links(page_text)
+        
+        offsets = self._span_offsets(page_text, spans)
+        matches = list(self.matcher.finditer(page_text))
+        values = self.matcher.values
+        edits = [(start, end, values[rule], rule) for start, end, rule in matches]
+        
+        if self.fuzzy_matcher is not None:
+            hits = self._fuzzy_hits(page_text, matches)
+            if fuzzy_hits is not None:
+                fuzzy_hits.extend(hits)
+            if self.fuzzy_matcher.replace_hits and hits:
+                edits.extend((hit['start'], hit['end'], hit['replacement'], RULE_FUZZY) for hit in hits)
+                edits.sort()
+        
+        page_data['edits'] = edits
+        if edits:
+            self._edit(page_data, PAGE_TEXT, STAGE_RULES, edits, script, page_index)
+            for span_index, span_edits in self._map_to_spans(edits, offsets, spans).items():
+                self._edit(spans[span_index], span_index, STAGE_RULES, span_edits, script, page_index)
+        
+        for span_index, (span, offset) in enumerate(zip(spans, offsets)):
+            if offset < 0 and span.get('text'):
+                # Span not found in the page text, process it on its own
+                self._edit(span, span_index, STAGE_RULES, self._rule_edits(span['text']),
+                           script, page_index)
+        
+        self._rename_page(page_data, spans, self._shift_offsets(offsets, edits), script, page_index)
+        
+        counts = [0] * len(self.matcher.keys)
+        for _, _, rule in matches:
+            counts[rule] += 1
+        return counts
+    
+    @staticmethod
+    def _edit(holder: Dict[str, Any], span_index: int, stage: int,
+              edits: List[Tuple[int, int, str, int]], script: Optional[EditScript], page_index: int):
+        """Apply edits to ``holder['text']``, logging them to the script"""
+        if not edits:
+            return
+        if script is not None:
+            script.record(page_index, span_index, stage, holder['text'], edits)
+        holder['text'] = apply_edits(holder['text'], edits)
+    
+    @staticmethod
+    def _normalize(holder: Dict[str, Any], span_index: int, script: Optional[EditScript],
+                   page_index: int) -> str:
+        """NFC form of ``holder['text']``, logged as a whole-text edit when it changes"""
+        text = holder['text']
+        normalized = normalize_text(text)
+        if normalized is not text:
+            if script is not None:
+                script.record(page_index, span_index, STAGE_NORMALIZE, text,
+                              [(0, len(text), normalized, RULE_NORMALIZE)])
+            holder['text'] = normalized
+        return normalized
+    
+    @staticmethod
+    def _span_offsets(page_text: str, spans: List[Dict[str, Any]]) -> List[int]:
+        """Start offset of each span's text within the page text, -1 if not located
+        
+        Spans are extracted in the same reading order as the page text, so
+        each one is searched for from the end of the previous one.
+        """
+        offsets = []
+        cursor = 0
+        
+        for span in spans:
+            text = span.get('text')
+            found = page_text.find(text, cursor) if text else -1
+            offsets.append(found)
+            if found >= 0:
+                cursor = found + len(text)
+        
+        return offsets
+    
+    @staticmethod
+    def _shift_offsets(offsets: List[int], edits: List[Tuple[int, int, str, int]]) -> List[int]:
+        """Span offsets in the page text once ``edits`` are applied
+        
+        Follows _map_to_spans: a span starting inside a match that began in
+        an earlier span now starts right after that match's replacement.
+        """
+        shifted = []
+        shift = 0
+        k = 0
+        
+        for offset in offsets:
+            if offset < 0:
+                shifted.append(offset)
+                continue
+            while k < len(edits) and edits[k][1] <= offset:
+                start, end, replacement, _ = edits[k]
+                shift += len(replacement) - (end - start)
+                k += 1
+            if k < len(edits) and edits[k][0] < offset:
+                shifted.append(edits[k][0] + shift + len(edits[k][2]))
+            else:
+                shifted.append(offset + shift)
+        
+        return shifted
+    
+    def _rename_page(self, page_data: Dict[str, Any], spans: List[Dict[str, Any]],
+                     offsets: List[int], script: Optional[EditScript], page_index: int) -> bool:
+        """Apply product naming once to the page text and map it onto the spans
+        
+        ``offsets`` locate the spans in the current page text, as in
+        _map_to_spans, so names split across spans are renamed in the spans
+        too; spans not located (-1) are renamed on their own. The naming
+        edits are composed into ``page_data['edits']``. Returns whether
+        anything changed.
+        """
+        changed = False
+        name_edits = self._name_edits(page_data.get('text') or '')
+        if name_edits:
+            # Naming edits are against the replaced text; log them against the original
+            page_data['edits'] = compose_edits(page_data['text'], page_data.get('edits', []), name_edits)
+            self._edit(page_data, PAGE_TEXT, STAGE_NAMING, name_edits, script, page_index)
+            for span_index, span_edits in self._map_to_spans(name_edits, offsets, spans).items():
+                self._edit(spans[span_index], span_index, STAGE_NAMING, span_edits, script, page_index)
+            changed = True
+        
+        for span_index, (span, offset) in enumerate(zip(spans, offsets)):
+            if offset < 0 and span.get('text'):
+                span_edits = self._name_edits(span['text'])
+                self._edit(span, span_index, STAGE_NAMING, span_edits, script, page_index)
+                changed = changed or bool(span_edits)
+        
+        return changed
+    
+    def _fuzzy_hits(self, page_text: str, matches: List[Tuple[int, int, int]]) -> List[Dict[str, Any]]:
+        """Fuzzy matches of the page that do not overlap an exact match"""
+        starts = [start for start, _, _ in matches]
+        hits = []
+        
+        for hit in self.fuzzy_matcher.find(page_text):
+            k = bisect_right(starts, hit['start']) - 1
+            if k >= 0 and matches[k][1] > hit['start']:
+                continue
+            if k + 1 < len(matches) and matches[k + 1][0] < hit['end']:
+                continue
+            if not self.fuzzy_matcher.replace_hits:
+                logger.warning(f"Possible brand mention '{hit['matched']}' "
+                               f"(near '{hit['term']}', distance {hit['distance']})")
+            hits.append(hit)
+        
+        return hits
+    
+    @staticmethod
+    def _map_to_spans(edits: List[Tuple[int, int, str, int]], offsets: List[int],
+                      spans: List[Dict[str, Any]]) -> Dict[int, List[Tuple[int, int, str, int]]]:
+        """Translate page-level edits into per-span (start, end, replacement, rule) edits
+        
+        The span owning a match start is found by binary search over span
+        start offsets. A match crossing span boundaries puts the replacement
+        in the first span and removes the matched text from the others.
+        """
+        located = [(offset, index) for index, offset in enumerate(offsets) if offset >= 0]
+        starts = [offset for offset, _ in located]
+        ends = [offset + len(spans[index]['text']) for offset, index in located]
+        span_edits: Dict[int, List[Tuple[int, int, str, int]]] = {}
+        
+        for start, end, replacement, rule in edits:
+            k = max(bisect_right(starts, start) - 1, 0)
+            
+            while k < len(located) and starts[k] < end:
+                if ends[k] > start:
+                    offset, index = located[k]
+                    span_edits.setdefault(index, []).append(
+                        (max(start, offset) - offset, min(end, ends[k]) - offset, replacement, rule)
+                    )
+                    replacement = ''
+                k += 1
+        
+        return span_edits
+    
     def _replace_text(self, text: str) -> Tuple[str, int]:
         """Replace text according to rules and return count"""
         if not text:
             return text, 0
         
-        original_text = text
-        replacement_count = 0
+        if len(text) > MAX_CACHED_TEXT_LENGTH:
+            return self._replace_text_uncached(text)
         
-        # Apply each replacement rule
-        for old_text, new_text in self.rules.items():
-            pattern = self.patterns.get(old_text)
-            if pattern:
-                # Count replacements
-                matches = pattern.findall(text)
-                replacement_count += len(matches)
-                
-                # Perform replacement
-                text = pattern.sub(new_text, text)
+        key = (self.rule_key, 'replace', text)
+        result = self.span_cache.get(key)
+        if result is None:
+            result = self._replace_text_uncached(text)
+            self.span_cache.put(key, result)
+        return result
+    
+    def _replace_text_uncached(self, text: str) -> Tuple[str, int]:
+        """Apply rules and product naming to one string"""
+        text, counts = self.replace_text(text)
+        replacement_count = sum(counts.values())
         
         # Handle product naming
         text = self._update_product_names(text)
@@ -105,59 +1241,164 @@ class TextReplacer:
         
         return text, replacement_count
     
+    def has_hits(self, text: str) -> bool:
+        """Whether the replacement pass would find anything in ``text``
+        
+        Covers rules, product naming and (when enabled) fuzzy matching;
+        used to triage pages before any span-level work.
+        """
+        if not text:
+            return False
+        text = normalize_text(text)
+        if next(self.matcher.finditer(text), None) is not None:
+            return True
+        if self.product_namer.find_edits(text):
+            return True
+        return self.fuzzy_matcher is not None and bool(self.fuzzy_matcher.find(text))
+    
+    def replace_text(self, text: str) -> Tuple[str, Dict[str, int]]:
+        """Apply replacement rules in a single pass, returning per-rule counts"""
+        text, counts = self.matcher.replace(text)
+        return text, {old: count for old, count in zip(self.matcher.keys, counts) if count}
+    
+    def replace_stream(self, source: TextIO, destination: TextIO,
+                       chunk_size: int = STREAM_CHUNK_SIZE,
+                       name_counts: Optional[List[int]] = None) -> Dict[str, int]:
+        """Replace text read from ``source`` in fixed-size chunks, writing as it goes
+        
+        Produces the same output as _replace_text on the whole input while
+        holding only one chunk plus the rule window in memory. Returns the
+        per-rule counts; product name rewrites are added to
+        ``name_counts[0]`` when given.
+        """
+        counts = [0] * len(self.matcher.keys)
+        chunks = iter(lambda: source.read(chunk_size), '')
+        
+        for piece in self.product_namer.stream(self.matcher.stream(chunks, counts), name_counts):
+            destination.write(piece)
+        
+        return {old: count for old, count in zip(self.matcher.keys, counts) if count}
+    
+    def replace_file(self, input_path: Path, output_path: Path,
+                     chunk_size: int = STREAM_CHUNK_SIZE,
+                     name_counts: Optional[List[int]] = None) -> Dict[str, int]:
+        """Stream-replace a text file into ``output_path``"""
+        with open(input_path, 'r', encoding='utf-8') as source, \
+             open(output_path, 'w', encoding='utf-8') as destination:
+            return self.replace_stream(source, destination, chunk_size, name_counts)
+    
     def _update_product_names(self, text: str) -> str:
         """Update product naming according to strategy"""
-        # Remove old prefixes
-        for prefix in self.product_patterns['prefixes_to_remove']:
-            # Create pattern for prefix followed by model
-            for model in self.product_patterns['models']:
-                old_pattern = f"{prefix}\\s*{model}"
-                new_name = f"{self.product_patterns['new_prefix']} {model}"
-                
-                text = re.sub(
-                    old_pattern,
-                    new_name,
-                    text,
-                    flags=re.IGNORECASE
-                )
+        edits = self._name_edits(text)
+        return apply_edits(text, edits) if edits else text
+    
+    def _name_edits(self, text: str) -> List[Tuple[int, int, str, int]]:
+        """Product naming edits of ``text``, memoized for short texts"""
+        if not text or len(text) > MAX_CACHED_TEXT_LENGTH:
+            return self._name_edits_uncached(text)
         
-        # Also handle standalone model names
-        for model in self.product_patterns['models']:
-            # Check if model appears without any prefix
-            pattern = rf'\b(?<![\w\u4e00-\u9fff]){model}\b'
-            if re.search(pattern, text):
-                # Add Chiral prefix if not already present
-                if not re.search(rf'\bChiral\s+{model}\b', text, re.IGNORECASE):
-                    text = re.sub(
-                        pattern,
-                        f"{self.product_patterns['new_prefix']} {model}",
-                        text
-                    )
+        key = (self.rule_key, 'name', text)
+        result = self.span_cache.get(key)
+        if result is None:
+            result = self._name_edits_uncached(text)
+            self.span_cache.put(key, result)
+        return result
+    
+    def _name_edits_uncached(self, text: str) -> List[Tuple[int, int, str, int]]:
+        """Product naming edits tagged with RULE_NAMING"""
+        return [(start, end, replacement, RULE_NAMING)
+                for start, end, replacement in self.product_namer.find_edits(text)]
+    
+    def _rule_edits(self, text: str) -> List[Tuple[int, int, str, int]]:
+        """Replacement rule edits of one NFC string"""
+        values = self.matcher.values
+        return [(start, end, values[rule], rule) for start, end, rule in self.matcher.finditer(text)]
+    
+    def cache_info(self) -> Dict[str, int]:
+        """Span cache counters for the processing report"""
+        return self.span_cache.info()
+    
+    def rename_products(self, pdf_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Apply product naming to every page and text block
         
-        return text
+        Changes are logged to the document's edit script when it has one.
+        """
+        script = pdf_data.get('edit_script')
+        for page_index, page_data in enumerate(pdf_data['pages']):
+            spans = page_data.get('blocks', [])
+            if page_data.get('text'):
+                offsets = self._span_offsets(page_data['text'], spans)
+            else:
+                offsets = [-1] * len(spans)
+            changed = self._rename_page(page_data, spans, offsets, script, page_index)
+            
+            if hasattr(page_data, 'release'):
+                if changed:
+                    page_data.mark_modified()
+                else:
+                    page_data.release()
+        
+        return pdf_data
+    
+    def iter_replacements(self, pdf_data: Dict[str, Any],
+                          limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        """Lazily yield potential replacements page by page without applying them
+        
+        Each hit carries the page number, the rule and its replacement, the
+        surrounding context and the bbox of the span the match starts in
+        (None when the span cannot be located). Iteration stops after
+        ``limit`` hits when given.
+        """
+        if limit is not None and limit <= 0:
+            return
+        
+        found = 0
+        for page_index, page_data in enumerate(pdf_data['pages']):
+            page_text = page_data.get('text')
+            if not page_text:
+                continue
+            page_text = normalize_text(page_text)
+            
+            spans = None
+            for start, end, rule in self.matcher.finditer(page_text):
+                if spans is None:
+                    # Only pages with hits pay for the span offset table
+                    spans = page_data.get('blocks', [])
+                    offsets = self._span_offsets(page_text, spans)
+                    located = [(offset, index) for index, offset in enumerate(offsets) if offset >= 0]
+                    starts = [offset for offset, _ in located]
+                
+                bbox = None
+                k = bisect_right(starts, start) - 1
+                if k >= 0:
+                    offset, index = located[k]
+                    if start < offset + len(spans[index]['text']):
+                        bbox = spans[index].get('bbox')
+                
+                yield {
+                    'page': page_data.get('number', page_index + 1),
+                    'rule': self.matcher.keys[rule],
+                    'replacement': self.matcher.values[rule],
+                    'matched': page_text[start:end],
+                    'context': page_text[max(0, start - self.context_window):end + self.context_window],
+                    'bbox': bbox
+                }
+                
+                found += 1
+                if limit is not None and found >= limit:
+                    return
+            
+            # Previewing changes nothing, so lazily loaded pages can be dropped
+            if hasattr(page_data, 'release'):
+                page_data.release()
     
     def find_replacements(self, pdf_data: Dict[str, Any]) -> List[Tuple[str, str, str]]:
         """Find all potential replacements without applying them"""
         replacements = []
         
         try:
-            # Search through all text
-            all_text = ""
-            
-            for page_data in pdf_data['pages']:
-                if 'text' in page_data:
-                    all_text += page_data['text'] + "\n"
-            
-            # Find matches for each rule
-            for old_text, new_text in self.rules.items():
-                pattern = self.patterns.get(old_text)
-                if pattern:
-                    for match in pattern.finditer(all_text):
-                        start = max(0, match.start() - self.context_window)
-                        end = min(len(all_text), match.end() + self.context_window)
-                        context = all_text[start:end]
-                        
-                        replacements.append((old_text, new_text, context))
+            for hit in self.iter_replacements(pdf_data):
+                replacements.append((hit['rule'], hit['replacement'], hit['context']))
         
         except Exception as e:
             logger.error(f"Error finding replacements: {e}")
@@ -183,7 +1424,7 @@ class TextReplacer:
     
     def add_product_prefix(self, pdf_data: Dict[str, Any], prefix: str) -> Dict[str, Any]:
         """Add prefix to product model names"""
-        for model in self.product_patterns['models']:
+        for model in self.product_namer.models:
             # Pattern to find standalone model names
             pattern = re.compile(
                 rf'\b(?<!{re.escape(prefix)}\s){model}\b',
@@ -267,36 +1508,34 @@ class TextReplacer:
         return True
     
     def handle_chinese_text(self, text: str) -> str:
-        """Special handling for Chinese text replacements"""
-        # Normalize Unicode for consistent matching
-        text = unicodedata.normalize('NFC', text)
-        
-        # Apply Chinese-specific replacements
-        chinese_rules = {
-            '云深处科技': 'CHIRAL',
-            '杭州云深处科技有限公司': 'Chiral Robotics',
-            '绝影': '',  # Remove Jueying Chinese name
-            '中国杭州': '[Address TBD]',
-            '浙江省杭州市': '[Address TBD]'
-        }
-        
-        for old, new in chinese_rules.items():
-            text = text.replace(old, new)
+        """Special handling for Chinese text replacements
         
+        Chinese rules (language_settings.chinese_replacements) are part of
+        the main matcher, so this is the regular single-pass replacement;
+        绝影 before a model name is rewritten by the product namer.
+        """
+        text, _ = self._replace_text(text)
         return text
     
+    def collect_stats(self, pdf_data: Dict[str, Any]) -> ReplacementStats:
+        """Count hits per rule and page without applying replacements"""
+        stats = ReplacementStats(self.matcher.keys)
+        document = str(pdf_data.get('path', ''))
+        
+        for page_index, page_data in enumerate(pdf_data['pages']):
+            counts = [0] * len(self.matcher.keys)
+            for _, _, rule in self.matcher.finditer(page_data.get('text', '')):
+                counts[rule] += 1
+            stats.add_page(page_data.get('number', page_index + 1), counts, document)
+        
+        return stats
+    
     def get_replacement_stats(self, pdf_data: Dict[str, Any]) -> Dict[str, int]:
         """Get statistics about replacements to be made"""
-        stats = {rule: 0 for rule in self.rules.keys()}
-        
-        # Count occurrences
-        for page_data in pdf_data['pages']:
-            text = page_data.get('text', '')
-            
-            for old_text in self.rules.keys():
-                pattern = self.patterns.get(old_text)
-                if pattern:
-                    matches = pattern.findall(text)
-                    stats[old_text] += len(matches)
+        stats = pdf_data.get('replacement_stats')
+        if stats is None:
+            stats = self.collect_stats(pdf_data)
         
-        return stats
\ No newline at end of file
+        totals = {rule: 0 for rule in self.rules.keys()}
+        totals.update(stats.as_dict())
+        return totals
@@ -14,11 +14,11 @@ def check_python_version():
     version = sys.version_info
     print(f"   Version: {version.major}.{version.minor}.{version.micro}")
     
-    if version >= (3, 8):
+    if version >= (3, 10):
         print("   ✅ Python version is compatible")
         return True
     else:
-        print("   ❌ Python 3.8+ required")
+        print("   ❌ Python 3.10+ required")
         return False
 
 def check_project_structure():
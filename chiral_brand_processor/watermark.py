@@ -0,0 +1,184 @@
+"""
+Watermark Module - Stamps text on every page through one shared Form XObject
+"""
+
+import math
+import logging
+from typing import Dict, Tuple, Any, Optional
+
+import fitz  # PyMuPDF
+
+from text_replacer import CJK_PATTERN
+
+logger = logging.getLogger(__name__)
+
+# Resource name of the watermark form on every page
+RESOURCE_NAME = 'ChiralWatermark'
+
+# Size the template text is set at; placement scales it to the page
+TEMPLATE_FONT_SIZE = 72
+
+# Built-in font used for Chinese, Japanese and Korean watermark text
+CJK_FONT = 'china-s'
+
+
+def hex_to_rgb(color: str) -> Tuple[float, float, float]:
+    """(r, g, b) in 0..1 of a #rrggbb colour"""
+    color = color.lstrip('#')
+    return tuple(int(color[i:i + 2], 16) / 255 for i in (0, 2, 4))
+
+
+class Watermark:
+    """Stamps a text watermark on every page of a document
+
+    The text is drawn once into a Form XObject, and every page refers to
+    that form. Its placement (centred, rotated by ``angle`` as seen on
+    screen and scaled to fill ``size`` of the page) is worked out from
+    each page's own size and rotation. Pages of the same geometry share
+    their two small content streams as well, so a page gains no objects
+    of its own and the file grows by the same amount whatever its
+    length. The page's own content is bracketed with q/Q so that it
+    cannot leave the stamp transformed.
+    """
+
+    def __init__(self, text: str, fontname: str = 'helv', color: str = '#1e3a5f',
+                 opacity: float = 0.1, angle: float = 45, size: float = 0.7):
+        """Configure the watermark text, look and share of the page"""
+        self.text = text
+        self.fontname = CJK_FONT if CJK_PATTERN.search(text) else fontname
+        self.color = hex_to_rgb(color)
+        self.opacity = opacity
+        self.angle = angle
+        self.size = size
+
+    @classmethod
+    def from_config(cls, settings: Dict[str, Any]) -> Optional['Watermark']:
+        """Create a watermark from the ``watermark`` config section, None if disabled"""
+        if not settings.get('enabled', False) or not settings.get('text'):
+            return None
+        return cls(
+            settings['text'],
+            fontname=settings.get('font', 'helv'),
+            color=settings.get('color', '#1e3a5f'),
+            opacity=settings.get('opacity', 0.1),
+            angle=settings.get('angle', 45),
+            size=settings.get('size', 0.7)
+        )
+
+    def apply(self, doc: 'fitz.Document') -> int:
+        """Stamp every page of ``doc``, returning the number of pages stamped"""
+        if len(doc) == 0:
+            return 0
+
+        form, width, height = self._template(doc)
+        opening = self._new_stream(doc, b"q\n")
+        # Placement matrix -> xref of the content stream drawing the form there
+        stamps: Dict[Tuple[float, ...], int] = {}
+
+        for page in doc:
+            matrix = tuple(round(value, 4) for value in self._placement(page, width, height))
+            if matrix not in stamps:
+                stamps[matrix] = self._new_stream(
+                    doc, ("\nQ\nq %g %g %g %g %g %g cm /%s Do Q\n" % (matrix + (RESOURCE_NAME,))).encode('ascii')
+                )
+            self._add_resource(doc, page, form)
+            self._add_contents(doc, page, opening, stamps[matrix])
+
+        logger.info(f"Watermarked {len(doc)} pages ({len(stamps)} page layouts)")
+        return len(doc)
+
+    def _template(self, doc: 'fitz.Document') -> Tuple[int, float, float]:
+        """Draw the text on a scratch page and turn it into a Form XObject
+
+        Returns the form's xref and size. The scratch page is removed
+        again; the fonts and opacity state it set up stay with the form.
+        """
+        font = fitz.Font(self.fontname)
+        width = font.text_length(self.text, TEMPLATE_FONT_SIZE)
+        height = TEMPLATE_FONT_SIZE * (font.ascender - font.descender)
+
+        page = doc.new_page(width=width, height=height)
+        page.insert_text((0, TEMPLATE_FONT_SIZE * font.ascender), self.text,
+                         fontname=self.fontname, fontsize=TEMPLATE_FONT_SIZE,
+                         color=self.color, fill_opacity=self.opacity)
+        contents = page.read_contents()
+        resources = doc.xref_get_key(page.xref, 'Resources')[1]
+        doc.delete_page(page.number)
+
+        form = doc.get_new_xref()
+        doc.update_object(form, f"<</Type/XObject/Subtype/Form/BBox[0 0 {width:g} {height:g}]"
+                                f"/Resources {resources}>>")
+        doc.update_stream(form, contents)
+        return form, width, height
+
+    def _placement(self, page: 'fitz.Page', width: float, height: float) -> 'fitz.Matrix':
+        """Matrix placing the form centred on the page, in PDF coordinates
+
+        Built in the page's visible (rotated, top-down) coordinates and
+        mapped back, so the angle and size hold for rotated pages too.
+        """
+        visible = page.rect
+        radians = math.radians(self.angle)
+        cos, sin = abs(math.cos(radians)), abs(math.sin(radians))
+        scale = self.size * min(visible.width / (width * cos + height * sin),
+                                visible.height / (width * sin + height * cos))
+        centre = (visible.tl + visible.br) / 2
+
+        # Form space is bottom-up: centre it, flip it upright, then turn it
+        # counter-clockwise as seen on screen
+        return (fitz.Matrix(1, 0, 0, 1, -width / 2, -height / 2) *
+                fitz.Matrix(1, 0, 0, -1, 0, 0) *
+                fitz.Matrix(-self.angle) *
+                fitz.Matrix(scale, scale) *
+                fitz.Matrix(1, 0, 0, 1, centre.x, centre.y) *
+                ~page.rotation_matrix *
+                ~page.transformation_matrix)
+
+    @staticmethod
+    def _new_stream(doc: 'fitz.Document', data: bytes) -> int:
+        """Add a content stream object to ``doc``"""
+        xref = doc.get_new_xref()
+        doc.update_object(xref, "<<>>")
+        doc.update_stream(xref, data)
+        return xref
+
+    @staticmethod
+    def _add_resource(doc: 'fitz.Document', page: 'fitz.Page', form: int):
+        """Name the watermark form in the page's XObject resources"""
+        kind, value = doc.xref_get_key(page.xref, 'Resources')
+        if kind == 'null':
+            # Inherited from the page tree: give the page the inherited entry
+            parent = page.xref
+            while kind == 'null':
+                parent_kind, parent_ref = doc.xref_get_key(parent, 'Parent')
+                if parent_kind != 'xref':
+                    break
+                parent = int(parent_ref.split()[0])
+                kind, value = doc.xref_get_key(parent, 'Resources')
+            doc.xref_set_key(page.xref, 'Resources', value if kind != 'null' else "<<>>")
+            kind, value = doc.xref_get_key(page.xref, 'Resources')
+
+        # xref_set_key does not follow indirect objects along a key path
+        owner, prefix = (int(value.split()[0]), '') if kind == 'xref' else (page.xref, 'Resources/')
+        kind, value = doc.xref_get_key(owner, f"{prefix}XObject")
+        if kind == 'xref':
+            doc.xref_set_key(int(value.split()[0]), RESOURCE_NAME, f"{form} 0 R")
+        elif kind == 'dict':
+            doc.xref_set_key(owner, f"{prefix}XObject/{RESOURCE_NAME}", f"{form} 0 R")
+        else:
+            doc.xref_set_key(owner, f"{prefix}XObject", f"<</{RESOURCE_NAME} {form} 0 R>>")
+
+    @staticmethod
+    def _add_contents(doc: 'fitz.Document', page: 'fitz.Page', opening: int, stamp: int):
+        """Bracket the page's content streams with ``opening`` and ``stamp``"""
+        kind, value = doc.xref_get_key(page.xref, 'Contents')
+        if kind == 'xref' and not doc.xref_is_stream(int(value.split()[0])):
+            value = doc.xref_object(int(value.split()[0]), compressed=True)  # Indirect array
+            kind = 'array'
+        if kind == 'array':
+            streams = value.strip()[1:-1]
+        elif kind == 'xref':
+            streams = value
+        else:
+            streams = ''
+        doc.xref_set_key(page.xref, 'Contents', f"[{opening} 0 R {streams} {stamp} 0 R]")